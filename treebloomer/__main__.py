@@ -1,18 +1,23 @@
 import logging
+import sys
 from pathlib import Path
-from typing import List, Optional
+from typing import TYPE_CHECKING, List, Optional
 import argparse
 
-from treebloomer.processes.audio_extraction import extract_audio
-from treebloomer.processes.audio_compression import compress_audio
-from treebloomer.processes.transcript_extraction import extract_transcript
-from treebloomer.processes.summarization import summarize_transcript
-from treebloomer.processes.html_page_generation import generate_html_summary
-from treebloomer.processes.word_cloud_generation import generate_word_cloud
+from treebloomer import api_client, telemetry
+from treebloomer.scheduler import build_stages, run_leaf, run_pipeline
+from treebloomer.tree_scan import is_remote, scan_tree
+
+# Everything else (modes, folder passes, remote trees) is imported in the branch that uses it, like
+# the stage registry resolves its 'module:function' targets, so a run only loads what it asked for.
+if TYPE_CHECKING:
+    from treebloomer.storage import RemoteTree
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(filename)s - %(funcName)s - %(lineno)d - %(message)s'
 
 logging.basicConfig(
     level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(filename)s - %(funcName)s - %(lineno)d - %(message)s'
+    format=LOG_FORMAT
 )
 
 logger = logging.getLogger(__name__)
@@ -22,41 +27,292 @@ def is_excluded(file_path: Path, exclude: Optional[List[str]] = None) -> bool:
         return False
     return any(ex in file_path.parts for ex in exclude) or file_path.name in exclude
 
-def process_video_file(video_file: Path, exclude: Optional[List[str]] = None):
-    logger.info(f"Processing {video_file}")
-    subfolder = video_file.parent / video_file.stem
-    subfolder.mkdir(exist_ok=True)
+def process_video_file(video_file: Path, exclude: Optional[List[str]] = None, stage_options: Optional[dict] = None,
+                       stages: Optional[list] = None, on_leaf_start=None):
+    logger.info("Processing %s", video_file)
 
     try:
-        audio_file = extract_audio(video_file, subfolder)
-        compressed_audio = compress_audio(audio_file, subfolder)
-        transcript_file = extract_transcript(compressed_audio, subfolder)
-        summary_file = summarize_transcript(transcript_file, subfolder)
-        wordcloud_file = generate_word_cloud(transcript_file, subfolder)
-        html_summary_file = generate_html_summary(summary_file, subfolder)
+        if on_leaf_start is not None:
+            on_leaf_start(video_file)
+        run_leaf(video_file, stage_options, stages or build_stages())
     except Exception as e:
-        logger.error(f"Failed to process {video_file}: {e}")
+        logger.error("Failed to process %s: %s", video_file, e)
+
+def build_stage_options(args) -> dict:
+    stage_options = {}
+    transcript_options = {}
+    if args.chunk_seconds:
+        transcript_options['chunk_length'] = args.chunk_seconds
+    if args.transcribe_backend == "local":
+        transcript_options['backend'] = "local"
+        transcript_options['local_options'] = {'model_size': args.whisper_model, 'workers': args.whisper_workers,
+                                               'threads': args.whisper_threads, 'batch_size': args.whisper_batch_size}
+    if transcript_options:
+        stage_options['extract_transcript'] = transcript_options
+    if args.fused_audio:
+        stage_options['compress_audio'] = {'keep_audio': args.keep_audio}
+    return stage_options
+
+def process_video_files(video_files: List[Path], args, stage_options: dict, stages: list,
+                        remote: Optional['RemoteTree'] = None):
+    root = remote.mirror if remote is not None else Path(args.directory)
+    start_leaf = remote.start_leaf if remote is not None else None
+
+    def index_leaf(video_file: Path, error: Optional[Exception] = None):
+        # whatever the leaf got through before a failure is searchable too
+        if args.search_index:
+            from treebloomer.search_index import update_index
+            update_index(root, [video_file])
+        if remote is not None:
+            remote.finish_leaf(video_file, error)
+
+    if args.jobs > 1 or args.api_concurrency > 1:
+        results = run_pipeline(video_files, jobs=args.jobs, api_concurrency=args.api_concurrency,
+                               stage_options=stage_options, stages=stages, log_format=LOG_FORMAT,
+                               on_leaf_done=index_leaf, on_leaf_start=start_leaf)
+        failed = [video_file for video_file, error in results.items() if error is not None]
+        logger.info("Processed %s of %s video files, %s failed.", len(results) - len(failed), len(results), len(failed))
+    else:
+        for video_file in video_files:
+            logger.info("Processing %s...", video_file)
+            process_video_file(video_file, args.exclude, stage_options, stages, start_leaf)
+            index_leaf(video_file)
+
+def probe_leaves(path: Path, video_files: List[Path]):
+    # Drops leaves ffprobe says can't succeed and puts the longest first. Without ffprobe the
+    # leaves go through as they are.
+    from treebloomer.media_probe import longest_first, probe_tree, split_usable
+    probes = probe_tree(path, video_files)
+    if probes is None:
+        return video_files, {}
+    usable, skipped = split_usable(video_files, probes)
+    for video_file, reason in skipped.items():
+        logger.warning("Skipping %s: %s", video_file, reason)
+    return longest_first(usable, probes), probes
+
+def search_main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="treebloomer", description="Full-text index of transcripts and summaries.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    index_parser = subparsers.add_parser("index", help="Bring the tree's search index up to date")
+    index_parser.add_argument("directory", nargs="?", default=r"./input", help="Root of the video tree")
+    index_parser.add_argument("--exclude", nargs="*", default=None, help="Files or folders to exclude")
+    search_parser = subparsers.add_parser("search", help="Search transcripts and summaries")
+    search_parser.add_argument("query", help="Words to look for (all must match)")
+    search_parser.add_argument("--directory", default=r"./input", help="Root of the video tree")
+    search_parser.add_argument("--limit", type=int, default=20, help="Maximum number of hits")
+    search_parser.add_argument("--raw", action="store_true", help="Pass the query to SQLite FTS5 as-is (phrases, OR, NEAR, prefix*)")
+    args = parser.parse_args(argv)
+
+    from treebloomer.search_index import DB_NAME, search, update_index
+    path = Path(args.directory)
+    if args.command == "index":
+        video_files = sorted(scan_tree(path, args.exclude))
+        update_index(path, video_files, prune=True)
+        print("Done!")
+        return
+    if not (path / DB_NAME).exists():
+        parser.error(f"No search index under {path}; run `python -m treebloomer index {path}` first")
+    for hit in search(path, args.query, limit=args.limit, raw=args.raw):
+        where = f"{hit.start:.1f}-{hit.end:.1f}s" if hit.start is not None else hit.kind
+        print(f"{hit.link}  [{where}]  {hit.snippet}")
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ("index", "search"):
+        return search_main(sys.argv[1:])
+
     default_directory_path = r"./input"
     parser = argparse.ArgumentParser(description="Process video files to extract audio and transcripts.")
     parser.add_argument("directory", nargs="?", default=default_directory_path, help="Directory containing video files to process")
     parser.add_argument("--exclude", nargs="*", default=None, help="Files or folders to exclude")
+    parser.add_argument("--jobs", type=int, default=1, help="Worker processes for CPU-bound stages (audio, word clouds, HTML)")
+    parser.add_argument("--api-concurrency", type=int, default=1, help="Concurrent requests for API-bound stages (transcription, summarization)")
+    parser.add_argument("--chunk-seconds", type=float, default=None, help="Transcribe in overlapping chunks of about this many seconds, in parallel (files over the 25 MB upload limit are always chunked)")
+    parser.add_argument("--fused-audio", action="store_true", help="Stream the video straight to compressed audio in one ffmpeg pass")
+    parser.add_argument("--status", action="store_true", help="Report which stages of each leaf are fresh, stale or missing, without processing anything")
+    parser.add_argument("--rescan", action="store_true", help="Ignore the saved scan index and list every directory again")
+    parser.add_argument("--watch", action="store_true", help="Keep running and process videos as they appear (and finish copying)")
+    parser.add_argument("--watch-interval", type=float, default=30.0, help="Seconds between rescans in --watch mode")
+    parser.add_argument("--rpm", type=float, default=None, help="API requests-per-minute budget shared by all workers")
+    parser.add_argument("--tpm", type=float, default=None, help="API tokens-per-minute budget shared by all workers (estimated with tiktoken)")
+    parser.add_argument("--api-base-url", default=None, help="Alternate API endpoint, e.g. a local stand-in server (defaults to OPENAI_BASE_URL)")
+    parser.add_argument("--stage-concurrency", nargs="*", default=[], metavar="STAGE=N", help="Cap concurrent requests for individual API stages, e.g. extract_transcript=2")
+    parser.add_argument("--compact-transcripts", action="store_true", help="Strip filler words (um, uh, asides like 'you know'), stutters and repeated phrases from transcripts before summarizing them")
+    parser.add_argument("--batch", action="store_true", help="Summarize every pending transcript in the tree through the Batch API, then exit")
+    parser.add_argument("--batch-poll-interval", type=float, default=60.0, help="Seconds between Batch API status checks")
+    parser.add_argument("--dedup", action="store_true", help="Process identical copies of a video once and link their artifacts into every copy")
+    parser.add_argument("--transcribe-backend", choices=["api", "local"], default="api", help="Transcribe with the hosted whisper-1 API or a local CPU whisper model")
+    parser.add_argument("--whisper-model", default="base", help="Local whisper model size (tiny, base, small, medium, large)")
+    parser.add_argument("--whisper-workers", type=int, default=1, help="Local whisper worker processes, each holding one loaded model")
+    parser.add_argument("--whisper-threads", type=int, default=4, help="torch threads per local whisper worker")
+    parser.add_argument("--whisper-batch-size", type=int, default=8, help="30 s audio windows decoded together by a local whisper worker")
+    parser.add_argument("--only-word-clouds", action="store_true", help="Only (re-)render missing or stale word clouds, batched across --jobs worker processes")
+    parser.add_argument("--dry-run", action="store_true", help="List the stages each leaf would run, without running them")
+    parser.add_argument("--plan", action="store_true", help="Probe every video and estimate API minutes, tokens, cost and wall time for the pending work, without running it")
+    parser.add_argument("--trim-silence", action="store_true", help="Cut long silences out of the audio before transcription (segment times still refer to the original video)")
+    parser.add_argument("--keep-audio", action="store_true", help="With --fused-audio, also write the full-quality .audio.mp3")
+    parser.add_argument("--search-index", action="store_true", help="Add each leaf's transcript and summary to the tree's search index as soon as the leaf finishes")
+    parser.add_argument("--site-index", action="store_true", help="Write an index.html into every directory linking its subfolders and leaf pages (only changed directories are re-rendered)")
+    parser.add_argument("--folder-clouds", action="store_true", help="Write a word cloud into every directory on the way to a leaf, merged from its leaves' saved term counts (only changed directories are re-merged)")
+    parser.add_argument("--folder-summaries", action="store_true", help="Summarize every directory on the way to a leaf from its children's summaries (only folders above changed leaves are re-summarized)")
+    parser.add_argument("--trace", default=None, metavar="FILE", help="Append one JSON line per stage run (time, CPU, memory, I/O, audio length, API tokens/latency/retries) to FILE")
+    parser.add_argument("--metrics-file", default=None, metavar="FILE", help="Write per-stage totals for this run as a Prometheus textfile (e.g. for node_exporter's textfile collector)")
+    parser.add_argument("--profile", default=None, metavar="DIR", help="Write a cProfile dump per stage run into DIR")
+    parser.add_argument("--queue", choices=["lockfile", "sqlite"], default=None, help="Work-queue mode for several nodes sharing one tree: claim (leaf, stage) tasks with leases in lock files on the shared mount or in a SQLite database")
+    parser.add_argument("--queue-db", default=None, help="SQLite database for --queue sqlite (default: <directory>/.treebloomer_queue.sqlite)")
+    parser.add_argument("--node-id", default=None, help="Name of this node in the work queue (default: hostname-pid)")
+    parser.add_argument("--node-stages", nargs="*", default=None, metavar="STAGE", help="Stages this node runs in queue mode; 'cpu' and 'api' select a whole pool (default: all)")
+    parser.add_argument("--queue-workers", type=int, default=None, help="Tasks this node runs at once in queue mode (default: --jobs + --api-concurrency)")
+    parser.add_argument("--lease-seconds", type=float, default=120.0, help="A claimed task whose holder stops heartbeating for this long is taken over by another node")
+    parser.add_argument("--queue-poll-interval", type=float, default=10.0, help="Seconds between passes while this node waits on others")
+    parser.add_argument("--queue-idle-exit", type=float, default=0.0, help="Keep waiting this many seconds for work from other nodes before exiting")
+    parser.add_argument("--spill-dir", default=None, help="Local mirror for a directory given as an fsspec URL (s3://, gs://, memory://, file://, ...): its artifacts plus the media being processed (default: a folder under the system temp dir)")
+    parser.add_argument("--spill-gb", type=float, default=20.0, help="Media kept in --spill-dir at once when working on a remote tree, including the next leaves being prefetched")
+    parser.add_argument("--log-level", default="DEBUG", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Logging level")
 
     args = parser.parse_args()
     directory = args.directory
     exclude = args.exclude
+    logging.getLogger().setLevel(args.log_level)
+    telemetry.configure(trace_file=args.trace, metrics_file=args.metrics_file, profile_dir=args.profile)
 
-    logger.info(f"Processing video files in {directory}, excluding {exclude}")
+    logger.info("Processing video files in %s, excluding %s", directory, exclude)
     path = Path(directory)
 
-    for video_file in path.rglob('*.mp4'):
-        logger.info(f"Found video file: {video_file}")
-        if not is_excluded(video_file, exclude):
-            logger.info(f"Processing {video_file}...")
-            process_video_file(video_file, exclude)
-        else:
-            logger.info(f"{video_file} is excluded, skipping...")
+    stage_concurrency = {}
+    for limit in args.stage_concurrency:
+        stage, _, count = limit.partition("=")
+        if not count.isdigit():
+            parser.error(f"--stage-concurrency expects STAGE=N, got {limit!r}")
+        stage_concurrency[stage] = int(count)
+    api_client.configure(base_url=args.api_base_url, requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                         max_connections=max(args.api_concurrency * 2, 10), max_in_flight=args.api_concurrency,
+                         stage_concurrency=stage_concurrency)
+
+    if args.compact_transcripts:
+        from treebloomer.processes import summarization
+        summarization.compact_transcripts = True
+    if args.transcribe_backend == "local":
+        from treebloomer.processes import transcript_extraction
+        transcript_extraction.backend = "local"
+        transcript_extraction.local_options = build_stage_options(args)['extract_transcript']['local_options']
+    stages = build_stages(fused_audio=args.fused_audio, trim_silence=args.trim_silence)
+    if is_remote(directory):
+        if args.watch or args.queue or args.dedup or args.plan:
+            parser.error("--watch, --queue, --dedup and --plan need a local directory")
+        from treebloomer.storage import RemoteTree
+        remote = RemoteTree(directory, Path(args.spill_dir) if args.spill_dir else None, int(args.spill_gb * 1024 ** 3))
+        try:
+            video_files = remote.scan(exclude)
+            logger.info("Found %s video files", len(video_files))
+            run_tree(parser, args, remote.mirror, video_files, stages, remote)
+        finally:
+            # pushes whatever got done, also when interrupted
+            remote.close()
+        return
+
+    if args.watch:
+        from treebloomer.tree_scan import watch_tree
+        stage_options = build_stage_options(args)
+        for video_files in watch_tree(path, exclude, interval=args.watch_interval):
+            logger.info("%s new or changed video files ready", len(video_files))
+            video_files, _ = probe_leaves(path, video_files)
+            process_video_files(video_files, args, stage_options, stages)
+            build_folder_outputs(args, path, sorted(scan_tree(path, exclude)))
+            telemetry.write_metrics()
+        return
+
+    # excluded names are pruned during the scan itself
+    video_files = sorted(scan_tree(path, exclude, use_index=not args.rescan))
+    logger.info("Found %s video files", len(video_files))
+    run_tree(parser, args, path, video_files, stages)
+
+def build_folder_outputs(args, path: Path, video_files: List[Path]):
+    # the per-directory passes that run after the leaves
+    if args.site_index:
+        from treebloomer.site_index import build_site_index
+        build_site_index(path, video_files)
+    if args.folder_clouds:
+        from treebloomer.folder_clouds import build_folder_clouds
+        build_folder_clouds(path, video_files)
+    if args.folder_summaries:
+        from treebloomer.folder_summaries import build_folder_summaries
+        build_folder_summaries(path, video_files, api_concurrency=args.api_concurrency)
+
+def run_tree(parser, args, path: Path, video_files: List[Path], stages: list, remote: Optional['RemoteTree'] = None):
+    if args.status or args.dry_run:
+        from treebloomer.manifest import config_hashes, leaf_status
+        configs = config_hashes(stages)
+        for video_file in video_files:
+            status = leaf_status(video_file, stages, configs)
+            if args.status:
+                print(f"{video_file}: " + ", ".join(f"{name}={state}" for name, state in status.items()))
+            else:
+                pending = [name for name, state in status.items() if state != 'fresh']
+                print(f"{video_file}: {', '.join(pending) if pending else 'up to date'}")
+        return
+
+    if args.plan:
+        from treebloomer.media_probe import probe_tree, split_usable
+        from treebloomer.planner import build_plan, print_plan
+        probes = probe_tree(path, video_files)
+        if probes is None:
+            parser.error("--plan needs ffprobe")
+        usable, skipped = split_usable(video_files, probes)
+        print_plan(build_plan(usable, probes, stages, skipped, jobs=args.jobs, api_concurrency=args.api_concurrency,
+                              backend=args.transcribe_backend, tokens_per_minute=args.tpm),
+                   trim_silence=args.trim_silence)
+        return
+
+    if args.only_word_clouds:
+        from treebloomer.scheduler import render_word_clouds
+        rendered = render_word_clouds(video_files, stages, workers=args.jobs)
+        logger.info("Rendered %s word clouds", rendered)
+        print("Done!")
+        return
+
+    if args.batch:
+        from treebloomer.batch_summarization import run_batch_summarization
+        run_batch_summarization(path, video_files, stages, poll_interval=args.batch_poll_interval)
+        print("Done!")
+        return
+
+    if args.queue:
+        from treebloomer.work_queue import run_queue_worker
+        video_files, _ = probe_leaves(path, video_files)
+        try:
+            run_queue_worker(path, video_files, stages, kind=args.queue, node_id=args.node_id,
+                             node_stages=args.node_stages, stage_options=build_stage_options(args),
+                             workers=args.queue_workers or args.jobs + args.api_concurrency, jobs=args.jobs,
+                             lease_seconds=args.lease_seconds, poll_interval=args.queue_poll_interval,
+                             idle_exit=args.queue_idle_exit, db_path=Path(args.queue_db) if args.queue_db else None,
+                             log_format=LOG_FORMAT)
+        except ValueError as e:
+            parser.error(str(e))
+        telemetry.write_metrics()
+        print("Done!")
+        return
+
+    duplicates = {}
+    if remote is not None:
+        leaves = remote.queue_leaves(video_files, stages)
+    else:
+        video_files, probes = probe_leaves(path, video_files)
+        if args.dedup:
+            from treebloomer.dedup import find_duplicates
+            from treebloomer.media_probe import longest_first
+            video_files, duplicates = find_duplicates(path, video_files)
+            video_files = longest_first(video_files, probes)
+        leaves = video_files
+
+    process_video_files(leaves, args, build_stage_options(args), stages, remote)
+    if duplicates:
+        from treebloomer.dedup import link_duplicates
+        link_duplicates(duplicates, stages)
+        if args.search_index:
+            from treebloomer.search_index import update_index
+            update_index(path, sorted(duplicates))
+    build_folder_outputs(args, path, sorted([*video_files, *duplicates]))
+    telemetry.write_metrics()
 
     print("Done!")
 
@@ -0,0 +1,205 @@
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Dict, Optional, TypeVar
+
+from treebloomer import telemetry
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Process-wide settings; main() overrides them from the command line through configure().
+# base_url falls back to OPENAI_BASE_URL, which is also how a local stand-in server is plugged in.
+settings = {
+    'base_url': None,
+    'max_connections': 20,
+    'max_in_flight': None,
+    'requests_per_minute': None,
+    'tokens_per_minute': None,
+    'max_attempts': 6,
+    'backoff_base': 1.0,
+    'backoff_cap': 60.0,
+    'timeout': 600.0,
+}
+
+_lock = threading.Lock()
+_client: Optional['OpenAI'] = None
+_dotenv_loaded = False
+_request_bucket: Optional['TokenBucket'] = None
+_token_bucket: Optional['TokenBucket'] = None
+_stage_limits: Dict[str, threading.BoundedSemaphore] = {}
+# Caps requests on the wire across all stages and helper threads (map-reduce chunks, folder groups),
+# so --api-concurrency bounds the connections even where a stage fans out its own requests.
+_in_flight: Optional[threading.BoundedSemaphore] = None
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0):
+        # A single request bigger than the whole bucket is let through once the bucket is full,
+        # otherwise it could never run.
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                wait = (amount - self.level) / self.rate
+            time.sleep(wait)
+
+    def drain(self, seconds: float):
+        # Called on a 429: the provider says we're over, so stop handing out budget for a while.
+        with self.lock:
+            self.level = min(self.level, -seconds * self.rate)
+
+
+def configure(**overrides):
+    global _client, _request_bucket, _token_bucket, _in_flight
+    unknown = set(overrides) - set(settings) - {'stage_concurrency'}
+    if unknown:
+        raise ValueError(f"Unknown API client settings: {', '.join(sorted(unknown))}")
+    stage_concurrency = overrides.pop('stage_concurrency', None) or {}
+    with _lock:
+        settings.update(overrides)
+        _client = None
+        _request_bucket = TokenBucket(settings['requests_per_minute']) if settings['requests_per_minute'] else None
+        _token_bucket = TokenBucket(settings['tokens_per_minute']) if settings['tokens_per_minute'] else None
+        _in_flight = threading.BoundedSemaphore(settings['max_in_flight']) if settings['max_in_flight'] else None
+        for stage, limit in stage_concurrency.items():
+            _stage_limits[stage] = threading.BoundedSemaphore(limit)
+
+
+def _client_kwargs() -> dict:
+    global _dotenv_loaded
+    if not _dotenv_loaded:
+        # deferred from import time so CLI startup and non-API workers don't pay for it
+        from dotenv import load_dotenv
+        load_dotenv()
+        _dotenv_loaded = True
+    return {
+        'api_key': os.getenv("OPENAI_API_KEY"),
+        'base_url': settings['base_url'] or os.getenv("OPENAI_BASE_URL") or None,
+        'timeout': settings['timeout'],
+        # retries are ours (see call_with_retry), so the SDK's own are turned off
+        'max_retries': 0,
+    }
+
+
+def get_client() -> 'OpenAI':
+    global _client
+    with _lock:
+        if _client is None:
+            import httpx
+            from openai import OpenAI
+            limits = httpx.Limits(max_connections=settings['max_connections'],
+                                  max_keepalive_connections=settings['max_connections'])
+            _client = OpenAI(http_client=httpx.Client(limits=limits, timeout=settings['timeout']), **_client_kwargs())
+        return _client
+
+
+def estimate_tokens(text: str, model: str = "gpt-4o") -> int:
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+        return len(encoding.encode(text, disallowed_special=()))
+    except ImportError:
+        # roughly four characters per token for English text
+        return len(text) // 4 + 1
+
+
+@contextmanager
+def stage_limit(stage: Optional[str]):
+    semaphore = _stage_limits.get(stage) if stage else None
+    if semaphore is None:
+        yield
+        return
+    with semaphore:
+        yield
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = response.headers.get('retry-after')
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def _is_retryable(error: Exception) -> bool:
+    import openai
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS
+    return False
+
+
+def call_with_retry(request: Callable[[], T], stage: Optional[str] = None, tokens: int = 0) -> T:
+    # Waits for the per-stage slot and the request/token budgets, then retries transient failures
+    # with full-jitter exponential backoff, never sooner than the server's Retry-After.
+    with stage_limit(stage):
+        attempt = 0
+        latency = 0.0
+        while True:
+            if _request_bucket is not None:
+                _request_bucket.acquire(1)
+            if _token_bucket is not None and tokens:
+                _token_bucket.acquire(tokens)
+            started = time.perf_counter()
+            try:
+                if _in_flight is None:
+                    response = request()
+                else:
+                    with _in_flight:
+                        response = request()
+                if telemetry.enabled:
+                    telemetry.record_api_call(latency + time.perf_counter() - started, attempt, tokens, response)
+                return response
+            except Exception as e:
+                latency += time.perf_counter() - started
+                attempt += 1
+                if not _is_retryable(e) or attempt >= settings['max_attempts']:
+                    raise
+                delay = random.uniform(0, min(settings['backoff_cap'], settings['backoff_base'] * 2 ** attempt))
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                if getattr(e, 'status_code', None) == 429:
+                    for bucket in (_request_bucket, _token_bucket):
+                        if bucket is not None:
+                            bucket.drain(delay)
+                logger.warning("%s request failed (%s), retry %d/%d in %.1fs", stage or 'API',
+                               e.__class__.__name__, attempt, settings['max_attempts'] - 1, delay)
+                time.sleep(delay)
@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# In-process LRU of parsed artifacts: a stage puts the object it just wrote (the transcript response,
+# the summary dict) under the artifact's path, and the next stage, indexer or site builder in the
+# same process gets it back instead of re-reading and re-parsing the file. Disk stays the durable
+# copy: every hit is checked against the file's current size and mtime, so an artifact rewritten by
+# another process or node is read again. Entries are weighed by their file size; parsed objects are
+# several times bigger in memory, so max_bytes is kept well below what we're willing to spend.
+# Cached objects are shared, so callers treat them as read-only.
+max_bytes = 128 * 1024 * 1024
+
+_lock = threading.Lock()
+_entries: 'OrderedDict[str, Tuple[int, int, Any]]' = OrderedDict()
+_total = 0
+
+def _signature(path: Path) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def _store(key: str, signature: Tuple[int, int], value: Any) -> None:
+    global _total
+    size = signature[0]
+    with _lock:
+        previous = _entries.pop(key, None)
+        if previous is not None:
+            _total -= previous[0]
+        if size > max_bytes:
+            return
+        _entries[key] = (size, signature[1], value)
+        _total += size
+        while _total > max_bytes:
+            _, (evicted_size, _, _) = _entries.popitem(last=False)
+            _total -= evicted_size
+
+def put(path: Path, value: Any) -> Any:
+    # Call after the artifact is on disk (renamed into place), so the recorded mtime is the final one.
+    signature = _signature(path)
+    if signature is not None:
+        _store(str(path), signature, value)
+    return value
+
+def get(path: Path) -> Optional[Any]:
+    signature = _signature(path)
+    with _lock:
+        entry = _entries.get(str(path))
+        if entry is None or signature is None or entry[:2] != signature:
+            return None
+        _entries.move_to_end(str(path))
+        return entry[2]
+
+def load(path: Path, parse: Callable[[Path], Any]) -> Any:
+    value = get(path)
+    if value is not None:
+        return value
+    # stat before parsing: if the file changes while it's being read the entry is already stale
+    signature = _signature(path)
+    value = parse(path)
+    if signature is not None:
+        _store(str(path), signature, value)
+    return value
+
+def _read_json(path: Path) -> Any:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def load_json(path: Path) -> Any:
+    return load(path, _read_json)
+
+def clear() -> None:
+    global _total
+    with _lock:
+        _entries.clear()
+        _total = 0
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from treebloomer.api_client import estimate_tokens, get_client
+from treebloomer.manifest import config_hashes, expected_entries, load_manifest, record_stage, save_manifest
+from treebloomer.processes import summarization
+from treebloomer.processes.transcript_store import load_text
+
+logger = logging.getLogger(__name__)
+
+STATE_NAME = '.treebloomer_batch.json'
+STAGE_NAME = 'summarize_transcript'
+# Batch API limits are 50,000 requests and 200 MB per input file.
+max_requests_per_batch = 50_000
+max_bytes_per_batch = 190 * 1024 * 1024
+terminal_statuses = {'completed', 'failed', 'expired', 'cancelled'}
+
+# State kept at the tree root so an interrupted run picks up its in-flight batches instead of
+# resubmitting them:
+#   {"batches": {batch_id: {"input_file_id": ..., "done": bool,
+#                           "requests": {custom_id: {"video": relative path, "entry": manifest entry}}}}}
+
+def _state_path(root: Path) -> Path:
+    return root / STATE_NAME
+
+def load_state(root: Path) -> dict:
+    try:
+        with open(_state_path(root), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'batches': {}}
+
+def save_state(root: Path, state: dict) -> None:
+    path = _state_path(root)
+    incomplete_path = path.with_name(path.name + '.incomplete')
+    with open(incomplete_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=4)
+    incomplete_path.replace(path)
+
+def _leaf_paths(video_file: Path):
+    subfolder = video_file.parent / video_file.stem
+    return subfolder, subfolder / f"{video_file.stem}.transcript.json"
+
+def collect_pending(root: Path, video_files: List[Path], stages: list, in_flight: set) -> Dict[str, dict]:
+    pending = {}
+    configs = config_hashes(stages)
+    for video_file in video_files:
+        subfolder, transcript_file = _leaf_paths(video_file)
+        if not transcript_file.exists():
+            continue
+        entry = expected_entries(video_file, stages, configs)[STAGE_NAME]
+        recorded = load_manifest(video_file).get('stages', {}).get(STAGE_NAME)
+        output_file = summarization.summary_output_file(transcript_file, subfolder)
+        if output_file.exists() and (recorded is None or recorded.get('fingerprint') == entry['fingerprint']):
+            continue
+        relative = video_file.relative_to(root).as_posix()
+        # same leaf + same inputs/config -> same id, which is what makes resubmission idempotent
+        custom_id = hashlib.sha256(f"{relative}\0{entry['fingerprint']}".encode('utf-8')).hexdigest()[:32]
+        if custom_id in in_flight:
+            continue
+        transcript_text = load_text(transcript_file)
+        if estimate_tokens(transcript_text, summarization.model) > summarization.single_pass_token_limit:
+            # map-reduce needs several dependent calls; leave these to the interactive path
+            logger.info("Skipping %s in batch mode: transcript exceeds the single-pass token limit", video_file)
+            continue
+        pending[custom_id] = {'video': relative, 'entry': entry}
+    return pending
+
+def _request_lines(root: Path, pending: Dict[str, dict]):
+    for custom_id, request in pending.items():
+        video_file = root / request['video']
+        _, transcript_file = _leaf_paths(video_file)
+        transcript_text, compaction = summarization.prepare_transcript(load_text(transcript_file), transcript_file.stem)
+        # saved with the request in the state file, so fan_out records the same llm_details as the
+        # interactive path even when the results are collected by a later run
+        request['extra_details'] = {'compaction': compaction} if compaction else {}
+        line = json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                           "body": summarization.build_request(transcript_text)})
+        yield custom_id, line + "\n"
+
+def submit(root: Path, pending: Dict[str, dict], state: dict) -> None:
+    client = get_client()
+    groups, current, size = [], [], 0
+    for custom_id, line in _request_lines(root, pending):
+        encoded = line.encode('utf-8')
+        if current and (len(current) >= max_requests_per_batch or size + len(encoded) > max_bytes_per_batch):
+            groups.append(current)
+            current, size = [], 0
+        current.append((custom_id, encoded))
+        size += len(encoded)
+    if current:
+        groups.append(current)
+
+    for group in groups:
+        digest = hashlib.sha256(b"".join(custom_id.encode('utf-8') for custom_id, _ in group)).hexdigest()[:32]
+        # A crash between creating a batch and saving the state would otherwise resubmit it,
+        # so look for a live batch tagged with the same request digest first. Batches are listed
+        # newest first and such a batch is among the latest, so one page is enough; iterating the
+        # page object itself would page through every batch the account ever made.
+        existing = next((batch for batch in client.batches.list(limit=100).data
+                         if (batch.metadata or {}).get('treebloomer_digest') == digest
+                         and batch.status not in {'failed', 'expired', 'cancelled'}), None)
+        if existing is not None:
+            batch_id, input_file_id = existing.id, existing.input_file_id
+            logger.info("Reusing batch %s for %s transcripts", batch_id, len(group))
+        else:
+            batch_file = root / f".treebloomer_batch_{digest}.jsonl"
+            with open(batch_file, 'wb') as f:
+                for _, encoded in group:
+                    f.write(encoded)
+            with open(batch_file, 'rb') as f:
+                input_file_id = client.files.create(file=f, purpose="batch").id
+            batch = client.batches.create(input_file_id=input_file_id, endpoint="/v1/chat/completions",
+                                          completion_window="24h", metadata={'treebloomer_digest': digest})
+            batch_id = batch.id
+            batch_file.unlink()
+            logger.info("Submitted batch %s with %s transcripts", batch_id, len(group))
+        state['batches'][batch_id] = {'input_file_id': input_file_id, 'done': False,
+                                      'requests': {custom_id: pending[custom_id] for custom_id, _ in group}}
+        save_state(root, state)
+
+def fan_out(root: Path, requests: Dict[str, dict], output_text: str) -> int:
+    written = 0
+    for line in output_text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        request = requests.get(result.get('custom_id'))
+        if request is None:
+            continue
+        video_file = root / request['video']
+        response = result.get('response') or {}
+        if result.get('error') or response.get('status_code') != 200:
+            logger.error("Batch summarization failed for %s: %s", video_file, result.get('error') or response.get('body'))
+            continue
+        body = response['body']
+        subfolder, transcript_file = _leaf_paths(video_file)
+        output_file = summarization.summary_output_file(transcript_file, subfolder)
+        summarization.write_summary(output_file, body['choices'][0]['message']['content'], transcript_file, body['model'],
+                                    request.get('extra_details'))
+        manifest = load_manifest(video_file)
+        record_stage(manifest, STAGE_NAME, request['entry'], output_file)
+        save_manifest(video_file, manifest)
+        written += 1
+    return written
+
+def run_batch_summarization(root: Path, video_files: List[Path], stages: list, poll_interval: float = 60.0) -> int:
+    client = get_client()
+    state = load_state(root)
+    in_flight = {custom_id for batch in state['batches'].values() if not batch['done'] for custom_id in batch['requests']}
+    if in_flight:
+        logger.info("Resuming %s in-flight batches", sum(not batch['done'] for batch in state['batches'].values()))
+
+    pending = collect_pending(root, video_files, stages, in_flight)
+    logger.info("%s transcripts pending summarization", len(pending))
+    if pending:
+        submit(root, pending, state)
+
+    written = 0
+    while True:
+        open_batches = {batch_id: batch for batch_id, batch in state['batches'].items() if not batch['done']}
+        if not open_batches:
+            break
+        for batch_id, batch in open_batches.items():
+            remote = client.batches.retrieve(batch_id)
+            if remote.status not in terminal_statuses:
+                counts = remote.request_counts
+                logger.info("Batch %s is %s%s", batch_id, remote.status,
+                            f" ({counts.completed}/{counts.total})" if counts else "")
+                continue
+            # expired/cancelled batches still carry whatever finished before they stopped
+            if remote.output_file_id:
+                written += fan_out(root, batch['requests'], client.files.content(remote.output_file_id).text)
+            if remote.error_file_id:
+                fan_out(root, batch['requests'], client.files.content(remote.error_file_id).text)
+            if remote.status != 'completed':
+                logger.warning("Batch %s ended as %s; unfinished transcripts will be resubmitted next run", batch_id, remote.status)
+            batch['done'] = True
+            save_state(root, state)
+        if any(not batch['done'] for batch in state['batches'].values()):
+            time.sleep(poll_interval)
+
+    _state_path(root).unlink(missing_ok=True)
+    logger.info("Batch summarization wrote %s summaries", written)
+    return written
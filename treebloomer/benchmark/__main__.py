@@ -0,0 +1,228 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from treebloomer import api_client, telemetry
+from treebloomer.batch_summarization import run_batch_summarization
+from treebloomer.benchmark.mock_api import start_server
+from treebloomer.benchmark.synthetic_tree import generate_tree
+from treebloomer.scheduler import build_stages, run_pipeline
+from treebloomer.tree_scan import INDEX_NAME, scan_tree
+
+logger = logging.getLogger(__name__)
+
+RESULTS_VERSION = 1
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+
+# Each tree size runs in its own subprocess so peak memory is measured per size rather than as the
+# high-water mark of the whole session. Per-stage numbers come from the telemetry trace.
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def stage_summary(trace_file: Path, run_id: str) -> Dict[str, dict]:
+    by_stage: Dict[str, List[dict]] = {}
+    with open(trace_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('run') == run_id:
+                by_stage.setdefault(record['stage'], []).append(record)
+    summary = {}
+    for stage, records in by_stage.items():
+        walls = [record['wall_s'] for record in records]
+        # throughput over the span in which the stage was active, so overlapping leaves count once
+        active = max(record['started'] + record['wall_s'] for record in records) - min(record['started'] for record in records)
+        summary[stage] = {
+            'runs': len(records),
+            'errors': sum(record['status'] != 'ok' for record in records),
+            'throughput_per_s': len(records) / active if active > 0 else None,
+            'p50_s': percentile(walls, 0.50),
+            'p95_s': percentile(walls, 0.95),
+            # thread CPU only: subprocess CPU and RSS are process-wide and reported once per size
+            'cpu_s': sum(record['cpu_s'] for record in records),
+            'api_requests': sum(record['api_requests'] for record in records),
+            'api_retries': sum(record['api_retries'] for record in records),
+            'api_tokens': sum(record['api_prompt_tokens'] + record['api_completion_tokens'] for record in records),
+        }
+    return summary
+
+
+def run_size(args, size: int) -> dict:
+    import resource
+
+    workdir = Path(args.workdir)
+    root = workdir / f"tree_{size}"
+    if root.exists() and not args.keep_trees:
+        shutil.rmtree(root)
+    started = time.perf_counter()
+    video_files = generate_tree(root, size, duration=args.duration, kind=args.kind, unique_clips=args.unique_clips,
+                                depth=args.depth, fanout=args.fanout)
+    generate_s = time.perf_counter() - started
+
+    (root / INDEX_NAME).unlink(missing_ok=True)
+    started = time.perf_counter()
+    scan_tree(root)
+    crawl_cold_s = time.perf_counter() - started
+    started = time.perf_counter()
+    scan_tree(root)
+    crawl_warm_s = time.perf_counter() - started
+
+    server, stats, base_url = start_server(latency=args.latency, jitter=args.jitter, rate_429=args.rate_429,
+                                           seed=args.seed)
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    api_client.configure(base_url=base_url, backoff_base=0.05, backoff_cap=2.0,
+                         max_connections=max(args.api_concurrency * 2, 10), max_in_flight=args.api_concurrency)
+    trace_file = workdir / f"trace_{size}.jsonl"
+    trace_file.unlink(missing_ok=True)
+    run_id = f"benchmark-{size}"
+    telemetry.configure(trace_file=str(trace_file), run_id=run_id)
+
+    stages = build_stages(args.fused_audio, args.trim_silence)
+    if args.batch:
+        # transcripts interactively, then the summaries through the mocked Batch API
+        names = [stage.name for stage in stages]
+        pipeline_stages = stages[:names.index('summarize_transcript')]
+    else:
+        pipeline_stages = stages
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    results = run_pipeline(video_files, jobs=args.jobs, api_concurrency=args.api_concurrency,
+                           stages=pipeline_stages, log_format=LOG_FORMAT)
+    pipeline_s = time.perf_counter() - started
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # subprocess CPU of the pipeline run, leaving out the ffmpeg calls that rendered the tree
+    child_cpu_s = (children_after.ru_utime + children_after.ru_stime
+                   - children_before.ru_utime - children_before.ru_stime)
+    batch = {}
+    if args.batch:
+        started = time.perf_counter()
+        summaries = run_batch_summarization(root, video_files, stages, poll_interval=args.batch_poll_interval)
+        batch = {'batch_s': time.perf_counter() - started, 'batch_summaries': summaries}
+    server.shutdown()
+
+    return {
+        'leaves': size,
+        'generate_s': generate_s,
+        'crawl_cold_s': crawl_cold_s,
+        'crawl_warm_s': crawl_warm_s,
+        'pipeline_s': pipeline_s,
+        'leaves_per_s': size / pipeline_s if pipeline_s > 0 else None,
+        'failed_leaves': sum(error is not None for error in results.values()),
+        **batch,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'child_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'child_cpu_s': child_cpu_s,
+        'api_server': stats.snapshot(),
+        'stages': stage_summary(trace_file, run_id) if trace_file.exists() else {},
+    }
+
+
+def git_revision() -> str:
+    try:
+        completed = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                   cwd=Path(__file__).resolve().parent)
+        return completed.stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def compare(baseline: dict, current: dict) -> None:
+    baseline_sizes = {result['leaves']: result for result in baseline['results']}
+    for result in current['results']:
+        previous = baseline_sizes.get(result['leaves'])
+        if previous is None:
+            continue
+        print(f"{result['leaves']} leaves ({baseline['revision']} -> {current['revision']}):")
+        for key in ('crawl_cold_s', 'crawl_warm_s', 'pipeline_s'):
+            print(f"  {key:<24} {previous[key]:10.3f} -> {result[key]:10.3f}  ({_change(previous[key], result[key])})")
+        for stage, stats in result['stages'].items():
+            old = previous['stages'].get(stage)
+            if old:
+                print(f"  {stage + ' p50_s':<24} {old['p50_s']:10.3f} -> {stats['p50_s']:10.3f}  ({_change(old['p50_s'], stats['p50_s'])})")
+
+
+def _change(old: float, new: float) -> str:
+    return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m treebloomer.benchmark",
+                                     description="End-to-end benchmark on a synthetic tree against a local mock API.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100], help="Tree sizes (leaf counts) to run, e.g. 10 100 1000 10000")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per synthetic clip")
+    parser.add_argument("--kind", choices=["speech", "tone"], default="speech", help="Speech-like bursts with pauses, or a steady tone")
+    parser.add_argument("--unique-clips", type=int, default=4, help="Distinct clips rendered; leaves are hardlinks to these")
+    parser.add_argument("--depth", type=int, default=2, help="Folder levels above the leaves")
+    parser.add_argument("--fanout", type=int, default=10, help="Leaves per folder and folders per level")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mock API response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Standard deviation of the mock latency")
+    parser.add_argument("--rate-429", type=float, default=0.02, help="Fraction of mock API requests answered with 429")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--api-concurrency", type=int, default=8)
+    parser.add_argument("--fused-audio", action="store_true")
+    parser.add_argument("--trim-silence", action="store_true")
+    parser.add_argument("--batch", action="store_true", help="Summarize through the mock's Batch API endpoints instead of per-leaf requests")
+    parser.add_argument("--batch-poll-interval", type=float, default=0.5, help="Seconds between batch status checks in --batch mode")
+    parser.add_argument("--workdir", default="./benchmark_runs", help="Where synthetic trees and traces are written")
+    parser.add_argument("--keep-trees", action="store_true", help="Reuse trees (and their artifacts) from a previous run")
+    parser.add_argument("--output", default=None, help="Results JSON (default: <workdir>/results-<revision>.json)")
+    parser.add_argument("--compare", default=None, metavar="BASELINE", help="Print changes against an earlier results JSON")
+    parser.add_argument("--single-size", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT)
+    Path(args.workdir).mkdir(parents=True, exist_ok=True)
+
+    if args.single_size is not None:
+        json.dump(run_size(args, args.single_size), sys.stdout)
+        return
+
+    results = []
+    for size in args.sizes:
+        print(f"Running {size} leaves...", file=sys.stderr)
+        command = [sys.executable, "-m", "treebloomer.benchmark", *sys.argv[1:], "--single-size", str(size)]
+        completed = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+        if completed.returncode != 0:
+            raise SystemExit(f"Benchmark for {size} leaves failed with exit code {completed.returncode}")
+        results.append(json.loads(completed.stdout))
+
+    revision = git_revision()
+    document = {
+        'version': RESULTS_VERSION,
+        'revision': revision,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('single_size', 'compare', 'output')},
+        'results': results,
+    }
+    output = Path(args.output or Path(args.workdir) / f"results-{revision}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(document, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(json.load(f), document)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Local stand-in for the OpenAI endpoints the pipeline calls. Point the pipeline at it with
+# --api-base-url http://127.0.0.1:<port>/v1. Transcripts are invented from the upload size
+# (compressed audio is ~32 kb/s), summaries are fixed text shaped like the output schema. The
+# Batch API (/files, /batches) is mocked too: a batch answers every line of its input file with
+# such a summary and reports completed on its batch_polls-th retrieve.
+
+words = ("entropy gradient lecture example theorem proof model signal energy system network "
+         "process function history language memory structure feedback pattern data field").split()
+upload_bytes_per_second = 4000
+segment_seconds = 5.0
+batch_polls = 2
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.throttled = 0
+
+    def count(self, path: str, throttled: bool) -> None:
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            self.throttled += throttled
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'requests': dict(self.requests), 'throttled': self.throttled}
+
+
+def fake_transcript(upload_size: int, rng: random.Random) -> dict:
+    duration = max(1.0, upload_size / upload_bytes_per_second)
+    segments, start = [], 0.0
+    while start < duration:
+        end = min(duration, start + segment_seconds)
+        text = " " + " ".join(rng.choice(words) for _ in range(12)) + "."
+        segments.append({"id": len(segments), "seek": int(start * 100), "start": start, "end": end, "text": text,
+                         "tokens": [], "temperature": 0.0, "avg_logprob": -0.2, "compression_ratio": 1.4,
+                         "no_speech_prob": 0.01})
+        start = end
+    return {"task": "transcribe", "language": "english", "duration": duration,
+            "text": "".join(segment["text"] for segment in segments).strip(), "segments": segments}
+
+
+def fake_summary(model: str, prompt_chars: int) -> dict:
+    content = {
+        "page_summary": "# Synthetic lecture\n\n- covers entropy\n- covers signal models\n",
+        "paragraph_summary": "A synthetic lecture about entropy and signal models.",
+        "sentence_summary": "A synthetic lecture.",
+        "topics": ["entropy", "signal models"],
+        "keywords": ["information theory", "signals"],
+        "pull_quotes": ["entropy gradient lecture example"],
+    }
+    prompt_tokens = prompt_chars // 4 + 1
+    return {
+        "id": "chatcmpl-benchmark", "object": "chat.completion", "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": json.dumps(content), "refusal": None}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 80, "total_tokens": prompt_tokens + 80},
+    }
+
+
+class BatchStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+
+    def add_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        with self.lock:
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = content
+        return {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+
+    def create_batch(self, request: dict) -> Optional[dict]:
+        with self.lock:
+            if request.get("input_file_id") not in self.files:
+                return None
+            batch = {"id": f"batch_{len(self.batches) + 1}", "object": "batch", "endpoint": request.get("endpoint"),
+                     "input_file_id": request["input_file_id"], "completion_window": request.get("completion_window"),
+                     "status": "validating", "created_at": int(time.time()), "metadata": request.get("metadata"),
+                     "output_file_id": None, "error_file_id": None, "request_counts": None, "polls": 0}
+            self.batches[batch["id"]] = batch
+        return self.public(batch)
+
+    def retrieve(self, batch_id: str) -> Optional[dict]:
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            batch["polls"] += 1
+            lines = [json.loads(line) for line in self.files[batch["input_file_id"]].splitlines() if line.strip()]
+            if batch["status"] != "completed" and batch["polls"] >= batch_polls:
+                output = []
+                for line in lines:
+                    messages = line["body"].get("messages", [])
+                    prompt_chars = sum(len(message.get("content") or "") for message in messages)
+                    output.append(json.dumps({"id": f"batch_req_{len(output) + 1}", "custom_id": line["custom_id"],
+                                              "response": {"status_code": 200, "request_id": "benchmark",
+                                                           "body": fake_summary(line["body"].get("model", "benchmark"),
+                                                                                prompt_chars)},
+                                              "error": None}))
+                file_id = f"file-{len(self.files) + 1}"
+                self.files[file_id] = ("\n".join(output) + "\n").encode("utf-8")
+                batch.update(status="completed", output_file_id=file_id, completed_at=int(time.time()),
+                             request_counts={"total": len(lines), "completed": len(lines), "failed": 0})
+            elif batch["status"] == "validating":
+                batch.update(status="in_progress", request_counts={"total": len(lines), "completed": 0, "failed": 0})
+            return self.public(batch)
+
+    def list(self, limit: int) -> dict:
+        with self.lock:
+            batches = [self.public(batch) for batch in reversed(list(self.batches.values()))]
+        page = batches[:limit]
+        return {"object": "list", "data": page, "first_id": page[0]["id"] if page else None,
+                "last_id": page[-1]["id"] if page else None, "has_more": len(batches) > limit}
+
+    @staticmethod
+    def public(batch: dict) -> dict:
+        return {key: value for key, value in batch.items() if key != "polls"}
+
+
+def multipart_fields(body: bytes, content_type: str) -> dict:
+    # name -> (filename, content) of a multipart/form-data body, enough for what the SDK uploads
+    boundary = content_type.split("boundary=", 1)[1].strip('"').encode("utf-8")
+    fields = {}
+    for part in body.split(b"--" + boundary):
+        head, separator, content = part.partition(b"\r\n\r\n")
+        if not separator:
+            continue
+        disposition = head.decode("utf-8", "replace")
+        name = disposition.split('name="', 1)[1].split('"', 1)[0] if 'name="' in disposition else None
+        filename = disposition.split('filename="', 1)[1].split('"', 1)[0] if 'filename="' in disposition else None
+        fields[name] = (filename, content[:-2] if content.endswith(b"\r\n") else content)
+    return fields
+
+
+def make_handler(latency: float, jitter: float, rate_429: float, stats: Stats, seed: Optional[int]):
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    store = BatchStore()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logger.debug("mock api: " + format, *args)
+
+        def _send(self, status: int, body: dict, headers: Optional[dict] = None):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _send_bytes(self, content: bytes):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def _not_found(self, path: str):
+            self._send(404, {"error": {"message": f"{path} is not mocked", "type": "invalid_request_error"}})
+
+        def do_GET(self):
+            path, _, query = self.path.partition("?")
+            stats.count(path, False)
+            time.sleep(latency)
+            parts = ["", ""] + path.rstrip("/").split("/")
+            if parts[-1] == "batches":
+                limit = 20
+                for pair in query.split("&"):
+                    key, _, value = pair.partition("=")
+                    if key == "limit" and value.isdigit():
+                        limit = int(value)
+                self._send(200, store.list(limit))
+            elif parts[-2] == "batches":
+                batch = store.retrieve(parts[-1])
+                if batch is None:
+                    self._not_found(path)
+                else:
+                    self._send(200, batch)
+            elif parts[-1] == "content" and parts[-3] == "files":
+                with store.lock:
+                    content = store.files.get(parts[-2])
+                if content is None:
+                    self._not_found(path)
+                else:
+                    self._send_bytes(content)
+            else:
+                self._not_found(path)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            with rng_lock:
+                throttled = rng.random() < rate_429
+                delay = max(0.0, rng.gauss(latency, jitter)) if jitter else latency
+            path = self.path.split("?")[0]
+            stats.count(path, throttled)
+            if throttled:
+                self._send(429, {"error": {"message": "Rate limit reached (benchmark)", "type": "rate_limit_error"}},
+                           {"retry-after-ms": "200"})
+                return
+            time.sleep(delay)
+            if path.endswith("/audio/transcriptions"):
+                with rng_lock:
+                    self._send(200, fake_transcript(len(body), rng))
+            elif path.endswith("/chat/completions"):
+                request = json.loads(body or b"{}")
+                prompt_chars = sum(len(message.get("content") or "") for message in request.get("messages", []))
+                self._send(200, fake_summary(request.get("model", "benchmark"), prompt_chars))
+            elif path.endswith("/files"):
+                fields = multipart_fields(body, self.headers.get("Content-Type", ""))
+                filename, content = fields.get("file", (None, b""))
+                purpose = fields.get("purpose", (None, b"batch"))[1].decode("utf-8")
+                self._send(200, store.add_file(content, filename or "upload.jsonl", purpose))
+            elif path.endswith("/batches"):
+                batch = store.create_batch(json.loads(body or b"{}"))
+                if batch is None:
+                    self._send(400, {"error": {"message": "unknown input_file_id", "type": "invalid_request_error"}})
+                else:
+                    self._send(200, batch)
+            else:
+                self._not_found(path)
+
+    return Handler
+
+
+def start_server(port: int = 0, latency: float = 0.2, jitter: float = 0.0, rate_429: float = 0.0,
+                 seed: Optional[int] = None):
+    # Returns (server, stats, base_url); the server runs on a daemon thread until server.shutdown().
+    stats = Stats()
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(latency, jitter, rate_429, stats, seed))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="treebloomer-mock-api", daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    logger.info("Mock API listening on %s (latency %.3fs, 429 rate %.2f)", base_url, latency, rate_429)
+    return server, stats, base_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the transcription, chat completion and batch endpoints.")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Standard deviation of the latency")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server, stats, _ = start_server(args.port, args.latency, args.jitter, args.rate_429, args.seed)
+    try:
+        while True:
+            time.sleep(60)
+            logger.info("Served %s", stats.snapshot())
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
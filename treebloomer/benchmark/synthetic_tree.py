@@ -0,0 +1,72 @@
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import List
+
+from treebloomer.processes.media import run_ffmpeg
+
+logger = logging.getLogger(__name__)
+
+# Synthetic leaves are rendered once per distinct clip and then hardlinked into the tree, so a
+# 10k-leaf tree costs a handful of ffmpeg runs. Distinct tones per clip keep their audio apart.
+video_size = "160x120"
+video_rate = 5
+
+# "speech-like": a pitch-wobbling voiced tone chopped into bursts by a slow gate, so the audio has
+# silences for chunked transcription to cut at, like pauses between sentences.
+speech_expression = ("0.4*sin(2*PI*({pitch}+40*sin(2*PI*3*t))*t)"
+                     "*gt(sin(2*PI*0.35*t)+0.3*sin(2*PI*1.7*t),-0.2)")
+
+
+def render_clip(output_file: Path, duration: float, kind: str = "speech", pitch: float = 180.0) -> Path:
+    if kind == "tone":
+        audio = f"sine=frequency={pitch}:duration={duration}:sample_rate=16000"
+    else:
+        audio = f"aevalsrc='{speech_expression.format(pitch=pitch)}':d={duration}:s=16000"
+    run_ffmpeg([
+        "-f", "lavfi", "-i", f"color=c=black:s={video_size}:r={video_rate}:d={duration}",
+        "-f", "lavfi", "-i", audio,
+        "-c:v", "libx264", "-preset", "ultrafast", "-tune", "stillimage",
+        "-c:a", "aac", "-b:a", "64k", "-shortest", str(output_file),
+    ])
+    return output_file
+
+
+def leaf_path(root: Path, index: int, depth: int, fanout: int) -> Path:
+    # leaf i goes into d<digit>/d<digit>/... from its base-`fanout` digits, `depth` levels deep
+    parts, value = [], index // fanout
+    for _ in range(depth):
+        parts.append(f"d{value % fanout:0{len(str(fanout - 1))}d}")
+        value //= fanout
+    return root.joinpath(*reversed(parts), f"clip_{index:06d}.mp4")
+
+
+def _place(source: Path, destination: Path) -> None:
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def generate_tree(root: Path, count: int, duration: float = 30.0, kind: str = "speech", unique_clips: int = 4,
+                  depth: int = 2, fanout: int = 10) -> List[Path]:
+    root.mkdir(parents=True, exist_ok=True)
+    clip_dir = root.parent / f".{root.name}_clips"
+    clip_dir.mkdir(exist_ok=True)
+    clips = []
+    for index in range(min(unique_clips, count)):
+        clip = clip_dir / f"{kind}_{duration:g}s_{index}.mp4"
+        if not clip.exists():
+            render_clip(clip, duration, kind, pitch=140.0 + 25.0 * index)
+        clips.append(clip)
+
+    video_files = []
+    for index in range(count):
+        video_file = leaf_path(root, index, depth, fanout)
+        video_file.parent.mkdir(parents=True, exist_ok=True)
+        if not video_file.exists():
+            _place(clips[index % len(clips)], video_file)
+        video_files.append(video_file)
+    logger.info("Generated %s synthetic leaves under %s from %s clips", count, root, len(clips))
+    return video_files
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from treebloomer.manifest import config_hashes, expected_entries, leaf_status, load_manifest, record_stage, save_manifest
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = '.treebloomer_dedup.json'
+SAMPLE_BYTES = 1024 * 1024
+FICLONE = 0x40049409  # linux/fs.h
+
+# Artifacts that only depend on the media content and can be shared between identical copies.
+# The HTML page is not among them: it carries the leaf's own title and video path and is re-rendered.
+shared_suffixes = ['.audio.mp3', '.compressed_audio.mp3', '.compressed_audio.m4a', '.trimmed_audio.mp3', '.time_map.json',
+                   '.transcript.json', '.transcript.columns', '.transcript.txt', '.summaries.json', '.wordcloud.png', '.terms.json']
+html_stage = 'generate_html_summary'
+
+def partial_hash(path: Path, size: int) -> str:
+    # size + first and last MiB: cheap enough to run on every leaf, confirmed with full_hash on a match
+    digest = hashlib.sha256(str(size).encode('ascii'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(SAMPLE_BYTES))
+        if size > 2 * SAMPLE_BYTES:
+            f.seek(-SAMPLE_BYTES, os.SEEK_END)
+            digest.update(f.read(SAMPLE_BYTES))
+    return digest.hexdigest()
+
+def full_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(8 * SAMPLE_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_index(root: Path) -> dict:
+    try:
+        with open(root / INDEX_NAME, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_index(root: Path, index: dict) -> None:
+    path = root / INDEX_NAME
+    incomplete_path = path.with_name(path.name + '.incomplete')
+    with open(incomplete_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    incomplete_path.replace(path)
+
+def _hashes(root: Path, video_file: Path, index: dict, full: bool) -> dict:
+    # hashes are cached per leaf and only recomputed when size or mtime change
+    stat = video_file.stat()
+    key = video_file.relative_to(root).as_posix()
+    entry = index.get(key)
+    if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'partial': partial_hash(video_file, stat.st_size)}
+        index[key] = entry
+    if full and 'full' not in entry:
+        entry['full'] = full_hash(video_file)
+    return entry
+
+def find_duplicates(root: Path, video_files: List[Path]) -> Tuple[List[Path], Dict[Path, Path]]:
+    # Returns the leaves that need processing and a duplicate -> representative map. The
+    # representative of a group is the leaf that has the most stages recorded in its manifest.
+    index = load_index(root)
+    by_partial: Dict[str, List[Path]] = {}
+    for video_file in video_files:
+        try:
+            by_partial.setdefault(_hashes(root, video_file, index, full=False)['partial'], []).append(video_file)
+        except OSError as e:
+            logger.warning("Could not hash %s: %s", video_file, e)
+            by_partial.setdefault(str(video_file), []).append(video_file)
+
+    unique: List[Path] = []
+    duplicates: Dict[Path, Path] = {}
+    for candidates in by_partial.values():
+        if len(candidates) == 1:
+            unique.extend(candidates)
+            continue
+        by_full: Dict[str, List[Path]] = {}
+        for video_file in candidates:
+            by_full.setdefault(_hashes(root, video_file, index, full=True)['full'], []).append(video_file)
+        for group in by_full.values():
+            group.sort(key=lambda video_file: (-len(load_manifest(video_file).get('stages', {})), str(video_file)))
+            unique.append(group[0])
+            for video_file in group[1:]:
+                duplicates[video_file] = group[0]
+    save_index(root, index)
+    if duplicates:
+        logger.info("%s of %s videos are copies of another leaf", len(duplicates), len(video_files))
+    return sorted(unique), duplicates
+
+def _link(source: Path, destination: Path) -> None:
+    # reflink (copy-on-write) where the filesystem supports it, else a plain copy. Never a hardlink:
+    # the stage writers rewrite artifacts in place, so a rerun on one leaf would change the other's.
+    destination.unlink(missing_ok=True)
+    try:
+        import fcntl
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return
+    except (ImportError, OSError):
+        destination.unlink(missing_ok=True)
+    shutil.copy2(source, destination)
+
+def link_duplicate(duplicate: Path, representative: Path, stages: list, configs: Dict[str, str]) -> bool:
+    source_folder = representative.parent / representative.stem
+    source_manifest = load_manifest(representative).get('stages', {})
+    linked_stages = [stage for stage in stages if stage.name != html_stage and stage.name in source_manifest]
+    if len(linked_stages) < len([stage for stage in stages if stage.name != html_stage]):
+        logger.warning("%s isn't fully processed; leaving %s for the next run", representative, duplicate)
+        return False
+
+    subfolder = duplicate.parent / duplicate.stem
+    subfolder.mkdir(exist_ok=True)
+    for suffix in shared_suffixes:
+        source = source_folder / f"{representative.stem}{suffix}"
+        if source.exists():
+            _link(source, subfolder / f"{duplicate.stem}{suffix}")
+
+    manifest = load_manifest(duplicate)
+    expected = expected_entries(duplicate, stages, configs)
+    for stage in linked_stages:
+        output_name = source_manifest[stage.name]['output'].replace(representative.stem, duplicate.stem, 1)
+        record_stage(manifest, stage.name, expected[stage.name], subfolder / output_name)
+
+    # the page is rendered for this leaf, so it gets its own title and ../<stem>.mp4 video path
+    html_stage_def = next(stage for stage in stages if stage.name == html_stage)
+    summary_file = subfolder / manifest['stages'][html_stage_def.input_stage]['output']
+    record_stage(manifest, html_stage, expected[html_stage], html_stage_def.func(summary_file, subfolder, force=True))
+    save_manifest(duplicate, manifest)
+    logger.info("Linked artifacts of %s into %s", representative, duplicate)
+    return True
+
+def link_duplicates(duplicates: Dict[Path, Path], stages: list) -> None:
+    configs = config_hashes(stages)
+    for duplicate, representative in duplicates.items():
+        if all(state == 'fresh' for state in leaf_status(duplicate, stages, configs).values()):
+            continue
+        try:
+            link_duplicate(duplicate, representative, stages, configs)
+        except Exception as e:
+            logger.error("Failed to link %s to %s: %s", duplicate, representative, e)
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from treebloomer.site_index import directory_tree, gone_directories
+
+logger = logging.getLogger(__name__)
+
+STATE_NAME = '.treebloomer_clouds.json'
+COUNTS_NAME = '.treebloomer_terms.json'
+CLOUD_NAME = 'folder.wordcloud.png'
+
+# Folder and root word clouds are rolled up from the per-leaf term counts generate_word_cloud saves
+# (<stem>.terms.json), never from the transcripts: every directory on the way to a leaf keeps its
+# merged counts in .treebloomer_terms.json, and a directory's counts are its own leaves' plus its
+# subfolders' merged counts. The state file keeps a digest per directory over its leaves' term file
+# stats and its subfolders' digests, so a changed leaf re-merges only its ancestors, each of which
+# reads its unchanged subfolders' saved counts instead of walking down to their leaves again.
+
+def load_state(root: Path) -> dict:
+    try:
+        with open(root / STATE_NAME, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_state(root: Path, state: dict) -> None:
+    path = root / STATE_NAME
+    incomplete_path = path.with_name(path.name + '.incomplete')
+    with open(incomplete_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    incomplete_path.replace(path)
+
+def _leaf_terms(video_file: Path) -> Path:
+    return video_file.parent / video_file.stem / f"{video_file.stem}.terms.json"
+
+def _stat(path: Path) -> Optional[list]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _read_counts(path: Path) -> Dict[str, int]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _backfill(video_file: Path) -> None:
+    # leaves whose cloud was drawn before term counts were saved: count their transcript once
+    from treebloomer.processes.transcript_store import load_text
+    from treebloomer.processes.word_cloud_generation import term_counts, write_term_counts
+    transcript_file = video_file.parent / video_file.stem / f"{video_file.stem}.transcript.json"
+    if transcript_file.exists():
+        write_term_counts(term_counts(load_text(transcript_file)), _leaf_terms(video_file))
+
+def merge_counts(into: Dict[str, int], counts: Dict[str, int]) -> None:
+    get = into.get
+    for term, count in counts.items():
+        into[term] = get(term, 0) + count
+
+def build_folder_clouds(root: Path, video_files: List[Path], force: bool = False) -> int:
+    from treebloomer.processes.word_cloud_generation import render_cloud, stage_config, write_term_counts
+
+    leaves: Dict[Path, List[Path]] = {}
+    stats: Dict[Path, list] = {}
+    for video_file in video_files:
+        leaf_stat = _stat(_leaf_terms(video_file))
+        if leaf_stat is None:
+            try:
+                _backfill(video_file)
+            except Exception as e:
+                logger.warning("Could not count the terms of %s: %s", video_file, e)
+            leaf_stat = _stat(_leaf_terms(video_file))
+            if leaf_stat is None:
+                continue
+        stats[video_file] = leaf_stat
+        leaves.setdefault(video_file.parent, []).append(video_file)
+
+    directories, children = directory_tree(root, leaves)
+    config_hash = hashlib.sha256(json.dumps(stage_config(), sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    previous = load_state(root)
+    state: Dict[str, str] = {}
+    # counts merged in this run, held until the parent takes them so they aren't read back from disk
+    merged: Dict[Path, Dict[str, int]] = {}
+    failed = set()
+    rendered = 0
+    for directory in sorted(directories, key=lambda directory: len(directory.parts), reverse=True):
+        key = directory.relative_to(root).as_posix()
+        directory_leaves = sorted(leaves.get(directory, []))
+        folders = sorted(children.get(directory, []))
+        digest = hashlib.sha256(json.dumps([
+            config_hash,
+            [[video_file.name, stats[video_file]] for video_file in directory_leaves],
+            [[folder.name, state.get(folder.relative_to(root).as_posix())] for folder in folders],
+        ]).encode('utf-8')).hexdigest()
+        if not force and previous.get(key) == digest \
+                and (directory / CLOUD_NAME).exists() and (directory / COUNTS_NAME).exists():
+            state[key] = digest
+            continue
+
+        try:
+            counts: Dict[str, int] = {}
+            for video_file in directory_leaves:
+                merge_counts(counts, _read_counts(_leaf_terms(video_file)))
+            for folder in folders:
+                if folder.relative_to(root).as_posix() in state:
+                    merge_counts(counts, merged.pop(folder) if folder in merged else _read_counts(folder / COUNTS_NAME))
+            write_term_counts(counts, directory / COUNTS_NAME)
+            if counts:
+                render_cloud(counts, directory / CLOUD_NAME)
+            rendered += 1
+        except Exception as e:
+            # left out of the state, so the parent skips it and the next run tries again
+            logger.error("Failed to build the word cloud of %s: %s", directory, e)
+            failed.add(key)
+            continue
+        merged[directory] = counts
+        state[key] = digest
+
+    # directories that no longer hold any leaf lose the cloud we generated for them
+    for key in gone_directories(root, previous, state, failed):
+        for name in (CLOUD_NAME, COUNTS_NAME):
+            (root / key / name).unlink(missing_ok=True)
+
+    save_state(root, state)
+    logger.info("Rendered %s of %s folder word clouds", rendered, len(directories))
+    return rendered
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from treebloomer import artifact_cache, telemetry
+from treebloomer.site_index import directory_tree, gone_directories
+
+logger = logging.getLogger(__name__)
+
+STATE_NAME = '.treebloomer_folder_summaries.json'
+SUMMARY_NAME = 'folder.summaries.json'
+STAGE_NAME = 'summarize_folder'
+
+# Every directory on the way to a summarized leaf gets folder.summaries.json, in the same schema as
+# a leaf's summaries.json, written from its children's summaries only - leaves' summaries.json and
+# subfolders' folder.summaries.json - never from transcripts. Like the folder clouds, the state file
+# keeps a digest per directory over its leaves' summary stats and its subfolders' digests, so a new
+# or re-summarized leaf dirties only its ancestors and a rerun costs one small request per ancestor.
+# A folder with more entries than fit in request_token_budget is summarized in groups first, and
+# the group summaries are then summarized like entries of the folder.
+request_token_budget = 30_000
+# the parts of a child summary passed up; page summaries are left out, the rest says enough
+entry_fields = ('sentence_summary', 'paragraph_summary', 'topics', 'keywords', 'pull_quotes')
+
+folder_system_prompt = """
+You are an expert summarizer and analyst. The attached JSON documents summarize the contents of one folder of a video archive: its videos, its subfolders, or parts of the folder that were summarized separately. Write summaries of the folder as a whole in the output schema, describing what the collection covers rather than any single video. Merge and de-duplicate topics and keywords, and keep pull quotes verbatim from the ones given.
+
+More details can be found in the output schema.
+"""
+
+def load_state(root: Path) -> dict:
+    try:
+        with open(root / STATE_NAME, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_state(root: Path, state: dict) -> None:
+    path = root / STATE_NAME
+    incomplete_path = path.with_name(path.name + '.incomplete')
+    with open(incomplete_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    incomplete_path.replace(path)
+
+def stage_config() -> dict:
+    from treebloomer.processes import summarization
+    return {'model': summarization.model, 'temperature': summarization.temperature,
+            'system_prompt': folder_system_prompt, 'output_json_schema': summarization.output_json_schema,
+            'entry_fields': entry_fields, 'request_token_budget': request_token_budget}
+
+def _leaf_summary(video_file: Path) -> Path:
+    return video_file.parent / video_file.stem / f"{video_file.stem}.summaries.json"
+
+def _stat(path: Path) -> Optional[list]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _entry(kind: str, name: str, summary: dict) -> str:
+    return json.dumps(dict({'type': kind, 'name': name}, **{field: summary.get(field) for field in entry_fields}),
+                      ensure_ascii=False)
+
+def summarize_entries(name: str, entries: List[str]) -> Tuple[str, str, int]:
+    # (content, model, request count)
+    from treebloomer.processes.summarization import complete, group_by_tokens
+    groups = group_by_tokens(entries, request_token_budget)
+    if len(groups) == 1:
+        content, response_model = complete(folder_system_prompt, f"Folder {name}:\n\n" + "\n\n".join(entries),
+                                           stage=STAGE_NAME)
+        return content, response_model, 1
+    logger.info("Summarizing folder %s in %s groups...", name, len(groups))
+    partials = [complete(folder_system_prompt, f"Folder {name}, part {index + 1} of {len(groups)}:\n\n"
+                         + "\n\n".join(group), stage=STAGE_NAME)[0] for index, group in enumerate(groups)]
+    content, response_model, requests = summarize_entries(
+        name, [_entry('part', f"part {index + 1}", json.loads(partial)) for index, partial in enumerate(partials)])
+    return content, response_model, requests + len(groups)
+
+def write_folder_summary(output_file: Path, content: str, response_model: str, details: dict) -> None:
+    from treebloomer.processes import summarization
+    summary_data = json.loads(content)
+    summary_data['llm_details'] = dict(details, system_prompt=folder_system_prompt,
+                                       output_json_schema=summarization.output_json_schema,
+                                       model=response_model, temperature=summarization.temperature)
+    incomplete_path = output_file.with_name(output_file.name + '.incomplete')
+    with open(incomplete_path, 'w', encoding='utf-8') as f:
+        json.dump(summary_data, f, indent=4)
+    incomplete_path.replace(output_file)
+    artifact_cache.put(output_file, summary_data)
+
+def build_folder_summaries(root: Path, video_files: List[Path], api_concurrency: int = 1, force: bool = False) -> int:
+    leaves: Dict[Path, List[Path]] = {}
+    stats: Dict[Path, list] = {}
+    for video_file in video_files:
+        leaf_stat = _stat(_leaf_summary(video_file))
+        if leaf_stat is not None:
+            stats[video_file] = leaf_stat
+            leaves.setdefault(video_file.parent, []).append(video_file)
+
+    directories, children = directory_tree(root, leaves)
+    config_hash = hashlib.sha256(json.dumps(stage_config(), sort_keys=True).encode('utf-8')).hexdigest()
+    previous = load_state(root)
+    state: Dict[str, str] = {}
+    failed = set()
+    written = 0
+
+    def summarize_directory(directory: Path, key: str) -> None:
+        entries = []
+        for folder in sorted(children.get(directory, [])):
+            if folder.relative_to(root).as_posix() in state:
+                entries.append(_entry('folder', folder.name, artifact_cache.load_json(folder / SUMMARY_NAME)))
+        for video_file in sorted(leaves.get(directory, [])):
+            entries.append(_entry('video', video_file.stem, artifact_cache.load_json(_leaf_summary(video_file))))
+        name = key if key != '.' else root.resolve().name
+        content, response_model, requests = summarize_entries(name, entries)
+        write_folder_summary(directory / SUMMARY_NAME, content, response_model,
+                             {'entries': len(entries), 'requests': requests})
+
+    # Deepest level first; the folders of one level don't depend on each other and run concurrently.
+    levels: Dict[int, List[Path]] = {}
+    for directory in directories:
+        levels.setdefault(len(directory.parts), []).append(directory)
+    with ThreadPoolExecutor(max_workers=max(api_concurrency, 1), thread_name_prefix='treebloomer-folder') as pool:
+        for depth in sorted(levels, reverse=True):
+            futures = {}
+            for directory in sorted(levels[depth]):
+                key = directory.relative_to(root).as_posix()
+                folders = sorted(children.get(directory, []))
+                digest = hashlib.sha256(json.dumps([
+                    config_hash,
+                    [[video_file.name, stats[video_file]] for video_file in sorted(leaves.get(directory, []))],
+                    [[folder.name, state.get(folder.relative_to(root).as_posix())] for folder in folders],
+                ]).encode('utf-8')).hexdigest()
+                if not force and previous.get(key) == digest and (directory / SUMMARY_NAME).exists():
+                    state[key] = digest
+                    continue
+                if not leaves.get(directory) and not any(folder.relative_to(root).as_posix() in state
+                                                         for folder in folders):
+                    continue
+                futures[telemetry.submit(pool, summarize_directory, directory, key)] = (directory, key, digest)
+            for future, (directory, key, digest) in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    # left out of the state, so the parent leaves it out and the next run tries again
+                    logger.error("Failed to summarize folder %s: %s", directory, e)
+                    failed.add(key)
+                    continue
+                state[key] = digest
+                written += 1
+
+    # directories that no longer hold any leaf lose the summary we wrote for them
+    for key in gone_directories(root, previous, state, failed):
+        (root / key / SUMMARY_NAME).unlink(missing_ok=True)
+
+    save_state(root, state)
+    logger.info("Summarized %s of %s folders", written, len(directories))
+    return written
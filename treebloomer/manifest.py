@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+# A leaf's manifest lives next to its artifacts as <stem>.manifest.json and records, per stage:
+#   inputs      - hash over the fingerprints of everything the stage consumed
+#   config      - hash of the stage's stage_config() (model, prompt, schema, bitrate, template, ...)
+#   fingerprint - hash of the two above; what downstream stages hash as their inputs
+#   output      - artifact file name, relative to the leaf subfolder
+# Because fingerprints chain, a changed config or source invalidates the stage and everything below it.
+
+def _hash(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def manifest_path(video_file: Path) -> Path:
+    return video_file.parent / video_file.stem / f"{video_file.stem}.manifest.json"
+
+def load_manifest(video_file: Path) -> dict:
+    path = manifest_path(video_file)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {'version': MANIFEST_VERSION, 'stages': {}}
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable manifest %s: %s", path, e)
+        return {'version': MANIFEST_VERSION, 'stages': {}}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {'version': MANIFEST_VERSION, 'stages': {}}
+    return manifest
+
+def save_manifest(video_file: Path, manifest: dict) -> None:
+    path = manifest_path(video_file)
+    incomplete_path = path.with_name(path.name + '.incomplete')
+    with open(incomplete_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+    incomplete_path.replace(path)
+
+def source_fingerprint(video_file: Path) -> str:
+    # size + mtime rather than content: hashing multi-GB videos on every run would cost more than it saves
+    stat = video_file.stat()
+    return _hash({'name': video_file.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+
+def config_hashes(stages: list) -> Dict[str, str]:
+    return {stage.name: _hash(stage.config() if stage.config else {}) for stage in stages}
+
+def expected_entries(video_file: Path, stages: list, configs: Optional[Dict[str, str]] = None) -> Dict[str, dict]:
+    configs = configs or config_hashes(stages)
+    fingerprints = {None: source_fingerprint(video_file)}
+    entries = {}
+    for stage in stages:
+        upstream = [stage.input_stage, *[name for name in stage.requires if name != stage.input_stage]]
+        inputs = _hash([fingerprints[name] for name in upstream])
+        fingerprints[stage.name] = _hash([inputs, configs[stage.name]])
+        entries[stage.name] = {'inputs': inputs, 'config': configs[stage.name], 'fingerprint': fingerprints[stage.name]}
+    return entries
+
+def stale_stages(manifest: dict, expected: Dict[str, dict], stages: list) -> List[str]:
+    # A stage is stale when its recorded fingerprint differs, or when anything it depends on is stale.
+    # Stages with no record yet (trees processed before the manifest existed) are not stale: the
+    # stage's own exists() check decides, and the result is adopted into the manifest.
+    recorded = manifest.get('stages', {})
+    stale: List[str] = []
+    for stage in stages:
+        entry = recorded.get(stage.name)
+        if (entry is not None and entry.get('fingerprint') != expected[stage.name]['fingerprint']) \
+                or any(name in stale for name in stage.requires):
+            stale.append(stage.name)
+    return stale
+
+def leaf_status(video_file: Path, stages: list, configs: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    # Answered from the manifest alone: 'fresh', 'stale' or 'missing' per stage.
+    manifest = load_manifest(video_file)
+    expected = expected_entries(video_file, stages, configs)
+    stale = stale_stages(manifest, expected, stages)
+    recorded = manifest.get('stages', {})
+    return {stage.name: 'stale' if stage.name in stale else 'fresh' if stage.name in recorded else 'missing'
+            for stage in stages}
+
+def record_stage(manifest: dict, stage_name: str, entry: dict, output_file: Path) -> None:
+    manifest.setdefault('stages', {})[stage_name] = dict(entry, output=output_file.name)
@@ -0,0 +1,126 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from treebloomer.processes.media import first_audio_stream, probe_media, stream_bit_rate
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = '.treebloomer_probe.json'
+INDEX_VERSION = 2
+probe_workers = 8
+
+# ffprobe results per leaf, keyed by path relative to the root and invalidated by size + mtime like
+# the dedup hashes. Only what planning and ordering need is kept: duration, the first audio stream
+# (codec, channels, sample rate, bit rate) and the video codec. Failures are never cached: they can
+# be transient (a file still being copied, an NFS hiccup, ffprobe killed under load), so an unreadable
+# leaf is skipped for this run only and probed again on the next.
+
+def load_index(root: Path) -> dict:
+    try:
+        with open(root / INDEX_NAME, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable probe cache under %s: %s", root, e)
+    return {'version': INDEX_VERSION, 'leaves': {}}
+
+def save_index(root: Path, index: dict) -> None:
+    path = root / INDEX_NAME
+    incomplete_path = path.with_name(path.name + '.incomplete')
+    try:
+        with open(incomplete_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        incomplete_path.replace(path)
+    except OSError as e:
+        logger.warning("Could not save probe cache %s: %s", path, e)
+
+def summarize_probe(probe: dict) -> dict:
+    audio = first_audio_stream(probe)
+    video = next((stream for stream in probe.get('streams', []) if stream.get('codec_type') == 'video'), None)
+    duration = probe.get('format', {}).get('duration') or (audio or {}).get('duration')
+    return {
+        'duration': float(duration) if duration else None,
+        'audio': None if audio is None else {
+            'codec': audio.get('codec_name'),
+            'channels': audio.get('channels'),
+            'sample_rate': int(audio['sample_rate']) if audio.get('sample_rate') else None,
+            'bit_rate': stream_bit_rate(audio, probe),
+        },
+        'video_codec': (video or {}).get('codec_name'),
+    }
+
+def _probe(video_file: Path) -> dict:
+    try:
+        return summarize_probe(probe_media(video_file))
+    except RuntimeError as e:
+        # ffprobe ran but couldn't read the file: truncated upload, not actually a video, ...
+        return {'error': str(e)}
+
+def probe_tree(root: Path, video_files: List[Path], workers: int = probe_workers) -> Optional[Dict[Path, dict]]:
+    # Probe results for every leaf, from the cache where size and mtime still match. ffprobe runs in
+    # threads since each probe is a subprocess. Returns None when ffprobe isn't installed at all.
+    index = load_index(root)
+    cached = index['leaves']
+    results: Dict[Path, dict] = {}
+    missing: List[Tuple[Path, str, int, int]] = []
+    for video_file in video_files:
+        try:
+            stat = video_file.stat()
+        except OSError as e:
+            results[video_file] = {'error': str(e)}
+            continue
+        key = video_file.relative_to(root).as_posix()
+        entry = cached.get(key)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            results[video_file] = entry
+        else:
+            missing.append((video_file, key, stat.st_size, stat.st_mtime_ns))
+
+    if missing:
+        logger.info("Probing %s of %s videos...", len(missing), len(video_files))
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='treebloomer-probe') as pool:
+                probes = list(pool.map(_probe, [video_file for video_file, *_ in missing]))
+        except FileNotFoundError as e:
+            logger.warning("ffprobe is not available, skipping the probe phase: %s", e)
+            return None
+        for (video_file, key, size, mtime_ns), probe in zip(missing, probes):
+            entry = dict(probe, size=size, mtime_ns=mtime_ns)
+            if 'error' in probe:
+                cached.pop(key, None)
+            else:
+                cached[key] = entry
+            results[video_file] = entry
+        save_index(root, index)
+    return results
+
+def unusable_reason(probe: dict) -> Optional[str]:
+    # Why a leaf can't get through the pipeline, or None if it can.
+    if 'error' in probe:
+        return f"unreadable ({probe['error'].splitlines()[0] if probe['error'] else 'ffprobe failed'})"
+    if probe.get('audio') is None:
+        return "no audio stream"
+    if not probe.get('duration'):
+        return "zero or unknown duration"
+    return None
+
+def split_usable(video_files: List[Path], probes: Dict[Path, dict]) -> Tuple[List[Path], Dict[Path, str]]:
+    usable, skipped = [], {}
+    for video_file in video_files:
+        reason = unusable_reason(probes.get(video_file, {'error': ''}))
+        if reason is None:
+            usable.append(video_file)
+        else:
+            skipped[video_file] = reason
+    return usable, skipped
+
+def longest_first(video_files: List[Path], probes: Dict[Path, dict]) -> List[Path]:
+    # Longest processing time first: the long leaves start while the pools are still full of short
+    # ones, instead of a 4-hour file starting last and running alone at the end of the run.
+    return sorted(video_files, key=lambda video_file: -(probes.get(video_file, {}).get('duration') or 0.0))
@@ -0,0 +1,103 @@
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from treebloomer.manifest import config_hashes, leaf_status
+
+logger = logging.getLogger(__name__)
+
+# Rough cost and time model for --plan. Prices are USD list prices for the models the stages use;
+# speech runs at about 150 words (~200 tokens) a minute. Stage times are fixed seconds plus seconds
+# per second of audio, measured on a few machines; check them against a --trace of a real run.
+transcription_price_per_minute = 0.006
+prompt_price_per_million = 2.50
+completion_price_per_million = 10.00
+transcript_tokens_per_minute = 200
+summary_completion_tokens = 1500
+stage_seconds = {
+    # stage: (fixed seconds, seconds per second of audio)
+    'extract_audio': (1.0, 0.01),
+    'compress_audio': (1.0, 0.01),
+    'trim_silence': (0.5, 0.005),
+    'extract_transcript': (5.0, 0.05),
+    'summarize_transcript': (15.0, 0.005),
+    'generate_word_cloud': (3.0, 0.0),
+    'generate_html_summary': (0.5, 0.0),
+}
+
+def _prompt_overhead_tokens() -> int:
+    from treebloomer.api_client import estimate_tokens
+    from treebloomer.processes.summarization import output_json_schema, system_prompt
+    return estimate_tokens(system_prompt + json.dumps(output_json_schema))
+
+def leaf_estimate(duration: float, pending: List[str], backend: str = "api", overhead_tokens: int = 0) -> dict:
+    minutes = duration / 60
+    estimate = {'api_minutes': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0,
+                'cpu_s': 0.0, 'api_s': 0.0}
+    if 'extract_transcript' in pending and backend == "api":
+        estimate['api_minutes'] = minutes
+        estimate['cost'] += minutes * transcription_price_per_minute
+    if 'summarize_transcript' in pending:
+        estimate['prompt_tokens'] = int(minutes * transcript_tokens_per_minute) + overhead_tokens
+        estimate['completion_tokens'] = summary_completion_tokens
+        estimate['cost'] += (estimate['prompt_tokens'] * prompt_price_per_million
+                             + estimate['completion_tokens'] * completion_price_per_million) / 1_000_000
+    for name in pending:
+        fixed, per_second = stage_seconds.get(name, (0.0, 0.0))
+        pool = 'api_s' if name in ('extract_transcript', 'summarize_transcript') and backend == "api" else 'cpu_s'
+        estimate[pool] += fixed + per_second * duration
+    return estimate
+
+def build_plan(video_files: List[Path], probes: Dict[Path, dict], stages: list, skipped: Dict[Path, str],
+               jobs: int = 1, api_concurrency: int = 1, backend: str = "api",
+               tokens_per_minute: Optional[float] = None) -> dict:
+    configs = config_hashes(stages)
+    overhead_tokens = _prompt_overhead_tokens() if any(stage.name == 'summarize_transcript' for stage in stages) else 0
+    totals = {'leaves': 0, 'audio_minutes': 0.0, 'api_minutes': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0,
+              'cost': 0.0, 'cpu_s': 0.0, 'api_s': 0.0}
+    longest_leaf_s = 0.0
+    leaves = []
+    for video_file in video_files:
+        status = leaf_status(video_file, stages, configs)
+        pending = [name for name, state in status.items() if state != 'fresh']
+        if not pending:
+            continue
+        duration = probes.get(video_file, {}).get('duration') or 0.0
+        estimate = leaf_estimate(duration, pending, backend, overhead_tokens)
+        leaves.append((video_file, duration, pending, estimate))
+        totals['leaves'] += 1
+        totals['audio_minutes'] += duration / 60
+        for key in ('api_minutes', 'prompt_tokens', 'completion_tokens', 'cost', 'cpu_s', 'api_s'):
+            totals[key] += estimate[key]
+        longest_leaf_s = max(longest_leaf_s, estimate['cpu_s'] + estimate['api_s'])
+
+    # The two pools overlap, so the run takes about as long as the busier pool, or the longest single
+    # leaf (its stages run one after another), or what the token budget allows - whichever is longest.
+    bounds = {'cpu pool': totals['cpu_s'] / max(jobs, 1), 'api pool': totals['api_s'] / max(api_concurrency, 1),
+              'longest leaf': longest_leaf_s}
+    if tokens_per_minute:
+        bounds['--tpm budget'] = (totals['prompt_tokens'] + totals['completion_tokens']) / tokens_per_minute * 60
+    bottleneck = max(bounds, key=bounds.get)
+    return {'totals': totals, 'wall_s': bounds[bottleneck], 'bottleneck': bottleneck, 'leaves': leaves,
+            'skipped': skipped}
+
+def _duration(seconds: float) -> str:
+    hours, remainder = divmod(int(seconds), 3600)
+    return f"{hours}h{remainder // 60:02d}m" if hours else f"{remainder // 60}m{remainder % 60:02d}s"
+
+def print_plan(plan: dict, trim_silence: bool = False, top: int = 10) -> None:
+    totals = plan['totals']
+    for video_file, reason in sorted(plan['skipped'].items()):
+        print(f"skip {video_file}: {reason}")
+    if plan['leaves']:
+        print(f"Longest of {len(plan['leaves'])} pending leaves (started first):")
+        for video_file, duration, pending, estimate in sorted(plan['leaves'], key=lambda leaf: -leaf[1])[:top]:
+            print(f"  {_duration(duration):>8}  ${estimate['cost']:8.3f}  {video_file}: {', '.join(pending)}")
+    print(f"Leaves to process:   {totals['leaves']} ({len(plan['skipped'])} skipped)")
+    print(f"Audio:               {totals['audio_minutes']:.1f} min")
+    print(f"Transcription:       {totals['api_minutes']:.1f} API min"
+          + (" (before silence trimming)" if trim_silence else ""))
+    print(f"Summary tokens:      {totals['prompt_tokens']:,} prompt + {totals['completion_tokens']:,} completion")
+    print(f"Estimated cost:      ${totals['cost']:.2f}")
+    print(f"Estimated wall time: {_duration(plan['wall_s'])} (bound by the {plan['bottleneck']})")
@@ -0,0 +1,66 @@
+import importlib
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+# Stage registry. Stages are declared by 'module:function' reference and only imported the first
+# time a leaf actually runs them (or the manifest asks for their stage_config), so `--help`, dry
+# runs, status queries and pool workers that only ever run one stage don't import matplotlib,
+# torch, openai and friends. New processes start from process_templates/ and are registered here.
+
+def resolve(target: str) -> Callable:
+    module_name, _, attribute = target.partition(':')
+    return getattr(importlib.import_module(module_name, __name__), attribute)
+
+
+class Stage(NamedTuple):
+    name: str
+    target: str                 # 'module:function', relative to this package
+    pool: str                   # 'cpu' stages run in processes, 'api' stages in threads
+    input_stage: Optional[str]  # whose output is handed in; None means the video file itself
+    requires: Tuple[str, ...]
+    config_target: Optional[str] = None  # feeds the manifest fingerprint
+
+    @property
+    def func(self) -> Callable:
+        return resolve(self.target)
+
+    @property
+    def config(self) -> Optional[Callable[[], dict]]:
+        return resolve(self.config_target) if self.config_target else None
+
+
+# Listed in dependency order, so walking the list front to back is a valid sequential run.
+STAGES: List[Stage] = [
+    Stage('extract_audio', '.audio_extraction:extract_audio', 'cpu', None, (),
+          '.audio_extraction:stage_config'),
+    Stage('compress_audio', '.audio_compression:compress_audio', 'cpu', 'extract_audio', ('extract_audio',),
+          '.audio_compression:stage_config'),
+    Stage('extract_transcript', '.transcript_extraction:extract_transcript', 'api', 'compress_audio',
+          ('compress_audio',), '.transcript_extraction:stage_config'),
+    Stage('summarize_transcript', '.summarization:summarize_transcript', 'api', 'extract_transcript',
+          ('extract_transcript',), '.summarization:stage_config'),
+    Stage('generate_word_cloud', '.word_cloud_generation:generate_word_cloud', 'cpu', 'extract_transcript',
+          ('extract_transcript',), '.word_cloud_generation:stage_config'),
+    Stage('generate_html_summary', '.html_page_generation:generate_html_summary', 'cpu', 'summarize_transcript',
+          ('summarize_transcript', 'generate_word_cloud'), '.html_page_generation:stage_config'),
+]
+
+# Fused audio: one ffmpeg pass from the video to the transcription audio, no separate extract_audio stage.
+FUSED_AUDIO_STAGES: List[Stage] = [
+    Stage('compress_audio', '.audio_compression:compress_audio_from_video', 'cpu', None, (),
+          '.audio_compression:fused_stage_config'),
+    *STAGES[2:],
+]
+
+# Optional silence trimming between compress_audio and extract_transcript, which then transcribes
+# the trimmed audio and maps segment times back onto the original timeline.
+TRIM_SILENCE_STAGE = Stage('trim_silence', '.voice_activity:trim_silence', 'cpu', 'compress_audio',
+                           ('compress_audio',), '.voice_activity:stage_config')
+
+def with_silence_trimming(stages: List[Stage]) -> List[Stage]:
+    trimmed = []
+    for stage in stages:
+        if stage.name == 'extract_transcript':
+            trimmed.append(TRIM_SILENCE_STAGE)
+            stage = stage._replace(input_stage='trim_silence', requires=('trim_silence',))
+        trimmed.append(stage)
+    return trimmed
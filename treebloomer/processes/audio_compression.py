@@ -1,28 +1,102 @@
 import logging
 from pathlib import Path
-from pydub import AudioSegment
+
+from treebloomer.processes.media import first_audio_stream, probe_media, run_ffmpeg, stream_bit_rate
 
 logger = logging.getLogger(__name__)
 
-def compress_audio(audio_file: Path, subfolder: Path) -> Path:
-    logger.info(f"Compressing audio file {audio_file.stem}...")
+bitrate = "32k"
+
+# Source audio already in one of these codecs at or under copy_bitrate_limit is remuxed as-is
+# by the fused path instead of being re-encoded. Values are the container extension to use.
+copyable_codecs = {"mp3": "mp3", "aac": "m4a"}
+copy_bitrate_limit = 40_000
+
+def stage_config() -> dict:
+    return {'bitrate': bitrate, 'format': 'mp3'}
+
+def fused_stage_config() -> dict:
+    return {'bitrate': bitrate, 'copyable_codecs': copyable_codecs, 'copy_bitrate_limit': copy_bitrate_limit}
+
+def compress_audio(audio_file: Path, subfolder: Path, force: bool = False) -> Path:
+    logger.info("Compressing audio file %s...", audio_file.stem)
     
     original_stem = audio_file.stem.rsplit('.', 1)[0]  # Remove '.audio' from the stem
     compressed_audio_file = subfolder / f"{original_stem}.compressed_audio.mp3"
     incomplete_path = subfolder / f"{original_stem}.compressed_audio.mp3.incomplete"
     
-    if compressed_audio_file.exists():
-        logger.info(f"Compressed audio file {compressed_audio_file} already exists. Skipping compression.")
+    if compressed_audio_file.exists() and not force:
+        logger.info("Compressed audio file %s already exists. Skipping compression.", compressed_audio_file)
         return compressed_audio_file
     
     try:
+        from pydub import AudioSegment
         audio = AudioSegment.from_file(audio_file)
-        audio.export(incomplete_path, format="mp3", bitrate="32k")
+        audio.export(incomplete_path, format="mp3", bitrate=bitrate)
         incomplete_path.rename(compressed_audio_file)
-        logger.info(f"Compressed audio file {audio_file.stem} to {compressed_audio_file}.")
+        logger.info("Compressed audio file %s to %s.", audio_file.stem, compressed_audio_file)
         return compressed_audio_file
     except Exception as e:
-        logger.error(f"Failed to compress audio file {audio_file}: {e}")
+        logger.error("Failed to compress audio file %s: %s", audio_file, e)
         if incomplete_path.exists():
             incomplete_path.unlink()
         raise
+
+def compress_audio_from_video(video_file: Path, subfolder: Path, keep_audio: bool = False, force: bool = False) -> Path:
+    # Fused path: a single streaming ffmpeg process goes straight from the video to the
+    # transcription audio, so nothing is decoded into memory and no intermediate .audio.mp3
+    # is written unless keep_audio is set (in which case the same decode feeds both outputs).
+    logger.info("Compressing audio straight from %s...", video_file.stem)
+
+    original_stem = video_file.stem
+    existing = [subfolder / f"{original_stem}.compressed_audio.{extension}" for extension in {"mp3", *copyable_codecs.values()}]
+    for compressed_audio_file in existing:
+        if compressed_audio_file.exists() and not force:
+            logger.info("Compressed audio file %s already exists. Skipping compression.", compressed_audio_file)
+            return compressed_audio_file
+
+    probe = probe_media(video_file)
+    stream = first_audio_stream(probe)
+    if stream is None:
+        raise ValueError(f"{video_file} has no audio stream")
+
+    source_bit_rate = stream_bit_rate(stream, probe)
+    extension = copyable_codecs.get(stream.get("codec_name"))
+    stream_copy = extension is not None and source_bit_rate is not None and source_bit_rate <= copy_bitrate_limit
+    if not stream_copy:
+        extension = "mp3"
+
+    compressed_audio_file = subfolder / f"{original_stem}.compressed_audio.{extension}"
+    incomplete_path = subfolder / f"{original_stem}.compressed_audio.{extension}.incomplete"
+    audio_output_path = subfolder / f"{original_stem}.audio.mp3"
+    audio_incomplete_path = subfolder / f"{original_stem}.audio.mp3.incomplete"
+    muxer = "mp3" if extension == "mp3" else "ipod"
+
+    args = ["-i", str(video_file), "-map", "0:a:0", "-vn"]
+    if stream_copy:
+        logger.info("Source audio is %s at %s b/s, remuxing without re-encoding.", stream.get('codec_name'), source_bit_rate)
+        args += ["-c:a", "copy"]
+    else:
+        args += ["-c:a", "libmp3lame", "-b:a", bitrate]
+    args += ["-f", muxer, str(incomplete_path)]
+    keep_audio = keep_audio and (force or not audio_output_path.exists())
+    if keep_audio:
+        args += ["-map", "0:a:0", "-vn", "-c:a", "libmp3lame", "-q:a", "2", "-f", "mp3", str(audio_incomplete_path)]
+
+    try:
+        run_ffmpeg(args)
+        incomplete_path.rename(compressed_audio_file)
+        for stale_file in existing:
+            # a forced rerun may switch between stream copy and re-encode
+            if stale_file != compressed_audio_file and stale_file.exists():
+                stale_file.unlink()
+        if keep_audio:
+            audio_incomplete_path.rename(audio_output_path)
+        logger.info("Compressed audio from %s to %s.", video_file.stem, compressed_audio_file)
+        return compressed_audio_file
+    except Exception as e:
+        logger.error("Failed to compress audio from %s: %s", video_file, e)
+        for path in [incomplete_path, audio_incomplete_path]:
+            if path.exists():
+                path.unlink()
+        raise
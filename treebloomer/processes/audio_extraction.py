@@ -1,27 +1,30 @@
 import logging
 from pathlib import Path
-from audio_extract import extract_audio as extract_audio_core
 logger = logging.getLogger(__name__)
 
-def extract_audio(video_file: Path, subfolder: Path) -> Path:
-    logger.info(f"Extracting audio from {video_file.stem}...")
+def stage_config() -> dict:
+    return {'format': 'mp3'}
+
+def extract_audio(video_file: Path, subfolder: Path, force: bool = False) -> Path:
+    logger.info("Extracting audio from %s...", video_file.stem)
     
     audio_output_path = subfolder / f"{video_file.stem}.audio.mp3"
     incomplete_path = subfolder / f"{video_file.stem}.audio.mp3.incomplete"
     
-    if audio_output_path.exists():
-        logger.info(f"Audio file {audio_output_path} already exists. Skipping extraction.")
+    if audio_output_path.exists() and not force:
+        logger.info("Audio file %s already exists. Skipping extraction.", audio_output_path)
         return audio_output_path
     
     try:
+        from audio_extract import extract_audio as extract_audio_core
         extract_audio_core(input_path=str(video_file), output_path=str(incomplete_path), overwrite=True)
         # The actual output file will have .mp3 appended, so we need to account for that
         actual_incomplete_path = incomplete_path.with_suffix('.incomplete.mp3')
         actual_incomplete_path.rename(audio_output_path)
-        logger.info(f"Extracted audio from {video_file.stem} to {audio_output_path}.")
+        logger.info("Extracted audio from %s to %s.", video_file.stem, audio_output_path)
         return audio_output_path
     except Exception as e:
-        logging.error(f"Failed to extract audio from {video_file}: {e}")
+        logging.error("Failed to extract audio from %s: %s", video_file, e)
         actual_incomplete_path = incomplete_path.with_suffix('.incomplete.mp3')
         if actual_incomplete_path.exists():
             actual_incomplete_path.unlink()
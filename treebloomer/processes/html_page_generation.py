@@ -1,49 +1,16 @@
+import hashlib
 import json
 import os
+from functools import lru_cache
 from pathlib import Path
-from jinja2 import Template
-import markdown2
 import logging
 
+from treebloomer import artifact_cache
+
 logger = logging.getLogger(__name__)
 
-def generate_html_summary(input_file: Path, subfolder: Path) -> Path:
-    logger.info(f"Generating HTML summary for {input_file.stem}...")
-    
-    original_stem = input_file.stem.rsplit('.', 1)[0]
-    output_file = subfolder / f"{original_stem}.html"
-    
-    if output_file.exists():
-        logger.info(f"HTML summary file {output_file} already exists. Skipping generation.")
-        return output_file
-    
-    try:
-        # Read the JSON file
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        # Convert markdown to HTML
-        markdowner = markdown2.Markdown()
-        page_summary_html = markdowner.convert(data['page_summary'])
-        
-        # Prepare the data for the template
-        context = {
-            'title': original_stem,
-            'sentence_summary': data['sentence_summary'],
-            'topics': data['topics'],
-            'keywords': data['keywords'],
-            'paragraph_summary': data['paragraph_summary'],
-            'page_summary': page_summary_html,
-            'pull_quotes': data['pull_quotes'],
-            'video_filename': f"../{original_stem}.mp4", 
-            'model': data['llm_details']['model'],
-            'temperature': data['llm_details']['temperature'],
-            'system_prompt': data['llm_details']['system_prompt'],
-            'output_schema': json.dumps(data['llm_details']['output_json_schema'], indent=2),
-        }
-        
-        # HTML template
-        template = Template('''
+# HTML template
+html_template = '''
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -179,10 +146,130 @@ def generate_html_summary(input_file: Path, subfolder: Path) -> Path:
             var details = document.getElementById('promptDetails');
             details.classList.toggle('show');
         });
+
+        // deep links from search results: <page>.html#t=<seconds> starts the video there
+        var seek = window.location.hash.match(/^#t=([0-9.]+)$/);
+        if (seek) {
+            var video = document.querySelector('video');
+            var seekTo = function() { video.currentTime = parseFloat(seek[1]); };
+            if (video.readyState >= 1) { seekTo(); } else { video.addEventListener('loadedmetadata', seekTo, { once: true }); }
+        }
     </script>
 </body>
 </html>
-        ''')
+        '''
+
+# Tree-level index template: one page per directory, linking its subfolders' indexes and its leaves' pages
+index_template = '''
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{{ title | e }}</title>
+    <style>
+        body { 
+            font-family: Arial, sans-serif; 
+            line-height: 1.6; 
+            color: #FFFFFF; 
+            background-color: #000000; 
+            max-width: 1200px; 
+            margin: 0 auto; 
+            padding: 20px; 
+        }
+        h1 { color: #FF00FF; /* Magenta */ }
+        h2 { color: #00FFFF; /* Cyan */ }
+        a { color: #00FFFF; /* Cyan */ }
+        .leaf { background-color: #1A1A1A; padding: 10px 15px; margin: 10px 0; border-radius: 5px; }
+        .topics span { 
+            display: inline-block; 
+            margin-right: 10px; 
+            background-color: #DE3163; /* Cerise */ 
+            color: white; 
+            padding: 2px 8px; 
+            border-radius: 3px; 
+        }
+    </style>
+</head>
+<body>
+    {% if parent %}<p><a href="../index.html">&larr; up</a></p>{% endif %}
+    <h1>{{ title | e }}</h1>
+    {% if folders %}
+    <h2>Folders</h2>
+    <ul>
+        {% for folder in folders %}
+        <li><a href="{{ folder.name | urlencode }}/index.html">{{ folder.name | e }}</a> <small>({{ folder.count }} videos)</small></li>
+        {% endfor %}
+    </ul>
+    {% endif %}
+    {% if leaves %}
+    <h2>Videos</h2>
+    {% for leaf in leaves %}
+    <div class="leaf">
+        <a href="{{ leaf.href | urlencode }}"><strong>{{ leaf.title | e }}</strong></a>
+        <p>{{ leaf.sentence_summary | e }}</p>
+        <p class="topics"><small>
+        {% for topic in leaf.topics %}
+        <span>{{ topic | e }}</span>
+        {% endfor %}
+        </small></p>
+    </div>
+    {% endfor %}
+    {% endif %}
+</body>
+</html>
+        '''
+
+@lru_cache(maxsize=None)
+def template_environment():
+    # One environment per process: templates are compiled once and reused for every page, and the
+    # compiled bytecode is cached on disk (keyed by template source) for the next run's workers.
+    from jinja2 import DictLoader, Environment, FileSystemBytecodeCache
+    return Environment(loader=DictLoader({'page.html': html_template, 'index.html': index_template}),
+                       bytecode_cache=FileSystemBytecodeCache(), auto_reload=False)
+
+@lru_cache(maxsize=None)
+def markdown_converter():
+    import markdown2
+    return markdown2.Markdown()
+
+def stage_config() -> dict:
+    return {'template_sha256': hashlib.sha256(html_template.encode('utf-8')).hexdigest()}
+
+def generate_html_summary(input_file: Path, subfolder: Path, force: bool = False) -> Path:
+    logger.info("Generating HTML summary for %s...", input_file.stem)
+    
+    original_stem = input_file.stem.rsplit('.', 1)[0]
+    output_file = subfolder / f"{original_stem}.html"
+    
+    if output_file.exists() and not force:
+        logger.info("HTML summary file %s already exists. Skipping generation.", output_file)
+        return output_file
+    
+    try:
+        # Read the JSON file (or take the summary just written in this process)
+        data = artifact_cache.load_json(input_file)
+        
+        # Convert markdown to HTML
+        page_summary_html = markdown_converter().convert(data['page_summary'])
+        
+        # Prepare the data for the template
+        context = {
+            'title': original_stem,
+            'sentence_summary': data['sentence_summary'],
+            'topics': data['topics'],
+            'keywords': data['keywords'],
+            'paragraph_summary': data['paragraph_summary'],
+            'page_summary': page_summary_html,
+            'pull_quotes': data['pull_quotes'],
+            'video_filename': f"../{original_stem}.mp4", 
+            'model': data['llm_details']['model'],
+            'temperature': data['llm_details']['temperature'],
+            'system_prompt': data['llm_details']['system_prompt'],
+            'output_schema': json.dumps(data['llm_details']['output_json_schema'], indent=2),
+        }
+        
+        template = template_environment().get_template('page.html')
         
         # Render the template
         html_content = template.render(context)
@@ -191,10 +278,10 @@ def generate_html_summary(input_file: Path, subfolder: Path) -> Path:
         with open(output_file, 'w', encoding='utf-8') as f:
             f.write(html_content)
         
-        logger.info(f"Generated HTML summary at {output_file}.")
+        logger.info("Generated HTML summary at %s.", output_file)
         return output_file
     except Exception as e:
-        logging.error(f"Failed to generate HTML summary for {input_file}: {e}")
+        logging.error("Failed to generate HTML summary for %s: %s", input_file, e)
         if output_file.exists():
             output_file.unlink()
         raise
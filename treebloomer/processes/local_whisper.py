@@ -0,0 +1,127 @@
+import atexit
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+WINDOW_SECONDS = 30
+SECONDS_PER_TIMESTAMP = 0.02
+# same thresholds whisper.transcribe uses to drop silent windows
+no_speech_threshold = 0.6
+logprob_threshold = -1.0
+
+# One model per worker process, loaded by the pool initializer and reused for every file that
+# worker is handed.
+_model = None
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_key: Optional[tuple] = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker(model_size: str, threads: int):
+    global _model
+    import torch
+    import whisper
+    torch.set_num_threads(threads)
+    logger.info("Loading whisper model %s with %s threads...", model_size, threads)
+    _model = whisper.load_model(model_size, device="cpu")
+
+
+def get_pool(model_size: str, workers: int, threads: int) -> ProcessPoolExecutor:
+    global _pool, _pool_key
+    with _pool_lock:
+        if _pool is None or _pool_key != (model_size, workers, threads):
+            if _pool is not None:
+                _pool.shutdown(wait=True)
+            _pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model_size, threads))
+            _pool_key = (model_size, workers, threads)
+        return _pool
+
+
+@atexit.register
+def _shutdown_pool():
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _window_segments(tokens: list, tokenizer, offset: float, window_length: float) -> list:
+    # Split one decoded window into (start, end, text tokens) on its timestamp tokens.
+    segments, start, text_tokens = [], None, []
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            time = (token - tokenizer.timestamp_begin) * SECONDS_PER_TIMESTAMP
+            if start is not None and text_tokens:
+                segments.append((offset + start, offset + time, text_tokens))
+                start, text_tokens = None, []
+            else:
+                start = time
+        elif token < tokenizer.eot:
+            text_tokens.append(token)
+    if text_tokens:
+        segments.append((offset + (start or 0.0), offset + window_length, text_tokens))
+    return segments
+
+
+def transcribe_in_worker(audio_file: str, batch_size: int, language: Optional[str]) -> dict:
+    # Runs inside a pool worker: decode the audio once, cut it into 30 s windows and decode them
+    # batch_size at a time through the already-loaded model.
+    import torch
+    import whisper
+    from whisper.tokenizer import get_tokenizer
+
+    audio = whisper.load_audio(audio_file)
+    duration = len(audio) / SAMPLE_RATE
+    window_samples = WINDOW_SECONDS * SAMPLE_RATE
+    offsets = list(range(0, len(audio), window_samples))
+    options = whisper.DecodingOptions(task="transcribe", language=language, fp16=False, without_timestamps=False)
+
+    segments = []
+    detected_language = language
+    for batch_start in range(0, len(offsets), batch_size):
+        batch_offsets = offsets[batch_start:batch_start + batch_size]
+        mels = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(audio[offset:offset + window_samples]),
+                                        n_mels=_model.dims.n_mels)
+            for offset in batch_offsets
+        ])
+        with torch.no_grad():
+            results = whisper.decode(_model, mels, options)
+        for offset, result in zip(batch_offsets, results):
+            if result.no_speech_prob > no_speech_threshold and result.avg_logprob < logprob_threshold:
+                continue
+            detected_language = detected_language or result.language
+            tokenizer = get_tokenizer(_model.is_multilingual, num_languages=_model.num_languages,
+                                      language=result.language, task="transcribe")
+            window_length = min(WINDOW_SECONDS, (len(audio) - offset) / SAMPLE_RATE)
+            for start, end, text_tokens in _window_segments(result.tokens, tokenizer, offset / SAMPLE_RATE, window_length):
+                segments.append({
+                    "id": len(segments),
+                    "seek": offset // (SAMPLE_RATE // 100),
+                    "start": round(start, 2),
+                    "end": round(min(end, duration), 2),
+                    "text": tokenizer.decode(text_tokens),
+                    "tokens": text_tokens,
+                    "temperature": result.temperature,
+                    "avg_logprob": result.avg_logprob,
+                    "compression_ratio": result.compression_ratio,
+                    "no_speech_prob": result.no_speech_prob,
+                })
+
+    return {
+        "task": "transcribe",
+        "language": whisper.tokenizer.LANGUAGES.get(detected_language, detected_language),
+        "duration": duration,
+        "text": "".join(segment["text"] for segment in segments).strip(),
+        "segments": segments,
+    }
+
+
+def transcribe_local(audio_file: Path, model_size: str = "base", workers: int = 1, threads: int = 4,
+                     batch_size: int = 8, language: Optional[str] = None) -> dict:
+    logger.info("Transcribing %s locally with whisper %s...", audio_file.stem, model_size)
+    pool = get_pool(model_size, workers, threads)
+    return pool.submit(transcribe_in_worker, str(audio_file), batch_size, language).result()
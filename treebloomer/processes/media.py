@@ -0,0 +1,70 @@
+import json
+import logging
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+def ffmpeg_binary(name: str = "ffmpeg") -> str:
+    found = shutil.which(name)
+    if found:
+        return found
+    if name == "ffmpeg":
+        try:
+            # audio_extract pulls in imageio-ffmpeg, which ships its own binary
+            import imageio_ffmpeg
+            return imageio_ffmpeg.get_ffmpeg_exe()
+        except ImportError:
+            pass
+    return name
+
+def run_ffmpeg(args: list) -> None:
+    command = [ffmpeg_binary(), "-hide_banner", "-nostdin", "-loglevel", "error", "-y", *args]
+    logger.debug("Running %s", ' '.join(command))
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with {completed.returncode}: {completed.stderr.strip()}")
+
+def probe_media(media_file: Path) -> dict:
+    command = [ffmpeg_binary("ffprobe"), "-v", "error", "-print_format", "json",
+               "-show_format", "-show_streams", str(media_file)]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"ffprobe failed on {media_file}: {completed.stderr.strip()}")
+    return json.loads(completed.stdout)
+
+def first_audio_stream(probe: dict) -> Optional[dict]:
+    for stream in probe.get("streams", []):
+        if stream.get("codec_type") == "audio":
+            return stream
+    return None
+
+def stream_bit_rate(stream: dict, probe: dict) -> Optional[int]:
+    bit_rate = stream.get("bit_rate") or probe.get("format", {}).get("bit_rate")
+    return int(bit_rate) if bit_rate else None
+
+def media_duration(media_file: Path) -> float:
+    return float(probe_media(media_file)["format"]["duration"])
+
+def detect_silences(media_file: Path, noise: str = "-35dB", min_silence: float = 0.5) -> list:
+    # Returns (start, end) pairs of silent spans as reported by ffmpeg's silencedetect filter.
+    command = [ffmpeg_binary(), "-hide_banner", "-nostdin", "-i", str(media_file),
+               "-af", f"silencedetect=noise={noise}:d={min_silence}", "-f", "null", "-"]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"silencedetect failed on {media_file}: {completed.stderr.strip()[-500:]}")
+    silences = []
+    start = None
+    for line in completed.stderr.splitlines():
+        if "silence_start:" in line:
+            start = float(line.split("silence_start:")[1].split()[0])
+        elif "silence_end:" in line and start is not None:
+            silences.append((start, float(line.split("silence_end:")[1].split()[0])))
+            start = None
+    return silences
+
+def cut_audio(media_file: Path, output_file: Path, start: float, duration: float) -> None:
+    run_ffmpeg(["-ss", f"{start:.3f}", "-t", f"{duration:.3f}", "-i", str(media_file),
+                "-map", "0:a:0", "-c:a", "copy", str(output_file)])
@@ -1,11 +1,18 @@
 import logging
 from pathlib import Path
 
-def one_shot_process_template(input_file: Path, subfolder: Path) -> Path:
+logger = logging.getLogger(__name__)
+
+# Anything that should invalidate this process's outputs when it changes (model, parameters, template...).
+# The manifest hashes it into the output's fingerprint.
+def stage_config() -> dict:
+    return {}
+
+def one_shot_process_template(input_file: Path, subfolder: Path, force: bool = False) -> Path:
     # TODO: Replace 'template' with a descriptive name for your process
     process_name = 'template'
     
-    logger.info(f"Processing {input_file.stem} with {process_name}...")
+    logger.info("Processing %s with %s...", input_file.stem, process_name)
     
     # TODO: Specify the correct input file extension
     input_extension = '.ext'
@@ -19,8 +26,8 @@ def one_shot_process_template(input_file: Path, subfolder: Path) -> Path:
     # TODO: Specify the correct output file name format
     output_file = subfolder / f"{original_stem}.{process_name}{output_extension}"
     
-    if output_file.exists():
-        logger.info(f"Processed file {output_file} already exists. Skipping processing.")
+    if output_file.exists() and not force:
+        logger.info("Processed file %s already exists. Skipping processing.", output_file)
         return output_file
     
     try:
@@ -36,10 +43,15 @@ def one_shot_process_template(input_file: Path, subfolder: Path) -> Path:
         # For demonstration, we're just creating an empty file
         output_file.touch()
         
-        logger.info(f"Processed {input_file.stem} to {output_file}.")
+        logger.info("Processed %s to %s.", input_file.stem, output_file)
         return output_file
     except Exception as e:
-        logging.error(f"Failed to process {input_file} with {process_name}: {e}")
+        logging.error("Failed to process %s with %s: %s", input_file, process_name, e)
         if output_file.exists():
             output_file.unlink()
         raise
+
+# To run this process as part of the pipeline, register it in treebloomer/processes/__init__.py, e.g.
+#     Stage('template', '.template:one_shot_process_template', 'cpu', 'extract_transcript', ('extract_transcript',),
+#           '.template:stage_config'),
+# Heavy third-party imports belong inside the function so they're only paid for when the stage runs.
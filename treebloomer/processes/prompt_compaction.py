@@ -0,0 +1,45 @@
+import re
+
+from treebloomer.processes.word_cloud_generation import custom_stop_words
+
+# Transcript compaction before summarization: drop the filler the word clouds already treat as
+# stopwords, collapse stutters and immediately repeated short phrases, and normalize whitespace.
+# "um"/"uh" (and drawn-out "umm", "uhh") go wherever they appear. The other entries are ordinary
+# words too ("I like it", "what I mean is"), so they're only dropped where whisper punctuated them
+# as an aside: between commas, or opening a sentence with a comma after them.
+hesitations = {word for word in custom_stop_words if word.lower() in ('um', 'uh')}
+asides = sorted(custom_stop_words - hesitations, key=lambda word: (-len(word), word))
+max_repeated_words = 4
+# Single words are only collapsed when they're a typical stutter. Doubles like "had had",
+# "that that" or "is is" are often grammatical, and repeated numbers are data ("1 1 2 3 5").
+stutter_words = ('a', 'an', 'and', 'but', 'i', 'if', 'in', 'it', 'my', 'of', 'on', 'so', 'the', 'they',
+                 'this', 'to', 'we', 'you')
+
+hesitation_pattern = re.compile(
+    r"\b(?:" + "|".join(f"{re.escape(word[:-1])}{re.escape(word[-1])}+" for word in sorted(hesitations)) + r")\b,?\s*",
+    re.IGNORECASE)
+aside_pattern = re.compile(r",\s*(?:" + "|".join(re.escape(word) for word in asides) + r"),", re.IGNORECASE)
+opening_aside_pattern = re.compile(r"(^|[.!?]\s+)(?:" + "|".join(re.escape(word) for word in asides) + r"),\s*",
+                                   re.IGNORECASE)
+# "I think, I think" - a run of 2 to max_repeated_words words (letters only) said again
+# straight away - or "the the", a stutter word said again
+repeat_word = r"[^\W\d_]+(?:'[^\W\d_]+)?"
+repeat_pattern = re.compile(r"\b(%s(?:\s+%s){1,%d}|%s)(?:,?\s+\1\b)+"
+                            % (repeat_word, repeat_word, max_repeated_words - 1, "|".join(stutter_words)),
+                            re.IGNORECASE)
+space_before_punctuation = re.compile(r"\s+([,.!?;:])")
+doubled_commas = re.compile(r",(?:\s*,)+")
+
+def compaction_config() -> dict:
+    return {'hesitations': sorted(hesitations), 'asides': asides, 'max_repeated_words': max_repeated_words,
+            'stutter_words': list(stutter_words)}
+
+def compact_transcript(text: str) -> str:
+    text = hesitation_pattern.sub("", text)
+    text = aside_pattern.sub("", text)
+    text = opening_aside_pattern.sub(r"\1", text)
+    text = repeat_pattern.sub(r"\1", text)
+    text = " ".join(text.split())
+    text = space_before_punctuation.sub(r"\1", text)
+    text = doubled_commas.sub(",", text)
+    return text.strip(" ,")
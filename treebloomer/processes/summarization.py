@@ -1,11 +1,15 @@
+import hashlib
 import logging
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from openai import OpenAI
-import os
-from dotenv import load_dotenv
+from typing import List, Optional, Tuple
 
-load_dotenv()
+from treebloomer import artifact_cache, telemetry
+from treebloomer.api_client import call_with_retry, estimate_tokens, get_client
+from treebloomer.processes.prompt_compaction import compact_transcript, compaction_config
+from treebloomer.processes.transcript_store import load_segments, load_text
 
 # TODO: adjust this basic system prompt to be more specific. later, we'll abstract it to a config file.
 # Pertinent information: 
@@ -13,6 +17,8 @@ load_dotenv()
 # - artifact type (lecture video, podcast, etc.)
 # - filetree (with "you are here")
 #   - optional, in case you don't want any global awareness. 
+# Anything per-leaf like that belongs in the user message: the system prompt and schema are the
+# start of every request and must stay byte-identical for the provider's prompt cache to hit.
 system_prompt = """
 You are an expert summarizer and analyst. Your task is to read the attached transcript and provide various summaries.
 
@@ -73,61 +79,204 @@ output_json_schema = {
 
 model = "gpt-4o-2024-08-06"  # or another appropriate model
 temperature = 0.0
+# Strip filler words and repeats from the transcript before sending it (--compact-transcripts).
+compact_transcripts = False
+
+# Transcripts estimated above single_pass_token_limit are summarized map-reduce style: split on
+# segment boundaries into chunks of about chunk_token_budget, summarize those concurrently into
+# the same schema, then reduce the partial summaries into the final one.
+single_pass_token_limit = 100_000
+chunk_token_budget = 12_000
+map_workers = 4
+
+chunk_system_prompt = """
+You are an expert summarizer and analyst. The attached text is one part of a longer transcript. Summarize this part only; your output will later be merged with the summaries of the other parts.
+
+More details can be found in the output schema. 
+"""
+
+reduce_system_prompt = """
+You are an expert summarizer and analyst. The attached JSON documents are summaries of consecutive parts of one long transcript, in order. Merge them into a single set of summaries of the whole transcript, de-duplicating topics, keywords and pull quotes and keeping pull quotes verbatim.
+
+More details can be found in the output schema. 
+"""
 
 logger = logging.getLogger(__name__)
 
-def summarize_transcript(input_file: Path, subfolder: Path) -> Path:
-    process_name = 'summaries'
+def stage_config() -> dict:
+    config = {'model': model, 'temperature': temperature, 'system_prompt': system_prompt,
+              'output_json_schema': output_json_schema}
+    if compact_transcripts:
+        # only present when on, so turning it on re-summarizes but upgrading doesn't
+        config['compaction'] = compaction_config()
+    return config
+
+def summary_output_file(input_file: Path, subfolder: Path) -> Path:
+    original_stem = input_file.stem.rsplit('.', 1)[0]
+    return subfolder / f"{original_stem}.summaries.json"
+
+def build_request(content: str, prompt: str = system_prompt, header: str = "Transcript:\n\n") -> dict:
+    # Body of a chat completion request; shared by the interactive path, the map-reduce calls and
+    # the batch file writer. Everything ahead of the user message is static per prompt, so
+    # consecutive requests share their longest possible prefix.
+    return {
+        "model": model,
+        "temperature": temperature,
+        "response_format": output_json_schema,
+        "messages": [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": header + content}
+        ],
+    }
+
+def prepare_transcript(transcript_text: str, name: str = "") -> Tuple[str, Optional[dict]]:
+    # The transcript as it goes into the prompt, and token counts before/after compaction if it's on.
+    if not compact_transcripts:
+        return transcript_text, None
+    compacted = compact_transcript(transcript_text)
+    details = {'tokens_before': estimate_tokens(transcript_text, model),
+               'tokens_after': estimate_tokens(compacted, model)}
+    logger.info("Compacted transcript %s from %d to %d tokens (%.1f%% fewer)", name, details['tokens_before'],
+                details['tokens_after'], 100 * (1 - details['tokens_after'] / max(details['tokens_before'], 1)))
+    return compacted, details
+
+def split_segments(segments: list, max_tokens: int) -> List[str]:
+    chunks, current, current_tokens = [], [], 0
+    for segment in segments:
+        tokens = estimate_tokens(segment['text'], model)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("".join(current).strip())
+            current, current_tokens = [], 0
+        current.append(segment['text'])
+        current_tokens += tokens
+    if current:
+        chunks.append("".join(current).strip())
+    return chunks
+
+def complete(prompt: str, content: str, stage: str = 'summarize_transcript') -> Tuple[str, str]:
+    # One schema-shaped completion: (content, model). Also used for the folder summaries.
+    client = get_client()
+    request = build_request(content, prompt, header="")
+    response = call_with_retry(lambda: client.chat.completions.create(**request),
+                               stage=stage, tokens=estimate_tokens(prompt + content, model))
+    return response.choices[0].message.content, response.model
+
+def group_by_tokens(texts: List[str], budget: int) -> List[List[str]]:
+    # Consecutive texts packed into groups of about `budget` tokens. A group always takes at
+    # least two texts, so every round of merging the groups is shorter than the one before.
+    groups, current, current_tokens = [], [], 0
+    for text in texts:
+        tokens = estimate_tokens(text, model)
+        if len(current) >= 2 and current_tokens + tokens > budget:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+def _reduce(partials: List[str]) -> Tuple[str, str]:
+    # Merge in groups that fit the budget; more than one group means another round on top.
+    groups = group_by_tokens(partials, single_pass_token_limit)
+    merged = [complete(reduce_system_prompt, "Partial summaries:\n\n" + "\n\n".join(
+        f"Part {index + 1} of {len(group)}:\n{partial}" for index, partial in enumerate(group))) for group in groups]
+    if len(merged) == 1:
+        return merged[0]
+    return _reduce([content for content, _ in merged])
+
+def map_reduce_summary(transcript_obj: dict, cache_file: Path) -> Tuple[str, str, int]:
+    segments = transcript_obj.get('segments') or [{'text': transcript_obj['text']}]
+    if compact_transcripts:
+        # segment texts carry their own leading space, which compaction strips
+        segments = [{'text': " " + compact_transcript(segment['text'])} for segment in segments]
+    chunks = split_segments(segments, chunk_token_budget)
+    prompt_hash = hashlib.sha256(json.dumps([model, temperature, chunk_system_prompt, output_json_schema,
+                                             compact_transcripts], sort_keys=True).encode('utf-8')).hexdigest()
+    keys = [hashlib.sha256((prompt_hash + chunk).encode('utf-8')).hexdigest() for chunk in chunks]
+
+    # Map results survive a failed reduce, keyed by chunk text + prompt/config.
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cache = {}
+    cache_lock = threading.Lock()
+
+    def summarize_chunk(index: int) -> str:
+        if keys[index] in cache:
+            return cache[keys[index]]
+        content, _ = complete(chunk_system_prompt, f"Transcript part {index + 1} of {len(chunks)}:\n\n{chunks[index]}")
+        with cache_lock:
+            cache[keys[index]] = content
+            with open(cache_file, 'w') as f:
+                json.dump(cache, f)
+        return content
+
+    logger.info("Summarizing %s transcript chunks (%s cached)...", len(chunks), sum(key in cache for key in keys))
+    with ThreadPoolExecutor(max_workers=map_workers, thread_name_prefix="treebloomer-map") as pool:
+        futures = [telemetry.submit(pool, summarize_chunk, index) for index in range(len(chunks))]
+        partials = [future.result() for future in futures]
+    content, response_model = _reduce(partials)
+    return content, response_model, len(chunks)
+
+def write_summary(output_file: Path, content: str, input_file: Path, response_model: str,
+                  extra_details: Optional[dict] = None) -> Path:
+    summary_data = json.loads(content)
+    logger.debug("Summary for %s: %d topics, %d keywords, %d pull quotes", input_file.stem,
+                 len(summary_data.get('topics', [])), len(summary_data.get('keywords', [])),
+                 len(summary_data.get('pull_quotes', [])))
     
-    logger.info(f"Summarizing transcript {input_file.stem}...")
+    # # Add the prompt used to the summary data
+    # summary_data['prompt_used'] = system_prompt
+    summary_data['llm_details'] = {}
+    summary_data['llm_details']['system_prompt'] = system_prompt
+    summary_data['llm_details']['output_json_schema'] = output_json_schema
+    summary_data['llm_details']['input_file'] = str(input_file)
+    summary_data['llm_details']['input_file_stem'] = str(input_file)
+    summary_data['llm_details']['model'] = response_model
+    summary_data['llm_details']['temperature'] = temperature
+    summary_data['llm_details'].update(extra_details or {})
     
-    original_stem = input_file.stem.rsplit('.', 1)[0]
-    output_file = subfolder / f"{original_stem}.{process_name}.json"
+    # Write the summary data directly to the output file
+    with open(output_file, 'w') as outfile:
+        json.dump(summary_data, outfile, indent=4)
+    artifact_cache.put(output_file, summary_data)
+    return output_file
+
+def summarize_transcript(input_file: Path, subfolder: Path, force: bool = False) -> Path:
+    logger.info("Summarizing transcript %s...", input_file.stem)
+    
+    output_file = summary_output_file(input_file, subfolder)
     
-    if output_file.exists():
-        logger.info(f"Summary file {output_file} already exists. Skipping summarization.")
+    if output_file.exists() and not force:
+        logger.info("Summary file %s already exists. Skipping summarization.", output_file)
         return output_file
     
     try:
-        # Read the transcript
-        with open(input_file, 'r') as file:
-            transcript_json = file.read()
-            transcript_obj = json.loads(transcript_json)
-            transcript_text = transcript_obj['text']
-        
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        response = client.chat.completions.create(
-            model=model, 
-            temperature = temperature,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Transcript:\n\n{transcript_text}"}
-            ],
-            response_format=output_json_schema
-        )
-        
-        # # TODO: Process the API response and extract the summary data
-        summary_data = json.loads(response.choices[0].message.content)
-        logger.info("summary_data: %s", summary_data)
-        
-        # # Add the prompt used to the summary data
-        # summary_data['prompt_used'] = system_prompt
-        summary_data['llm_details'] = {}
-        summary_data['llm_details']['system_prompt'] = system_prompt
-        summary_data['llm_details']['output_json_schema'] = output_json_schema
-        summary_data['llm_details']['input_file'] = str(input_file)
-        summary_data['llm_details']['input_file_stem'] = str(input_file)
-        summary_data['llm_details']['model'] = response.model
-        summary_data['llm_details']['temperature'] = temperature
+        # Read the transcript text (from the columnar sidecar when there is one)
+        transcript_text, compaction = prepare_transcript(load_text(input_file), input_file.stem)
+        extra_details = {'compaction': compaction} if compaction else {}
         
-        # Write the summary data directly to the output file
-        with open(output_file, 'w') as outfile:
-            json.dump(summary_data, outfile, indent=4)
+        client = get_client()
+        request = build_request(transcript_text)
+        estimated_tokens = estimate_tokens(system_prompt + request["messages"][1]["content"], model)
+        if estimated_tokens > single_pass_token_limit:
+            cache_file = output_file.with_name(output_file.name.replace('.summaries.json', '.summary_chunks.json'))
+            content, response_model, chunk_count = map_reduce_summary(load_segments(input_file), cache_file)
+            write_summary(output_file, content, input_file, response_model,
+                          dict(extra_details, map_reduce_chunks=chunk_count, system_prompt=chunk_system_prompt,
+                               reduce_system_prompt=reduce_system_prompt))
+            cache_file.unlink(missing_ok=True)
+        else:
+            response = call_with_retry(lambda: client.chat.completions.create(**request),
+                                       stage='summarize_transcript', tokens=estimated_tokens)
+            write_summary(output_file, response.choices[0].message.content, input_file, response.model, extra_details)
         
-        logger.info(f"Summarized {input_file.stem} to {output_file}.")
+        logger.info("Summarized %s to %s.", input_file.stem, output_file)
         return output_file
     except Exception as e:
-        logging.error(f"Failed to summarize {input_file}: {e}")
+        logging.error("Failed to summarize %s: %s", input_file, e)
         if output_file.exists():
             output_file.unlink()
         raise
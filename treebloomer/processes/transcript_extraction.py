@@ -1,14 +1,31 @@
 import json
 import logging
-import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List, Optional, Tuple
 
-from dotenv import load_dotenv
-from openai import OpenAI
+from treebloomer import artifact_cache, telemetry
+from treebloomer.api_client import call_with_retry, get_client
+from treebloomer.processes.local_whisper import transcribe_local
+from treebloomer.processes.media import cut_audio, detect_silences, media_duration
+from treebloomer.processes.transcript_store import columns_path, write_columns
+from treebloomer.processes.voice_activity import load_time_map, remap_transcript
 
-load_dotenv()
 logger = logging.getLogger(__name__)
 
+model = "whisper-1"
+# Set from --transcribe-backend/--whisper-model so the manifest fingerprint follows them.
+backend = "api"
+local_options: dict = {}
+
+# The hosted whisper-1 endpoint rejects uploads over 25 MB; anything bigger is always chunked.
+max_upload_bytes = 25 * 1024 * 1024
+chunk_seconds = 600.0
+chunk_overlap_seconds = 5.0
+# How far from a nominal cut point we will look for a silence to cut in instead.
+silence_search_seconds = 30.0
+
 def to_dict(obj):
     if hasattr(obj, "__dict__"):
         # convert object with a __dict__ to a dictionary
@@ -21,36 +38,164 @@ def to_dict(obj):
         result = obj
     return result
 
-def extract_transcript(audio_file: Path, subfolder: Path) -> Path:
-    logger.info(f"Transcribing audio from {audio_file.stem}...")
+def as_dict(transcript) -> dict:
+    # SDK responses are pydantic models; model_dump is much cheaper than walking __dict__ recursively
+    if isinstance(transcript, dict):
+        return transcript
+    if hasattr(transcript, "model_dump"):
+        return transcript.model_dump(exclude_none=True)
+    return to_dict(transcript)
+
+def transcribe_file(audio_file: Path):
+    # Returns the SDK's response object as is; extract_transcript writes it without converting it first.
+    client = get_client()
+
+    def request():
+        # reopened on every attempt so a retry uploads the file from the start
+        with open(str(audio_file), 'rb') as audio_data:
+            return client.audio.transcriptions.create(model=model, file=audio_data,
+                                                      response_format="verbose_json")
+
+    return call_with_retry(request, stage='extract_transcript')
+
+def plan_chunks(duration: float, silences: List[Tuple[float, float]], target_seconds: float) -> List[float]:
+    # Cut points (excluding 0 and duration), each snapped to the middle of the nearest silence
+    # within silence_search_seconds of the nominal boundary.
+    cuts = []
+    previous = 0.0
+    while duration - previous > target_seconds:
+        nominal = previous + target_seconds
+        candidates = [(start + end) / 2 for start, end in silences
+                      if abs((start + end) / 2 - nominal) <= silence_search_seconds and (start + end) / 2 > previous + 1.0]
+        cut = min(candidates, key=lambda midpoint: abs(midpoint - nominal)) if candidates else nominal
+        cuts.append(cut)
+        previous = cut
+    return cuts
+
+def merge_chunk_transcripts(chunks: List[Tuple[float, float, float, dict]]) -> dict:
+    # chunks: (offset, owned_start, owned_end, transcript). Segment times are shifted by the
+    # chunk offset and a segment is kept only by the chunk that owns its start time, which
+    # drops the copies transcribed twice in the overlaps.
+    merged = dict(chunks[0][3])
+    segments = []
+    words = []
+    for offset, owned_start, owned_end, transcript in chunks:
+        for segment in transcript.get("segments") or []:
+            start, end = segment["start"] + offset, segment["end"] + offset
+            if not owned_start <= start < owned_end:
+                continue
+            segment = dict(segment, start=start, end=end, id=len(segments))
+            if "seek" in segment:
+                segment["seek"] = segment["seek"] + int(offset * 100)
+            segments.append(segment)
+        for word in transcript.get("words") or []:
+            start, end = word["start"] + offset, word["end"] + offset
+            if owned_start <= start < owned_end:
+                words.append(dict(word, start=start, end=end))
+    merged["segments"] = segments
+    if words:
+        merged["words"] = words
+    merged["text"] = "".join(segment["text"] for segment in segments).strip()
+    return merged
+
+def transcribe_chunked(audio_file: Path, work_dir: Path, target_seconds: float,
+                       max_workers: int) -> dict:
+    duration = media_duration(audio_file)
+    try:
+        silences = detect_silences(audio_file)
+    except Exception as e:
+        logger.warning("Silence detection failed for %s, cutting at fixed intervals: %s", audio_file, e)
+        silences = []
+    boundaries = [0.0, *plan_chunks(duration, silences, target_seconds), duration]
+    logger.info("Transcribing %s in %s chunks with %s workers...", audio_file.stem, len(boundaries) - 1, max_workers)
 
-    original_stem = audio_file.stem.rsplit('.', 1)[0]  # Remove '.compressed_audio' from the stem
+    work_dir.mkdir(exist_ok=True)
+    try:
+        jobs = []
+        for index, (owned_start, owned_end) in enumerate(zip(boundaries, boundaries[1:])):
+            start = max(0.0, owned_start - chunk_overlap_seconds)
+            end = min(duration, owned_end + chunk_overlap_seconds)
+            chunk_file = work_dir / f"chunk_{index:04d}{audio_file.suffix}"
+            cut_audio(audio_file, chunk_file, start, end - start)
+            jobs.append((start, owned_start, owned_end if index < len(boundaries) - 2 else float("inf"), chunk_file))
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="treebloomer-chunk") as pool:
+            futures = [telemetry.submit(pool, transcribe_file, job[3]) for job in jobs]
+            transcripts = [as_dict(future.result()) for future in futures]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    merged = merge_chunk_transcripts([(offset, owned_start, owned_end, transcript)
+                                      for (offset, owned_start, owned_end, _), transcript in zip(jobs, transcripts)])
+    merged["duration"] = duration
+    return merged
+
+def stage_config() -> dict:
+    if backend != "local":
+        return {'model': model, 'response_format': 'verbose_json'}
+    # what changes the local output; workers, threads and batch size only change how fast it comes
+    from treebloomer.processes import local_whisper
+    return {'backend': backend, 'model_size': local_options.get('model_size', 'base'),
+            'language': local_options.get('language'), 'no_speech_threshold': local_whisper.no_speech_threshold,
+            'logprob_threshold': local_whisper.logprob_threshold}
+
+def extract_transcript(audio_file: Path, subfolder: Path, chunk_length: Optional[float] = None,
+                       chunk_workers: int = 4, backend: str = "api", local_options: Optional[dict] = None,
+                       force: bool = False) -> Path:
+    logger.info("Transcribing audio from %s...", audio_file.stem)
+
+    original_stem = audio_file.stem.rsplit('.', 1)[0]  # Remove '.compressed_audio' / '.trimmed_audio' from the stem
     transcript_json_path = subfolder / f"{original_stem}.transcript.json"
     transcript_txt_path = subfolder / f"{original_stem}.transcript.txt"
+    transcript_columns_path = columns_path(transcript_json_path)
 
-    if transcript_json_path.exists() and transcript_txt_path.exists():
-        logger.info(f"Transcript files already exist. Skipping transcription.")
+    if transcript_json_path.exists() and transcript_txt_path.exists() and not force:
+        logger.info("Transcript files already exist. Skipping transcription.")
         return transcript_json_path
 
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        with open(str(audio_file), 'rb') as audio_data:
-            result = client.audio.transcriptions.create(model="whisper-1", file=audio_data,
-                                                        response_format="verbose_json")
-        transcript = to_dict(result)
+        if backend not in ("api", "local"):
+            raise ValueError(f"Unknown transcription backend {backend!r}")
+        if backend == "api" and chunk_length is None and audio_file.stat().st_size > max_upload_bytes:
+            chunk_length = chunk_seconds
+
+        if backend == "local":
+            # no upload limit locally, so no chunking; the worker pool batches 30 s windows instead
+            transcript = transcribe_local(audio_file, **(local_options or {}))
+        elif chunk_length:
+            transcript = transcribe_chunked(audio_file, subfolder / f"{original_stem}.transcript_chunks.incomplete",
+                                            chunk_length, chunk_workers)
+        else:
+            transcript = transcribe_file(audio_file)
+
+        time_map = load_time_map(audio_file)
+        if time_map is not None:
+            # silence was cut before transcribing; put the segments back on the video's timeline
+            transcript = remap_transcript(as_dict(transcript), time_map)
 
         with open(transcript_json_path, 'w') as json_file:
-            json.dump(transcript, json_file, indent=4)
+            if hasattr(transcript, "model_dump_json"):
+                json_file.write(transcript.model_dump_json(exclude_none=True))
+            else:
+                json.dump(transcript, json_file)
 
         with open(transcript_txt_path, 'w') as txt_file:
-            txt_file.write(transcript["text"])
+            txt_file.write(transcript.text if hasattr(transcript, "text") else transcript["text"])
+
+        try:
+            write_columns(transcript, transcript_columns_path)
+        except Exception as e:
+            # readers fall back to the JSON, so a missing sidecar only costs speed
+            logger.warning("Could not write transcript columns for %s: %s", audio_file.stem, e)
+            transcript_columns_path.unlink(missing_ok=True)
 
-        logger.info(f"Transcription saved to {transcript_json_path} and {transcript_txt_path}")
+        artifact_cache.put(transcript_json_path, transcript)
+        logger.info("Transcription saved to %s and %s", transcript_json_path, transcript_txt_path)
         return transcript_json_path
     except Exception as e:
-        logging.error(f"Failed to transcribe audio file {audio_file}: {e}")
+        logging.error("Failed to transcribe audio file %s: %s", audio_file, e)
         # Clean up any partially written files
-        for path in [transcript_json_path, transcript_txt_path]:
+        for path in [transcript_json_path, transcript_txt_path, transcript_columns_path]:
             if path.exists():
                 path.unlink()
         raise
@@ -0,0 +1,207 @@
+import json
+import logging
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional
+
+from treebloomer import artifact_cache
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Columnar sidecar written next to <stem>.transcript.json as <stem>.transcript.columns:
+#
+#   magic (8 bytes) | header length (uint64 LE) | JSON header | columns, each 64-byte aligned
+#
+# The header lists each column's dtype, element count and offset, plus language/duration. Columns:
+#   start, end (float64), avg_logprob, no_speech_prob, compression_ratio (float32) - one per segment
+#   token_offsets (int64, n+1) into tokens (int32) - each segment's whisper tokens
+#   text_offsets (int64, n+1) into text_blob (uint8) - each segment's UTF-8 text
+# When the transcript's text is just its segments joined and stripped (the usual case) the blob is
+# only stored once; otherwise the full text follows the segment texts at header['text_offset'].
+# Readers mmap the file, so loading the text or a time range touches only those pages.
+
+MAGIC = b'TBTCOL01'
+SUFFIX = '.transcript.columns'
+ALIGN = 64
+float_columns = {'start': '<f8', 'end': '<f8', 'avg_logprob': '<f4', 'no_speech_prob': '<f4',
+                 'compression_ratio': '<f4'}
+
+
+def columns_path(transcript_json: Path) -> Path:
+    return transcript_json.with_name(transcript_json.name.replace('.transcript.json', SUFFIX))
+
+
+def _get(obj, name: str, default=None):
+    # SDK response objects (attributes) and merged/local transcripts (dicts) alike
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def write_columns(transcript, output_file: Path) -> Path:
+    import numpy as np
+
+    segments = _get(transcript, 'segments') or []
+    texts = [(_get(segment, 'text') or '').encode('utf-8') for segment in segments]
+    text = _get(transcript, 'text') or ''
+    joined = b''.join(texts)
+    text_offsets = np.zeros(len(segments) + 1, dtype='<i8')
+    np.cumsum([len(segment_text) for segment_text in texts], out=text_offsets[1:])
+    header = {'language': _get(transcript, 'language'), 'duration': _get(transcript, 'duration'),
+              'segments': len(segments), 'columns': {}}
+    blob = joined
+    if joined.decode('utf-8').strip() != text:
+        header['text_offset'] = len(joined)
+        blob = joined + text.encode('utf-8')
+
+    tokens = [_get(segment, 'tokens') or [] for segment in segments]
+    token_offsets = np.zeros(len(segments) + 1, dtype='<i8')
+    np.cumsum([len(segment_tokens) for segment_tokens in tokens], out=token_offsets[1:])
+    arrays = {name: np.array([_get(segment, name) or 0.0 for segment in segments], dtype=dtype)
+              for name, dtype in float_columns.items()}
+    arrays['token_offsets'] = token_offsets
+    arrays['tokens'] = np.fromiter((token for segment_tokens in tokens for token in segment_tokens),
+                                   dtype='<i4', count=int(token_offsets[-1]))
+    arrays['text_offsets'] = text_offsets
+    arrays['text_blob'] = np.frombuffer(blob, dtype='u1')
+
+    # offsets are relative to the start of the data section, which begins aligned after the header
+    offset = 0
+    for name, array in arrays.items():
+        header['columns'][name] = {'dtype': array.dtype.str, 'count': int(array.size), 'offset': offset}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGN) * ALIGN
+
+    incomplete_path = output_file.with_name(output_file.name + '.incomplete')
+    with open(incomplete_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header['columns'][name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    incomplete_path.replace(output_file)
+    return output_file
+
+
+class TranscriptColumns:
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        if self._map is None or self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a transcript columns file")
+        header_length, = struct.unpack_from('<Q', self._map, len(MAGIC))
+        self.header = json.loads(self._map[len(MAGIC) + 8:len(MAGIC) + 8 + header_length])
+        self._data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGN) * ALIGN
+
+    def column(self, name: str) -> 'np.ndarray':
+        import numpy as np
+        spec = self.header['columns'][name]
+        return np.frombuffer(self._map, dtype=spec['dtype'], count=spec['count'],
+                             offset=self._data_start + spec['offset'])
+
+    def __len__(self) -> int:
+        return self.header['segments']
+
+    @property
+    def language(self) -> Optional[str]:
+        return self.header.get('language')
+
+    @property
+    def duration(self) -> Optional[float]:
+        return self.header.get('duration')
+
+    def _blob(self, start: int, end: int) -> str:
+        spec = self.header['columns']['text_blob']
+        base = self._data_start + spec['offset']
+        return self._map[base + start:base + end].decode('utf-8')
+
+    @property
+    def text(self) -> str:
+        blob_size = self.header['columns']['text_blob']['count']
+        if 'text_offset' in self.header:
+            return self._blob(self.header['text_offset'], blob_size)
+        return self._blob(0, blob_size).strip()
+
+    def segment_text(self, index: int) -> str:
+        offsets = self.column('text_offsets')
+        return self._blob(int(offsets[index]), int(offsets[index + 1]))
+
+    def segment_texts(self) -> List[str]:
+        offsets = self.column('text_offsets').tolist()
+        return [self._blob(start, end) for start, end in zip(offsets, offsets[1:])]
+
+    def segments_between(self, start: float, end: float) -> List[dict]:
+        # segments overlapping [start, end), found by binary search over the sorted start/end columns
+        import numpy as np
+        starts, ends = self.column('start'), self.column('end')
+        first = int(np.searchsorted(ends, start, side='right'))
+        last = int(np.searchsorted(starts, end, side='left'))
+        offsets = self.column('text_offsets')
+        return [{'id': index, 'start': float(starts[index]), 'end': float(ends[index]),
+                 'text': self._blob(int(offsets[index]), int(offsets[index + 1]))} for index in range(first, last)]
+
+    def close(self) -> None:
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # arrays handed out by column() still point into the map; it's unmapped once they're gone
+                pass
+            self._map = None
+
+    def __enter__(self) -> 'TranscriptColumns':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def open_columns(transcript_json: Path) -> Optional[TranscriptColumns]:
+    # The sidecar if it exists and is at least as new as the JSON it was written with, else None.
+    path = columns_path(transcript_json)
+    try:
+        if path.stat().st_mtime_ns < transcript_json.stat().st_mtime_ns:
+            return None
+        return TranscriptColumns(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, ImportError) as e:
+        logger.warning("Ignoring transcript columns %s: %s", path, e)
+        return None
+
+
+def load_text(transcript_json: Path) -> str:
+    # the response extract_transcript just wrote, if it's still in this process's artifact cache
+    transcript = artifact_cache.get(transcript_json)
+    if transcript is not None:
+        return _get(transcript, 'text')
+    columns = open_columns(transcript_json)
+    if columns is not None:
+        with columns:
+            return columns.text
+    return artifact_cache.load_json(transcript_json)['text']
+
+
+def load_segments(transcript_json: Path) -> dict:
+    # {'text', 'segments': [{'start', 'end', 'text'}]} - what the summarizer and search index need
+    transcript = artifact_cache.get(transcript_json)
+    if transcript is not None:
+        return {'text': _get(transcript, 'text'), 'segments': [
+            {'start': _get(segment, 'start'), 'end': _get(segment, 'end'), 'text': _get(segment, 'text')}
+            for segment in _get(transcript, 'segments') or []]}
+    columns = open_columns(transcript_json)
+    if columns is not None:
+        with columns:
+            starts, ends = columns.column('start').tolist(), columns.column('end').tolist()
+            return {'text': columns.text, 'segments': [
+                {'start': start, 'end': end, 'text': text}
+                for start, end, text in zip(starts, ends, columns.segment_texts())]}
+    return artifact_cache.load_json(transcript_json)
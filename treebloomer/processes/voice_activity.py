@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Tuple
+
+from treebloomer.processes.audio_compression import bitrate
+from treebloomer.processes.media import ffmpeg_binary, run_ffmpeg
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Optional stage between compress_audio and extract_transcript: decode the compressed audio to
+# 16 kHz mono PCM, mark 30 ms frames whose RMS level is below the silence threshold, and cut every
+# silent run longer than min_silence_seconds (keeping padding_seconds of it on either side, so
+# speech isn't clipped and whisper still hears a pause). The kept spans are written as a time map
+# next to <stem>.trimmed_audio.mp3; extract_transcript uses it to move segment times back onto the
+# original timeline. The cuts are made on those same PCM samples, which the spans (whole
+# milliseconds, so whole samples) address exactly, and the kept samples are piped to the encoder:
+# the time map describes the trimmed audio to the sample instead of to a decoder frame.
+sample_rate = 16000
+frame_seconds = 0.03
+# A frame is silent below threshold_db (dBFS), raised to noise_margin_db above the recording's
+# noise floor for hissy sources, but never above max_threshold_db so quiet speech is kept.
+threshold_db = -45.0
+noise_margin_db = 10.0
+max_threshold_db = -30.0
+min_silence_seconds = 2.0
+padding_seconds = 0.3
+read_frames = 4096
+# Bumped whenever the cutting itself changes in a way the parameters above don't capture, so
+# audio trimmed by the old code is trimmed again. 2: cuts on PCM samples instead of aselect frames.
+TRIM_VERSION = 2
+
+def stage_config() -> dict:
+    return {'version': TRIM_VERSION, 'sample_rate': sample_rate, 'frame_seconds': frame_seconds,
+            'threshold_db': threshold_db, 'noise_margin_db': noise_margin_db, 'max_threshold_db': max_threshold_db,
+            'min_silence_seconds': min_silence_seconds, 'padding_seconds': padding_seconds, 'bitrate': bitrate}
+
+def time_map_path(audio_file: Path) -> Path:
+    original_stem = audio_file.stem.rsplit('.', 1)[0]
+    return audio_file.with_name(f"{original_stem}.time_map.json")
+
+def _decode_command(audio_file: Path) -> list:
+    return [ffmpeg_binary(), "-hide_banner", "-nostdin", "-loglevel", "error", "-i", str(audio_file),
+            "-map", "0:a:0", "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "-"]
+
+def frame_levels(audio_file: Path) -> Tuple['np.ndarray', float]:
+    # RMS level of every frame in dBFS, and the audio duration. PCM is streamed from ffmpeg a block
+    # at a time, so a long recording never sits in memory as samples.
+    import numpy as np
+
+    frame = int(sample_rate * frame_seconds)
+    command = _decode_command(audio_file)
+    levels = []
+    samples_read = 0
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        while True:
+            data = process.stdout.read(frame * read_frames * 2)
+            if not data:
+                break
+            samples = np.frombuffer(data, dtype='<i2').astype(np.float32) / 32768.0
+            samples_read += samples.size
+            # reads are whole frames except at the very end, where the short tail is its own frame
+            full = samples.size // frame * frame
+            blocks = samples[:full].reshape(-1, frame)
+            levels.append(np.einsum('ij,ij->i', blocks, blocks) / frame)
+            if full < samples.size:
+                tail = samples[full:]
+                levels.append(np.array([np.dot(tail, tail) / tail.size], dtype=np.float32))
+        stderr = process.stderr.read().decode('utf-8', 'replace')
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode {audio_file}: {stderr.strip()}")
+    power = np.concatenate(levels) if levels else np.zeros(0, dtype=np.float32)
+    return 10.0 * np.log10(power + 1e-10), samples_read / sample_rate
+
+def kept_spans(levels: 'np.ndarray', duration: float) -> List[Tuple[float, float]]:
+    import numpy as np
+
+    if levels.size == 0:
+        return []
+    noise_floor = float(np.percentile(levels, 5))
+    threshold = min(max(threshold_db, noise_floor + noise_margin_db), max_threshold_db)
+    # widen every voiced frame by the padding, then whatever is still silent is a candidate cut
+    padding = int(round(padding_seconds / frame_seconds))
+    voiced = np.convolve(levels > threshold, np.ones(2 * padding + 1, dtype=np.int32), mode='same') > 0
+    edges = np.flatnonzero(np.diff(np.concatenate(([1], voiced.astype(np.int8), [1]))))
+    silent_runs = edges.reshape(-1, 2)
+    long_enough = (silent_runs[:, 1] - silent_runs[:, 0]) * frame_seconds >= min_silence_seconds - 2 * padding_seconds
+    spans, position = [], 0.0
+    for first, last in silent_runs[long_enough].tolist():
+        # whole milliseconds are whole samples at sample_rate, so these are exactly where the cuts fall
+        cut_start, cut_end = round(first * frame_seconds, 3), round(min(last * frame_seconds, duration), 3)
+        if cut_start > position:
+            spans.append((position, cut_start))
+        position = cut_end
+    if position < duration:
+        spans.append((position, duration))
+    return spans
+
+def remap_times(times, time_map: dict, end: bool = False) -> List[float]:
+    # Times on the trimmed timeline back onto the original one. A time that falls exactly on a cut
+    # belongs to the span before it when it ends something (end=True), to the span after otherwise.
+    import numpy as np
+
+    spans = np.asarray(time_map['spans'], dtype=np.float64).reshape(-1, 2)
+    if spans.size == 0:
+        return [float(time) for time in times]
+    lengths = spans[:, 1] - spans[:, 0]
+    offsets = np.concatenate(([0.0], np.cumsum(lengths)[:-1]))
+    times = np.asarray(times, dtype=np.float64)
+    index = np.clip(np.searchsorted(offsets, times, side='left' if end else 'right') - 1, 0, len(spans) - 1)
+    within = np.clip(times - offsets[index], 0.0, None)
+    # past the end of the last span (encoder padding) stays past it rather than being clamped
+    within = np.where(index < len(spans) - 1, np.minimum(within, lengths[index]), within)
+    return (spans[index, 0] + within).tolist()
+
+def remap_transcript(transcript: dict, time_map: dict) -> dict:
+    segments = transcript.get("segments") or []
+    words = transcript.get("words") or []
+    starts = remap_times([segment["start"] for segment in segments], time_map)
+    ends = remap_times([segment["end"] for segment in segments], time_map, end=True)
+    remapped = dict(transcript, duration=time_map['duration'])
+    remapped["segments"] = [dict(segment, start=start, end=end) for segment, start, end in zip(segments, starts, ends)]
+    for segment in remapped["segments"]:
+        if "seek" in segment:
+            segment["seek"] = int(segment["start"] * 100)
+    if words:
+        word_starts = remap_times([word["start"] for word in words], time_map)
+        word_ends = remap_times([word["end"] for word in words], time_map, end=True)
+        remapped["words"] = [dict(word, start=start, end=end) for word, start, end in zip(words, word_starts, word_ends)]
+    return remapped
+
+def load_time_map(audio_file: Path):
+    # The time map written alongside a trimmed audio file, or None for audio that wasn't trimmed.
+    if not audio_file.stem.endswith('.trimmed_audio'):
+        return None
+    with open(time_map_path(audio_file), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_kept_audio(audio_file: Path, spans: List[Tuple[float, float]], output_file: Path) -> None:
+    # Decodes the audio again, a block at a time, and pipes only the samples inside the spans to the
+    # mp3 encoder.
+    bounds = [(int(round(start * sample_rate)), int(round(end * sample_rate))) for start, end in spans]
+    encode = [ffmpeg_binary(), "-hide_banner", "-nostdin", "-loglevel", "error", "-y", "-f", "s16le",
+              "-ar", str(sample_rate), "-ac", "1", "-i", "-", "-c:a", "libmp3lame", "-b:a", bitrate,
+              "-f", "mp3", str(output_file)]
+    block = sample_rate * 2 * 10
+    with subprocess.Popen(_decode_command(audio_file), stdout=subprocess.PIPE, stderr=subprocess.PIPE) as decoder, \
+            subprocess.Popen(encode, stdin=subprocess.PIPE, stderr=subprocess.PIPE) as encoder:
+        position, index = 0, 0
+        try:
+            while True:
+                data = decoder.stdout.read(block)
+                if not data:
+                    break
+                count = len(data) // 2
+                while index < len(bounds) and bounds[index][1] <= position:
+                    index += 1
+                for start, end in bounds[index:]:
+                    if start >= position + count:
+                        break
+                    first, last = max(start, position) - position, min(end, position + count) - position
+                    encoder.stdin.write(data[2 * first:2 * last])
+                position += count
+        except BaseException:
+            decoder.kill()
+            encoder.kill()
+            raise
+        finally:
+            encoder.stdin.close()
+            decoder_errors = decoder.stderr.read().decode('utf-8', 'replace')
+            encoder_errors = encoder.stderr.read().decode('utf-8', 'replace')
+    if decoder.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode {audio_file}: {decoder_errors.strip()}")
+    if encoder.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not encode {output_file}: {encoder_errors.strip()}")
+
+def _place(source: Path, destination: Path) -> None:
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+def trim_silence(audio_file: Path, subfolder: Path, force: bool = False) -> Path:
+    logger.info("Trimming silence from %s...", audio_file.stem)
+
+    original_stem = audio_file.stem.rsplit('.', 1)[0]  # Remove '.compressed_audio' from the stem
+    trimmed_audio_file = subfolder / f"{original_stem}.trimmed_audio.mp3"
+    time_map_file = time_map_path(trimmed_audio_file)
+    incomplete_path = subfolder / f"{original_stem}.trimmed_audio.mp3.incomplete"
+    time_map_incomplete_path = subfolder / f"{original_stem}.time_map.json.incomplete"
+
+    if trimmed_audio_file.exists() and time_map_file.exists() and not force:
+        logger.info("Trimmed audio file %s already exists. Skipping trimming.", trimmed_audio_file)
+        return trimmed_audio_file
+
+    try:
+        levels, duration = frame_levels(audio_file)
+        spans = kept_spans(levels, duration)
+        kept = sum(end - start for start, end in spans)
+        if not spans or spans == [(0.0, duration)]:
+            # nothing worth cutting (or nothing but silence): transcribe the compressed audio as is
+            spans = [(0.0, duration)]
+            incomplete_path.unlink(missing_ok=True)
+            if audio_file.suffix == ".mp3":
+                _place(audio_file, incomplete_path)
+            else:
+                run_ffmpeg(["-i", str(audio_file), "-map", "0:a:0", "-c:a", "libmp3lame", "-b:a", bitrate,
+                            "-f", "mp3", str(incomplete_path)])
+            kept = duration
+        else:
+            write_kept_audio(audio_file, spans, incomplete_path)
+
+        with open(time_map_incomplete_path, 'w', encoding='utf-8') as f:
+            json.dump({'duration': duration, 'trimmed_duration': kept, 'spans': [list(span) for span in spans]}, f)
+        time_map_incomplete_path.replace(time_map_file)
+        incomplete_path.replace(trimmed_audio_file)
+        logger.info("Trimmed %s to %.1f of %.1f minutes (%.0f%% silence cut).", audio_file.stem, kept / 60,
+                    duration / 60, 100 * (1 - kept / duration) if duration else 0)
+        return trimmed_audio_file
+    except Exception as e:
+        logger.error("Failed to trim silence from %s: %s", audio_file, e)
+        for path in [incomplete_path, time_map_incomplete_path]:
+            if path.exists():
+                path.unlink()
+        raise
@@ -1,103 +1,182 @@
 import colorsys
 import json
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-import matplotlib.pyplot as plt
-import nltk
-import numpy as np
-from nltk.corpus import stopwords
-from wordcloud import WordCloud
+from treebloomer.processes.transcript_store import load_text
 
-nltk.download('stopwords', quiet=True)
+if TYPE_CHECKING:
+    import numpy as np
 
 logger = logging.getLogger(__name__)
+
+custom_stop_words = {
+    'um', 'uh', 'like', 'you know', 'I mean'
+}
+
+# max_font_size used to be 10000, which made the layout walk the first word down one point at a
+# time from 10000. No word can be drawn taller than the canvas, so the canvas height is the upper
+# bound; render_cloud then bisects for the size the first word actually fits at (first_font_size)
+# and starts the layout there, which lands on exactly the same sizes and layout.
+wordcloud_options = dict(width=1000, height=1000,
+                         background_color='black',
+                         min_font_size=6,
+                         max_font_size=1000,
+                         random_state=42)
+
+palette = [
+    (75, 0, 130),   # Indigo
+    (0, 255, 255),  # Cyan
+    (255, 0, 255),  # Magenta
+]
+
+@lru_cache(maxsize=1)
+def color_table() -> 'np.ndarray':
+    import numpy as np
+    # RGB per font size, 0..max_font_size: the palette interpolated in HSV space from size 10 to 100
+    # (smaller sizes get the first color, larger ones the last).
+    hsv_colors = np.array([colorsys.rgb_to_hsv(r/255, g/255, b/255) for r, g, b in palette])
+    sizes = np.arange(wordcloud_options['max_font_size'] + 1)
+    t = np.clip((sizes - 10) / (100 - 10), 0, 1)
+    stops = np.linspace(0, 1, len(palette))
+    hsv = np.stack([np.interp(t, stops, hsv_colors[:, channel]) for channel in range(3)], axis=1)
+    return np.array([[int(x * 255) for x in colorsys.hsv_to_rgb(*row)] for row in hsv], dtype=np.uint8)
+
 def color_func(word, font_size, position, orientation, random_state=None, **kwargs):
-    colors = [
-        (75, 0, 130),   # Indigo
-        (0, 255, 255),  # Cyan
-        (255, 0, 255),  # Magenta
-    ]
-    
-    # Normalize the colors to [0, 1] range
-    colors = [(r/255, g/255, b/255) for r, g, b in colors]
-    
-    # Use HSV color space for smooth transitions
-    hsv_colors = [colorsys.rgb_to_hsv(*color) for color in colors]
-    
-    # Interpolate between colors based on font size
-    t = (font_size - 10) / (100 - 10)  # Assuming font sizes range from 10 to 100
-    t = max(0, min(t, 1))  # Clamp t between 0 and 1
-    
-    index = int(t * (len(hsv_colors) - 1))
-    remainder = t * (len(hsv_colors) - 1) - index
-    
-    if index == len(hsv_colors) - 1:
-        hsv = hsv_colors[-1]
-    else:
-        hsv1, hsv2 = hsv_colors[index], hsv_colors[index + 1]
-        h = (1 - remainder) * hsv1[0] + remainder * hsv2[0]
-        s = (1 - remainder) * hsv1[1] + remainder * hsv2[1]
-        v = (1 - remainder) * hsv1[2] + remainder * hsv2[2]
-        hsv = (h, s, v)
-    
-    rgb = colorsys.hsv_to_rgb(*hsv)
-    return tuple(int(x * 255) for x in rgb)
+    table = color_table()
+    return tuple(int(x) for x in table[min(max(int(font_size), 0), len(table) - 1)])
+
+@lru_cache(maxsize=1)
+def circular_mask() -> 'np.ndarray':
+    import numpy as np
+    x, y = np.ogrid[:wordcloud_options['height'], :wordcloud_options['width']]
+    mask = (x - 500) ** 2 + (y - 500) ** 2 > 400 ** 2
+    return 255 * mask.astype(np.uint8)
+
+@lru_cache(maxsize=1)
+def stop_words() -> frozenset:
+    import nltk
+    from nltk.corpus import stopwords
+    try:
+        english = stopwords.words('english')
+    except LookupError:
+        # only reach for the network when the corpus isn't installed yet
+        nltk.download('stopwords', quiet=True)
+        english = stopwords.words('english')
+    return frozenset(english) | custom_stop_words
+
+def _init_worker():
+    # build the shared state once per worker instead of once per leaf
+    color_table()
+    circular_mask()
+    stop_words()
 
-def generate_word_cloud(input_file: Path, subfolder: Path) -> Path:
-    logger.info(f"Generating word cloud for {input_file.stem}...")
+def terms_path(output_file: Path) -> Path:
+    # <stem>.terms.json next to <stem>.wordcloud.png: the leaf's term counts after stopwords and
+    # collocations, i.e. exactly what its cloud was drawn from. Folder clouds merge these.
+    return output_file.with_name(output_file.name.replace('.wordcloud.png', '.terms.json'))
+
+def term_counts(text: str) -> Dict[str, int]:
+    from wordcloud import WordCloud
+    return WordCloud(stopwords=set(stop_words()), **wordcloud_options).process_text(text)
+
+def write_term_counts(counts: Dict[str, int], path: Path) -> None:
+    incomplete_path = path.with_name(path.name + '.incomplete')
+    with open(incomplete_path, 'w', encoding='utf-8') as f:
+        json.dump(counts, f, separators=(',', ':'))
+    incomplete_path.replace(path)
+
+def first_font_size(wordcloud, counts: Dict[str, int]) -> int:
+    # Where to start WordCloud's layout so it lands where stepping down one point at a time from
+    # max_font_size would. The first word ends up at the largest size at which it fits the mask
+    # horizontally; whether a box fits only gets easier as it shrinks, so that size is bisected for.
+    # The layout starts one point above it: that try fails in both orientations, exactly like the
+    # long descent did, and the word is placed horizontally at the same size. Failed placements
+    # don't draw on the layout's random state, and this uses a throwaway one, so the layout is unchanged.
+    from random import Random
+    from PIL import Image, ImageDraw, ImageFont
+    from wordcloud.wordcloud import IntegralOccupancyMap
+
+    word = sorted(counts.items(), key=lambda item: item[1], reverse=True)[0][0]
+    mask = wordcloud._get_bolean_mask(wordcloud.mask)
+    occupancy = IntegralOccupancyMap(mask.shape[0], mask.shape[1], mask)
+    draw = ImageDraw.Draw(Image.new("L", (mask.shape[1], mask.shape[0])))
+    random_state = Random(0)
+
+    def fits(font_size: int) -> bool:
+        font = ImageFont.TransposedFont(ImageFont.truetype(wordcloud.font_path, font_size), orientation=None)
+        box = draw.textbbox((0, 0), word, font=font, anchor="lt")
+        return occupancy.sample_position(box[3] + wordcloud.margin, box[2] + wordcloud.margin,
+                                         random_state) is not None
+
+    low, high = wordcloud.min_font_size, wordcloud.max_font_size
+    if not fits(low) or fits(high):
+        return high
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low + 1
+
+def render_cloud(counts: Dict[str, int], output_file: Path) -> Path:
+    from wordcloud import WordCloud
+    wordcloud = WordCloud(stopwords=set(stop_words()), color_func=color_func, mask=circular_mask(),
+                          **wordcloud_options)
+    wordcloud.generate_from_frequencies(counts, max_font_size=first_font_size(wordcloud, counts) if counts else None)
+    wordcloud.to_file(str(output_file))
+    return output_file
+
+def stage_config() -> dict:
+    return {'custom_stop_words': sorted(custom_stop_words), 'wordcloud_options': wordcloud_options,
+            'palette': palette, 'renderer': 'pil'}
+
+def generate_word_cloud(input_file: Path, subfolder: Path, force: bool = False) -> Path:
+    logger.info("Generating word cloud for %s...", input_file.stem)
     
     original_stem = input_file.stem.rsplit('.', 1)[0]
     output_file = subfolder / f"{original_stem}.wordcloud.png"
+    counts_file = terms_path(output_file)
     
-    if output_file.exists():
-        logger.info(f"Word cloud file {output_file} already exists. Skipping generation.")
+    if output_file.exists() and not force:
+        logger.info("Word cloud file %s already exists. Skipping generation.", output_file)
         return output_file
     
     try:
-        # Read the transcript JSON
-        with open(input_file, 'r') as file:
-            transcript_data = json.load(file)
-        
-        # Extract the text from the transcript
-        text = transcript_data['text']
-        
-        # Get the set of stopwords
-        stop_words = set(stopwords.words('english'))
-        custom_stop_words = {
-            'um', 'uh', 'like', 'you know', 'I mean'
-        }
-        stop_words.update(custom_stop_words)
-        
-        # Generate the word cloud
-        x, y = np.ogrid[:1000, :1000]
-        mask = (x - 500) ** 2 + (y - 500) ** 2 > 400 ** 2
-        mask = 255 * mask.astype(int)
-        
-        wordcloud = WordCloud(width=1000, height=1000, 
-                              background_color='black', 
-                              stopwords=stop_words,
-                              min_font_size=6,
-                              max_font_size=10000,
-                              color_func=color_func,
-                              mask=mask,
-                              random_state=42).generate(text)
-        
-        # Display the generated image
-        plt.figure(figsize=(10,10), facecolor='black')
-        plt.imshow(wordcloud)
-        plt.axis("off")
-        plt.tight_layout(pad=0)
+        # Read the transcript text (from the columnar sidecar when there is one)
+        text = load_text(input_file)
         
-        # Save the image
-        plt.savefig(output_file, bbox_inches='tight', facecolor='black')
-        plt.close()
+        # Count terms (this is what WordCloud.generate does internally) and keep the counts for the
+        # folder clouds, then lay out and save the image straight from them, no matplotlib in between
+        counts = term_counts(text)
+        write_term_counts(counts, counts_file)
+        render_cloud(counts, output_file)
         
-        logger.info(f"Generated word cloud at {output_file}.")
+        logger.info("Generated word cloud at %s.", output_file)
         return output_file
     except Exception as e:
-        logging.error(f"Failed to generate word cloud for {input_file}: {e}")
-        if output_file.exists():
-            output_file.unlink()
+        logging.error("Failed to generate word cloud for %s: %s", input_file, e)
+        for path in [output_file, counts_file]:
+            if path.exists():
+                path.unlink()
         raise
 
+def generate_word_clouds(jobs: List[Tuple[Path, Path, bool]], workers: int = 1) -> List[Optional[Path]]:
+    # Batch mode: (transcript, subfolder, force) jobs rendered across worker processes that each
+    # build the mask, stopwords and color table once. Failed jobs come back as None.
+    if workers <= 1:
+        _init_worker()
+        results = []
+        for job in jobs:
+            try:
+                results.append(generate_word_cloud(*job))
+            except Exception:
+                results.append(None)
+        return results
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        futures = [pool.submit(generate_word_cloud, *job) for job in jobs]
+        return [None if future.exception() else future.result() for future in futures]
@@ -0,0 +1,202 @@
+import logging
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from treebloomer import telemetry
+from treebloomer.manifest import config_hashes, expected_entries, load_manifest, record_stage, save_manifest, stale_stages
+from treebloomer.processes import FUSED_AUDIO_STAGES, STAGES, Stage, resolve, with_silence_trimming
+
+logger = logging.getLogger(__name__)
+
+
+def build_stages(fused_audio: bool = False, trim_silence: bool = False) -> List[Stage]:
+    stages = FUSED_AUDIO_STAGES if fused_audio else STAGES
+    return with_silence_trimming(stages) if trim_silence else stages
+
+
+class LeafRun:
+    def __init__(self, video_file: Path, stages: List[Stage] = STAGES, configs: Optional[Dict[str, str]] = None):
+        self.video_file = video_file
+        self.stages = stages
+        self.configs = configs
+        self.subfolder = video_file.parent / video_file.stem
+        self.outputs: Dict[str, Path] = {}
+        self.running: set = set()
+        self.error: Optional[Exception] = None
+        self.manifest: dict = {}
+        self.expected: Dict[str, dict] = {}
+        self.stale: List[str] = []
+
+    def prepare(self) -> bool:
+        # Returns False when the manifest says every stage is already up to date.
+        self.subfolder.mkdir(exist_ok=True)
+        self.manifest = load_manifest(self.video_file)
+        self.expected = expected_entries(self.video_file, self.stages, self.configs)
+        self.stale = stale_stages(self.manifest, self.expected, self.stages)
+        recorded = self.manifest.get('stages', {})
+        if self.stale:
+            logger.info("Stale stages for %s: %s", self.video_file, ', '.join(self.stale))
+        return bool(self.stale) or any(stage.name not in recorded for stage in self.stages)
+
+    def complete(self, stage: Stage, output_file: Path):
+        self.outputs[stage.name] = output_file
+        record_stage(self.manifest, stage.name, self.expected[stage.name], output_file)
+        save_manifest(self.video_file, self.manifest)
+
+    def stage_input(self, stage: Stage) -> Path:
+        return self.video_file if stage.input_stage is None else self.outputs[stage.input_stage]
+
+    def ready_stages(self) -> List[Stage]:
+        if self.error is not None:
+            return []
+        return [stage for stage in self.stages
+                if stage.name not in self.outputs
+                and stage.name not in self.running
+                and all(req in self.outputs for req in stage.requires)]
+
+    @property
+    def finished(self) -> bool:
+        return self.error is not None or len(self.outputs) == len(self.stages)
+
+
+def _init_worker(level: int, fmt: str, telemetry_settings: Optional[dict] = None):
+    # spawned workers (Windows, macOS) don't inherit the parent's logging or telemetry setup
+    logging.basicConfig(level=level, format=fmt)
+    if telemetry_settings and not telemetry.enabled:
+        telemetry.configure(**telemetry_settings)
+
+
+def run_stage(stage: Stage, input_file: Path, subfolder: Path, stage_options: Optional[Dict[str, dict]] = None,
+              force: bool = False) -> Path:
+    options = (stage_options or {}).get(stage.name, {})
+    if force:
+        options = dict(options, force=True)
+    if not telemetry.enabled:
+        return stage.func(input_file, subfolder, **options)
+    with telemetry.stage_span(stage.name, subfolder, input_file) as span:
+        span['file'] = stage.func(input_file, subfolder, **options)
+    return span['file']
+
+
+def run_leaf(video_file: Path, stage_options: Optional[Dict[str, dict]] = None,
+             stages: List[Stage] = STAGES) -> Dict[str, Path]:
+    leaf = LeafRun(video_file, stages)
+    if not leaf.prepare():
+        logger.info("%s is up to date, skipping...", video_file)
+        return leaf.outputs
+    for stage in stages:
+        leaf.complete(stage, run_stage(stage, leaf.stage_input(stage), leaf.subfolder, stage_options,
+                                       force=stage.name in leaf.stale))
+    return leaf.outputs
+
+
+def run_pipeline(video_files: List[Path], jobs: int = 1, api_concurrency: int = 1,
+                 stage_options: Optional[Dict[str, dict]] = None,
+                 stages: List[Stage] = STAGES,
+                 log_format: str = logging.BASIC_FORMAT,
+                 on_leaf_done: Optional[Callable[[Path, Optional[Exception]], None]] = None,
+                 on_leaf_start: Optional[Callable[[Path], None]] = None) -> Dict[Path, Optional[Exception]]:
+    pools = {
+        'cpu': ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                   initargs=(logging.getLogger().level, log_format,
+                                             telemetry.worker_settings())),
+        'api': ThreadPoolExecutor(max_workers=api_concurrency, thread_name_prefix='treebloomer-api'),
+    }
+    # Only keep a limited number of leaves in flight so the pools work on finishing leaves
+    # instead of queueing every extract_audio in the tree ahead of everything else.
+    window = 2 * (jobs + api_concurrency)
+    if on_leaf_start is not None:
+        # on_leaf_start may block (a remote leaf's download), so it runs off the scheduling thread
+        pools['start'] = ThreadPoolExecutor(max_workers=window, thread_name_prefix='treebloomer-start')
+    configs = config_hashes(stages)
+    queued = deque(video_files)
+    active: List[LeafRun] = []
+    futures = {}
+    results: Dict[Path, Optional[Exception]] = {}
+
+    def submit_ready(leaf: LeafRun):
+        for stage in leaf.ready_stages():
+            future = pools[stage.pool].submit(run_stage, stage, leaf.stage_input(stage), leaf.subfolder,
+                                              stage_options, stage.name in leaf.stale)
+            leaf.running.add(stage.name)
+            futures[future] = (leaf, stage)
+
+    def admit():
+        while queued and len(active) < window:
+            leaf = LeafRun(queued.popleft(), stages, configs)
+            logger.info("Processing %s", leaf.video_file)
+            try:
+                if not leaf.prepare():
+                    logger.info("%s is up to date, skipping...", leaf.video_file)
+                    results[leaf.video_file] = None
+                    continue
+            except OSError as e:
+                logger.error("Failed to process %s: %s", leaf.video_file, e)
+                results[leaf.video_file] = e
+                continue
+            active.append(leaf)
+            if on_leaf_start is not None:
+                futures[pools['start'].submit(on_leaf_start, leaf.video_file)] = (leaf, None)
+            else:
+                submit_ready(leaf)
+
+    try:
+        admit()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                leaf, stage = futures.pop(future)
+                if stage is None:
+                    # on_leaf_start finished; any error fails this leaf only
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error("Failed to start %s: %s", leaf.video_file, e)
+                        leaf.error = e
+                else:
+                    leaf.running.discard(stage.name)
+                    try:
+                        leaf.complete(stage, future.result())
+                    except Exception as e:
+                        logger.error("Failed to process %s at %s: %s", leaf.video_file, stage.name, e)
+                        leaf.error = e
+                if leaf.finished and not leaf.running:
+                    active.remove(leaf)
+                    results[leaf.video_file] = leaf.error
+                    if on_leaf_done is not None:
+                        on_leaf_done(leaf.video_file, leaf.error)
+                else:
+                    submit_ready(leaf)
+            admit()
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    return results
+
+
+def render_word_clouds(video_files: List[Path], stages: List[Stage] = STAGES, workers: int = 1) -> int:
+    # Re-render pass for word clouds only: every leaf with a transcript whose word cloud is missing
+    # or stale, batched across worker processes that share their precomputed state.
+    configs = config_hashes(stages)
+    leaves, jobs = [], []
+    for video_file in video_files:
+        leaf = LeafRun(video_file, stages, configs)
+        leaf.prepare()
+        transcript_file = leaf.subfolder / f"{video_file.stem}.transcript.json"
+        recorded = leaf.manifest.get('stages', {}).get('generate_word_cloud')
+        if not transcript_file.exists() or (recorded is not None and 'generate_word_cloud' not in leaf.stale):
+            continue
+        leaves.append(leaf)
+        # unrecorded clouds from older runs are adopted like in a normal run rather than redrawn
+        jobs.append((transcript_file, leaf.subfolder, recorded is not None))
+    logger.info("Rendering %s word clouds with %s workers...", len(jobs), workers)
+    rendered = 0
+    stage = next(stage for stage in stages if stage.name == 'generate_word_cloud')
+    for leaf, output_file in zip(leaves, resolve('.word_cloud_generation:generate_word_clouds')(jobs, workers)):
+        if output_file is not None:
+            leaf.complete(stage, output_file)
+            rendered += 1
+    return rendered
@@ -0,0 +1,170 @@
+import logging
+import os
+import sqlite3
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+from treebloomer import artifact_cache
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = '.treebloomer_search.sqlite'
+SCHEMA_VERSION = 1
+# Segment rows are numbered leaf_id * SEGMENT_STRIDE + segment index, so a leaf's segments can be
+# replaced through a rowid range instead of a scan of the whole FTS table.
+SEGMENT_STRIDE = 1_000_000
+
+schema = """
+CREATE TABLE IF NOT EXISTS leaves (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    transcript_stat TEXT,
+    summary_stat TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS segments USING fts5(
+    text, start UNINDEXED, end UNINDEXED, tokenize='porter unicode61'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS summaries USING fts5(
+    sentence_summary, paragraph_summary, page_summary, topics, keywords, tokenize='porter unicode61'
+);
+"""
+
+
+class Hit(NamedTuple):
+    video_file: Path
+    kind: str
+    start: Optional[float]
+    end: Optional[float]
+    snippet: str
+    score: float
+
+    @property
+    def link(self) -> str:
+        page = self.video_file.parent / self.video_file.stem / f"{self.video_file.stem}.html"
+        return page.as_posix() + (f"#t={self.start:.2f}" if self.start is not None else "")
+
+
+def connect(root: Path) -> sqlite3.Connection:
+    connection = sqlite3.connect(root / DB_NAME)
+    connection.execute("PRAGMA journal_mode=WAL")
+    if connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        connection.executescript("DROP TABLE IF EXISTS leaves; DROP TABLE IF EXISTS segments; "
+                                 "DROP TABLE IF EXISTS summaries;")
+        connection.executescript(schema)
+        connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    return connection
+
+def _stat(path: Path) -> Optional[str]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def _load(path: Path) -> Optional[dict]:
+    try:
+        return artifact_cache.load_json(path)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not index %s: %s", path, e)
+        return None
+
+def _load_transcript(path: Path) -> Optional[dict]:
+    from treebloomer.processes.transcript_store import load_segments
+    try:
+        return load_segments(path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("Could not index %s: %s", path, e)
+        return None
+
+def _index_leaf(connection: sqlite3.Connection, root: Path, video_file: Path) -> bool:
+    subfolder = video_file.parent / video_file.stem
+    transcript_file = subfolder / f"{video_file.stem}.transcript.json"
+    summary_file = subfolder / f"{video_file.stem}.summaries.json"
+    key = video_file.relative_to(root).as_posix()
+    transcript_stat, summary_stat = _stat(transcript_file), _stat(summary_file)
+
+    row = connection.execute("SELECT id, transcript_stat, summary_stat FROM leaves WHERE path = ?", (key,)).fetchone()
+    if row is None:
+        leaf_id = connection.execute("INSERT INTO leaves (path) VALUES (?)", (key,)).lastrowid
+        row = (leaf_id, None, None)
+    leaf_id = row[0]
+    changed = False
+
+    if row[1] != transcript_stat:
+        connection.execute("DELETE FROM segments WHERE rowid BETWEEN ? AND ?",
+                           (leaf_id * SEGMENT_STRIDE, (leaf_id + 1) * SEGMENT_STRIDE - 1))
+        transcript = _load_transcript(transcript_file) if transcript_stat else None
+        if transcript is not None:
+            segments = transcript.get('segments') or [{'text': transcript.get('text', ''), 'start': None, 'end': None}]
+            connection.executemany("INSERT INTO segments (rowid, text, start, end) VALUES (?, ?, ?, ?)", [
+                (leaf_id * SEGMENT_STRIDE + index, segment['text'].strip(), segment.get('start'), segment.get('end'))
+                for index, segment in enumerate(segments[:SEGMENT_STRIDE])
+            ])
+        connection.execute("UPDATE leaves SET transcript_stat = ? WHERE id = ?", (transcript_stat, leaf_id))
+        changed = True
+
+    if row[2] != summary_stat:
+        connection.execute("DELETE FROM summaries WHERE rowid = ?", (leaf_id,))
+        summary = _load(summary_file) if summary_stat else None
+        if summary is not None:
+            connection.execute("INSERT INTO summaries (rowid, sentence_summary, paragraph_summary, page_summary, "
+                               "topics, keywords) VALUES (?, ?, ?, ?, ?, ?)", (
+                leaf_id, summary.get('sentence_summary', ''), summary.get('paragraph_summary', ''),
+                summary.get('page_summary', ''), "\n".join(summary.get('topics', [])),
+                "\n".join(summary.get('keywords', [])),
+            ))
+        connection.execute("UPDATE leaves SET summary_stat = ? WHERE id = ?", (summary_stat, leaf_id))
+        changed = True
+    return changed
+
+def _remove_leaf(connection: sqlite3.Connection, leaf_id: int) -> None:
+    connection.execute("DELETE FROM segments WHERE rowid BETWEEN ? AND ?",
+                       (leaf_id * SEGMENT_STRIDE, (leaf_id + 1) * SEGMENT_STRIDE - 1))
+    connection.execute("DELETE FROM summaries WHERE rowid = ?", (leaf_id,))
+    connection.execute("DELETE FROM leaves WHERE id = ?", (leaf_id,))
+
+def update_index(root: Path, video_files: List[Path], prune: bool = False) -> int:
+    # Re-indexes the leaves whose transcript or summary changed size or mtime since they were last
+    # indexed. With prune, leaves that are no longer in video_files are dropped from the index.
+    connection = connect(root)
+    try:
+        with connection:
+            updated = sum(_index_leaf(connection, root, video_file) for video_file in video_files)
+            removed = 0
+            if prune:
+                keep = {video_file.relative_to(root).as_posix() for video_file in video_files}
+                for leaf_id, key in connection.execute("SELECT id, path FROM leaves").fetchall():
+                    if key not in keep:
+                        _remove_leaf(connection, leaf_id)
+                        removed += 1
+        if updated or removed:
+            logger.info("Search index: updated %s leaves, removed %s", updated, removed)
+        return updated
+    finally:
+        connection.close()
+
+def fts_query(text: str) -> str:
+    # plain words are quoted so punctuation in them can't be read as FTS5 syntax
+    return " ".join('"' + term.replace('"', '""') + '"' for term in text.split())
+
+def search(root: Path, query: str, limit: int = 20, raw: bool = False) -> List[Hit]:
+    match = query if raw else fts_query(query)
+    if not match:
+        return []
+    connection = connect(root)
+    try:
+        summary_hits = connection.execute(
+            "SELECT leaves.path, snippet(summaries, -1, '[', ']', '...', 16), bm25(summaries) "
+            "FROM summaries JOIN leaves ON leaves.id = summaries.rowid "
+            "WHERE summaries MATCH ? ORDER BY rank LIMIT ?", (match, limit)).fetchall()
+        segment_hits = connection.execute(
+            "SELECT leaves.path, segments.start, segments.end, snippet(segments, 0, '[', ']', '...', 16), "
+            "bm25(segments) FROM segments JOIN leaves ON leaves.id = segments.rowid / ? "
+            "WHERE segments MATCH ? ORDER BY rank LIMIT ?", (SEGMENT_STRIDE, match, limit)).fetchall()
+    finally:
+        connection.close()
+    hits = [Hit(root / path, 'summary', None, None, snippet, score) for path, snippet, score in summary_hits]
+    hits += [Hit(root / path, 'transcript', start, end, snippet, score)
+             for path, start, end, snippet, score in segment_hits]
+    # bm25 is lower-is-better
+    return sorted(hits, key=lambda hit: hit.score)[:limit]
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+
+from treebloomer import artifact_cache
+from treebloomer.processes.html_page_generation import index_template, template_environment
+from treebloomer.tree_scan import VIDEO_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+STATE_NAME = '.treebloomer_site.json'
+INDEX_FILE = 'index.html'
+
+# Every directory on the way from the root to a leaf gets an index.html linking its subfolders'
+# indexes and its own leaves' pages. The state file records, per directory, a digest of what its
+# index shows (leaf page/summary stats, subfolder names and counts, the template), so a rerun only
+# re-renders the directories whose digest moved; everything else costs one stat per leaf.
+
+def load_state(root: Path) -> dict:
+    try:
+        with open(root / STATE_NAME, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_state(root: Path, state: dict) -> None:
+    path = root / STATE_NAME
+    incomplete_path = path.with_name(path.name + '.incomplete')
+    with open(incomplete_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    incomplete_path.replace(path)
+
+def _leaf_stat(video_file: Path) -> list:
+    subfolder = video_file.parent / video_file.stem
+    stats = []
+    for name in (f"{video_file.stem}.html", f"{video_file.stem}.summaries.json"):
+        try:
+            stat = os.stat(subfolder / name)
+            stats.append([stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            stats.append(None)
+    return stats
+
+def _leaf_context(video_file: Path) -> dict:
+    subfolder = video_file.parent / video_file.stem
+    context = {'title': video_file.stem, 'href': f"{video_file.stem}/{video_file.stem}.html",
+               'sentence_summary': '', 'topics': []}
+    try:
+        data = artifact_cache.load_json(subfolder / f"{video_file.stem}.summaries.json")
+        context['sentence_summary'] = data.get('sentence_summary', '')
+        context['topics'] = data.get('topics', [])
+    except (OSError, ValueError) as e:
+        logger.warning("No summary for %s in the index: %s", video_file, e)
+    return context
+
+def _write(path: Path, content: str) -> None:
+    incomplete_path = path.with_name(path.name + '.incomplete')
+    with open(incomplete_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    incomplete_path.replace(path)
+
+def directory_tree(root: Path, leaf_directories: Iterable[Path]) -> Tuple[Set[Path], Dict[Path, List[Path]]]:
+    # Every directory from the root down to one holding leaves, and each one's subdirectories among them.
+    directories = {root}
+    for directory in leaf_directories:
+        directories.add(directory)
+        directories.update(parent for parent in directory.parents if root in parent.parents or parent == root)
+    children: Dict[Path, List[Path]] = {}
+    for directory in directories:
+        if directory != root:
+            children.setdefault(directory.parent, []).append(directory)
+    return directories, children
+
+def has_videos(directory: Path) -> bool:
+    for _, _, files in os.walk(directory):
+        if any(name.endswith(VIDEO_SUFFIX) for name in files):
+            return True
+    return False
+
+def gone_directories(root: Path, previous: dict, state: dict, failed: Set[str] = frozenset()) -> List[str]:
+    # Directories the previous run wrote files for and this one didn't. Only those that are gone or
+    # have no video left anywhere under them are returned for their files to be removed; the rest were
+    # just outside this run's selection (a narrower --exclude, a subset of the tree) and keep their
+    # files and their state entry.
+    gone = []
+    for key in set(previous) - set(state) - set(failed):
+        if has_videos(root / key):
+            state[key] = previous[key]
+        else:
+            gone.append(key)
+    return gone
+
+def build_site_index(root: Path, video_files: List[Path], force: bool = False) -> int:
+    # Leaves without a rendered page yet are left out until a later run renders them.
+    leaves: Dict[Path, List[Path]] = {}
+    stats: Dict[Path, list] = {}
+    for video_file in video_files:
+        leaf_stat = _leaf_stat(video_file)
+        if leaf_stat[0] is None:
+            continue
+        stats[video_file] = leaf_stat
+        leaves.setdefault(video_file.parent, []).append(video_file)
+
+    directories, children = directory_tree(root, leaves)
+
+    # deepest first, so subfolder counts are known before their parent is digested
+    counts: Dict[Path, int] = {}
+    for directory in sorted(directories, key=lambda directory: len(directory.parts), reverse=True):
+        counts[directory] = len(leaves.get(directory, [])) + sum(counts[child] for child in children.get(directory, []))
+
+    template_hash = hashlib.sha256(index_template.encode('utf-8')).hexdigest()
+    previous = load_state(root)
+    state = {}
+    failed = set()
+    rendered = 0
+    template = None
+    for directory in sorted(directories):
+        key = directory.relative_to(root).as_posix()
+        directory_leaves = sorted(leaves.get(directory, []))
+        folders = sorted(children.get(directory, []))
+        digest = hashlib.sha256(json.dumps([
+            template_hash,
+            [[video_file.name, stats[video_file]] for video_file in directory_leaves],
+            [[folder.name, counts[folder]] for folder in folders],
+        ]).encode('utf-8')).hexdigest()
+        state[key] = digest
+        if not force and previous.get(key) == digest and (directory / INDEX_FILE).exists():
+            continue
+        if template is None:
+            template = template_environment().get_template('index.html')
+        try:
+            _write(directory / INDEX_FILE, template.render(
+                title=key if key != '.' else root.resolve().name,
+                parent=directory != root,
+                folders=[{'name': folder.name, 'count': counts[folder]} for folder in folders],
+                leaves=[_leaf_context(video_file) for video_file in directory_leaves],
+            ))
+            rendered += 1
+        except OSError as e:
+            logger.error("Failed to write the index of %s: %s", directory, e)
+            del state[key]
+            failed.add(key)
+
+    # directories that no longer hold any leaf lose the index we generated for them
+    for key in gone_directories(root, previous, state, failed):
+        (root / key / INDEX_FILE).unlink(missing_ok=True)
+
+    save_state(root, state)
+    logger.info("Rendered %s of %s directory indexes", rendered, len(directories))
+    return rendered
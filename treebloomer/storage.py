@@ -0,0 +1,459 @@
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from treebloomer.manifest import config_hashes, leaf_status
+from treebloomer.tree_scan import INDEX_NAME, VIDEO_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+MIRROR_NAME = '.treebloomer_mirror.json'
+
+# A tree on object storage (any fsspec URL: s3://, gs://, memory://, file://) is worked on through
+# a local mirror. The crawl lists the remote tree one directory per thread and pulls every artifact
+# that changed remotely, so manifests, summaries and tree-level state are local as usual. Leaf media
+# is stood in for by sparse placeholders with the remote size and mtime, which is all the manifest
+# fingerprints, and only the leaves with work left get their media downloaded: the next
+# prefetch_leaves of them into a spill cache of at most max_spill_bytes while the current ones run,
+# large files as parallel ranged reads. A finished leaf's new artifacts are queued for a background
+# thread that puts them in multi-file batches. The stages themselves keep reading and writing the
+# mirror's local paths (ffmpeg and whisper need real files anyway).
+list_workers = 16
+transfer_workers = 8
+range_bytes = 16 * 1024 * 1024
+max_spill_bytes = 20 * 1024 ** 3
+prefetch_leaves = 4
+upload_batch_files = 32
+upload_batch_seconds = 5.0
+
+_STOP = object()
+
+def _mtime_ns(info: dict) -> int:
+    for key in ('mtime', 'LastModified', 'last_modified', 'updated', 'created'):
+        value = info.get(key)
+        if value is None:
+            continue
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if isinstance(value, datetime):
+            value = value.timestamp()
+        return int(float(value) * 1e9)
+    return 0
+
+def _stat(path: Path) -> Optional[list]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _join(relative: str, name: str) -> str:
+    return name if relative == '.' else f"{relative}/{name}"
+
+def _mirrored(name: str) -> bool:
+    # our per-machine state and in-progress writes stay local
+    return name not in (MIRROR_NAME, INDEX_NAME) and not name.endswith(('.incomplete', '-wal', '-shm'))
+
+def placeholder(local_path: Path, size: int, mtime_ns: int) -> None:
+    # Sparse, so it takes no space; manifests fingerprint the source by size and mtime only.
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(local_path, 'wb') as f:
+        f.truncate(size)
+    os.utime(local_path, ns=(mtime_ns, mtime_ns))
+
+class Storage:
+    # The remote tree as fsspec sees it. Paths are posix paths relative to the root.
+    def __init__(self, url: str):
+        import fsspec
+        self.url = url
+        self.fs, root = fsspec.core.url_to_fs(url)
+        self.root = root.rstrip('/')
+
+    def full_path(self, relative: str) -> str:
+        return self.root if relative == '.' else f"{self.root}/{relative}"
+
+    def listdir(self, relative: str) -> Tuple[List[str], Dict[str, list]]:
+        path = self.full_path(relative)
+        self.fs.invalidate_cache(path)
+        subdirs, files = [], {}
+        for info in self.fs.ls(path, detail=True):
+            name = info['name'].rstrip('/').rsplit('/', 1)[-1]
+            if info['type'] == 'directory':
+                subdirs.append(name)
+            else:
+                files[name] = [info['size'], _mtime_ns(info)]
+        return sorted(subdirs), files
+
+    def find(self, relative: str) -> Dict[str, list]:
+        path = self.full_path(relative)
+        return {name[len(path) + 1:]: [info['size'], _mtime_ns(info)]
+                for name, info in self.fs.find(path, detail=True).items() if info['type'] != 'directory'}
+
+    def read_range(self, relative: str, start: int, end: int) -> bytes:
+        return self.fs.cat_file(self.full_path(relative), start=start, end=end)
+
+    def download(self, relative: str, local_path: Path, size: int, mtime_ns: int) -> None:
+        # Written at their offsets by up to transfer_workers ranged reads, then renamed into place
+        # with the remote mtime.
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        incomplete_path = local_path.with_name(local_path.name + '.incomplete')
+        try:
+            with open(incomplete_path, 'wb') as f:
+                f.truncate(size)
+            fd = os.open(incomplete_path, os.O_WRONLY)
+            try:
+                def fetch(start: int) -> None:
+                    data = memoryview(self.read_range(relative, start, min(start + range_bytes, size)))
+                    while data:
+                        written = os.pwrite(fd, data, start)
+                        data, start = data[written:], start + written
+
+                starts = range(0, size, range_bytes)
+                if len(starts) > 1:
+                    with ThreadPoolExecutor(max_workers=transfer_workers, thread_name_prefix='treebloomer-range') as pool:
+                        list(pool.map(fetch, starts))
+                else:
+                    for start in starts:
+                        fetch(start)
+            finally:
+                os.close(fd)
+            os.utime(incomplete_path, ns=(mtime_ns, mtime_ns))
+            incomplete_path.replace(local_path)
+        except BaseException:
+            incomplete_path.unlink(missing_ok=True)
+            raise
+
+    def put(self, pairs: List[Tuple[Path, str]]) -> None:
+        # one call for the whole batch; object store backends send the files concurrently
+        for parent in sorted({posixpath.dirname(self.full_path(relative)) for _, relative in pairs}):
+            self.fs.makedirs(parent, exist_ok=True)
+        self.fs.put([str(local_path) for local_path, _ in pairs], [self.full_path(relative) for _, relative in pairs])
+
+class SpillCache:
+    # Leaf media in the mirror, at most max_bytes of it counting downloads in flight. Only media
+    # whose leaf is done can be evicted - put back to a placeholder, least recently released first -
+    # so a prefetch never pushes out one that's waiting to be processed.
+    def __init__(self, storage: Storage, mirror: Path, max_bytes: int = max_spill_bytes):
+        self.storage = storage
+        self.mirror = mirror
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.resident: Dict[str, list] = {}
+        self.released: 'OrderedDict[str, list]' = OrderedDict()
+        self.pending: Dict[str, Future] = {}
+        self.pinned: Dict[str, int] = {}
+        self.total = 0
+        self.pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='treebloomer-prefetch')
+
+    def _make_room(self, size: int) -> bool:
+        while self.released and self.total + size > self.max_bytes:
+            relative, stat = self.released.popitem(last=False)
+            del self.resident[relative]
+            self.total -= stat[0]
+            placeholder(self.mirror / relative, *stat)
+        # something bigger than the whole cache still goes through, on its own
+        return self.total + size <= self.max_bytes or self.total == 0
+
+    def _download(self, relative: str, stat: list) -> None:
+        logger.info("Downloading %s (%.1f MB)...", relative, stat[0] / 1e6)
+        try:
+            self.storage.download(relative, self.mirror / relative, *stat)
+        except BaseException as e:
+            logger.warning("Could not download %s: %s", relative, e)
+            with self.lock:
+                self.pending.pop(relative, None)
+                self.total -= stat[0]
+            raise
+        with self.lock:
+            self.pending.pop(relative, None)
+            self.resident[relative] = stat
+
+    def prefetch(self, relative: str, stat: list) -> bool:
+        # False when it doesn't fit yet
+        with self.lock:
+            if relative in self.resident or relative in self.pending:
+                return True
+            if not self._make_room(stat[0]):
+                return False
+            self.total += stat[0]
+            self.pending[relative] = self.pool.submit(self._download, relative, stat)
+            return True
+
+    def fetch(self, relative: str, stat: list) -> Path:
+        with self.lock:
+            self.pinned[relative] = self.pinned.get(relative, 0) + 1
+            self.released.pop(relative, None)
+            future = self.pending.get(relative)
+            if future is None and relative not in self.resident:
+                # a leaf that's starting gets its media even past the limit rather than waiting for room
+                self._make_room(stat[0])
+                self.total += stat[0]
+                future = self.pending[relative] = self.pool.submit(self._download, relative, stat)
+        try:
+            if future is not None:
+                future.result()
+        except BaseException:
+            self.release(relative)
+            raise
+        return self.mirror / relative
+
+    def release(self, relative: str) -> None:
+        with self.lock:
+            count = self.pinned.pop(relative, 0) - 1
+            if count > 0:
+                self.pinned[relative] = count
+            elif relative in self.resident:
+                self.released[relative] = self.resident[relative]
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+class RemoteTree:
+    def __init__(self, url: str, mirror: Optional[Path] = None, spill_bytes: int = max_spill_bytes):
+        self.storage = Storage(url)
+        self.mirror = mirror or Path(tempfile.gettempdir()) / (
+            'treebloomer-' + hashlib.sha256(url.encode('utf-8')).hexdigest()[:12])
+        self.mirror.mkdir(parents=True, exist_ok=True)
+        self.cache = SpillCache(self.storage, self.mirror, spill_bytes)
+        self.lock = threading.Lock()
+        # leaves start on the scheduler's start threads while others finish, so the download order
+        # (started, frontier) has a lock of its own
+        self.order_lock = threading.Lock()
+        # [size, mtime] of every mirrored file on both sides as of its last transfer, and of every
+        # placeholder we wrote
+        self.state = self._load_state()
+        self.videos: Dict[str, list] = {}
+        self.files: Dict[str, list] = {}
+        self.order: List[str] = []
+        self.position: Dict[str, int] = {}
+        self.started = -1
+        self.frontier = 0
+        self.failed_uploads = 0
+        self.uploads: queue.Queue = queue.Queue()
+        self.upload_thread = threading.Thread(target=self._upload_loop, name='treebloomer-upload', daemon=True)
+        self.upload_thread.start()
+
+    def _load_state(self) -> dict:
+        try:
+            with open(self.mirror / MIRROR_NAME, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'remote': {}, 'local': {}, 'placeholders': {}}
+
+    def _save_state(self) -> None:
+        # called with self.lock held
+        path = self.mirror / MIRROR_NAME
+        incomplete_path = path.with_name(path.name + '.incomplete')
+        with open(incomplete_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        incomplete_path.replace(path)
+
+    def relative(self, local_path: Path) -> str:
+        return local_path.relative_to(self.mirror).as_posix()
+
+    def scan(self, exclude: Optional[List[str]] = None) -> List[Path]:
+        # Breadth-first with every directory listed on its own thread: an object store listing is a
+        # round trip per prefix, so siblings are listed concurrently. Leaf artifact folders are
+        # listed recursively in the same pool.
+        exclude_set = set(exclude or [])
+        self.videos, self.files = {}, {}
+        unlisted = []
+        with ThreadPoolExecutor(max_workers=list_workers, thread_name_prefix='treebloomer-list') as pool:
+            futures = {pool.submit(self.storage.listdir, '.'): ('.', False)}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    relative, artifacts = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except OSError as e:
+                        logger.warning("Could not list %s: %s", relative, e)
+                        unlisted.append('' if relative == '.' else relative + '/')
+                        continue
+                    if artifacts:
+                        self.files.update((_join(relative, name), stat) for name, stat in result.items()
+                                          if _mirrored(posixpath.basename(name)))
+                        continue
+                    subdirs, files = result
+                    leaves = set()
+                    for name, stat in files.items():
+                        if name in exclude_set:
+                            continue
+                        if name.endswith(VIDEO_SUFFIX):
+                            self.videos[_join(relative, name)] = stat
+                            leaves.add(name[:-len(VIDEO_SUFFIX)])
+                        elif _mirrored(name):
+                            self.files[_join(relative, name)] = stat
+                    for name in subdirs:
+                        if name in exclude_set or name.startswith('.treebloomer_'):
+                            continue
+                        if name in leaves:
+                            futures[pool.submit(self.storage.find, _join(relative, name))] = (_join(relative, name), True)
+                        else:
+                            futures[pool.submit(self.storage.listdir, _join(relative, name))] = (_join(relative, name), False)
+
+        with ThreadPoolExecutor(max_workers=transfer_workers, thread_name_prefix='treebloomer-pull') as pool:
+            pulled = sum(pool.map(lambda item: self._pull(*item), self.files.items()))
+        with self.lock:
+            self._prune(unlisted)
+            for relative, stat in self.videos.items():
+                placeholder(self.mirror / relative, *stat)
+                self.state['placeholders'][relative] = stat
+            self._save_state()
+        logger.info("Listed %s on %s: %s videos, pulled %s of %s artifacts into %s", self.storage.url,
+                    type(self.storage.fs).__name__, len(self.videos), pulled, len(self.files), self.mirror)
+        return sorted(self.mirror / relative for relative in self.videos)
+
+    def _prune(self, unlisted: List[str]) -> None:
+        # Leaves no longer listed (deleted, renamed or excluded) lose their placeholder and artifacts
+        # in the mirror, so they're never pushed back. Nothing is deleted remotely, and nothing below
+        # a directory whose listing failed. Called with self.lock held.
+        placeholders = self.state.setdefault('placeholders', {})
+        for relative in sorted(set(placeholders) - set(self.videos)):
+            if any(relative.startswith(prefix) for prefix in unlisted):
+                continue
+            del placeholders[relative]
+            local_path = self.mirror / relative
+            local_path.unlink(missing_ok=True)
+            shutil.rmtree(local_path.parent / local_path.stem, ignore_errors=True)
+            folder = relative[:-len(VIDEO_SUFFIX)] + '/'
+            for side in ('remote', 'local'):
+                for key in [key for key in self.state[side] if key.startswith(folder)]:
+                    del self.state[side][key]
+            logger.info("Dropped %s from the mirror, it is no longer listed", relative)
+
+    def _pull(self, relative: str, stat: list) -> bool:
+        # Only what changed remotely since we last transferred it; local changes not yet pushed
+        # (an interrupted run) are kept and pushed later.
+        local_path = self.mirror / relative
+        with self.lock:
+            if self.state['remote'].get(relative) == stat and local_path.exists():
+                return False
+        self.storage.download(relative, local_path, *stat)
+        with self.lock:
+            self.state['remote'][relative] = stat
+            self.state['local'][relative] = _stat(local_path)
+        return True
+
+    def queue_leaves(self, video_files: List[Path], stages: list) -> List[Path]:
+        # The leaves with work left, biggest first (there's no media to probe for durations yet),
+        # and the first of them start downloading.
+        configs = config_hashes(stages)
+        pending = [video_file for video_file in video_files
+                   if any(state != 'fresh' for state in leaf_status(video_file, stages, configs).values())]
+        pending.sort(key=lambda video_file: self.videos[self.relative(video_file)][0], reverse=True)
+        self.order = [self.relative(video_file) for video_file in pending]
+        self.position = {relative: index for index, relative in enumerate(self.order)}
+        self.started, self.frontier = -1, 0
+        self._prefetch()
+        logger.info("%s of %s leaves have work left", len(pending), len(video_files))
+        return pending
+
+    def _prefetch(self) -> None:
+        with self.order_lock:
+            while self.frontier < min(len(self.order), self.started + 1 + prefetch_leaves):
+                relative = self.order[self.frontier]
+                if not self.cache.prefetch(relative, self.videos[relative]):
+                    break
+                self.frontier += 1
+
+    def start_leaf(self, video_file: Path) -> None:
+        # Blocks until the leaf's media is local, which it usually already is.
+        relative = self.relative(video_file)
+        position = self.position.get(relative, -1)
+        with self.order_lock:
+            self.started = max(self.started, position)
+            self.frontier = max(self.frontier, position + 1)
+        self.cache.fetch(relative, self.videos[relative])
+        self._prefetch()
+
+    def finish_leaf(self, video_file: Path, error: Optional[Exception] = None) -> None:
+        # whatever a failed leaf got through is pushed too
+        self.cache.release(self.relative(video_file))
+        for item in self._changed(video_file.parent / video_file.stem):
+            self.uploads.put(item)
+        self._prefetch()
+
+    def _changed(self, directory: Path) -> List[Tuple[str, list]]:
+        changed = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.treebloomer_')]
+            for name in filenames:
+                local_path = Path(dirpath, name)
+                relative = self.relative(local_path)
+                # source media is read-only: never push a video, let alone a placeholder
+                if name.endswith(VIDEO_SUFFIX) or not _mirrored(name):
+                    continue
+                stat = _stat(local_path)
+                with self.lock:
+                    if stat is not None and self.state['local'].get(relative) != stat:
+                        changed.append((relative, stat))
+        return changed
+
+    def _upload_loop(self) -> None:
+        # A batch goes when it's full or upload_batch_seconds after its first file.
+        batch, deadline = [], 0.0
+        while True:
+            try:
+                item = self.uploads.get(timeout=max(deadline - time.monotonic(), 0) if batch else None)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + upload_batch_seconds
+                batch.append(item)
+            if batch and (item is None or len(batch) >= upload_batch_files):
+                self._upload(batch)
+                batch = []
+        if batch:
+            self._upload(batch)
+
+    def _upload(self, batch: List[Tuple[str, list]]) -> None:
+        batch = list(dict(batch).items())
+        try:
+            self.storage.put([(self.mirror / relative, relative) for relative, _ in batch])
+            # the remote side's new stats, so the next crawl doesn't pull our own uploads back
+            listings = {parent: self.storage.listdir(parent)[1]
+                        for parent in {posixpath.dirname(relative) or '.' for relative, _ in batch}}
+        except Exception as e:
+            # left out of the state, so close() or the next run pushes them again
+            logger.error("Failed to upload %s files to %s: %s", len(batch), self.storage.url, e)
+            self.failed_uploads += len(batch)
+            return
+        with self.lock:
+            for relative, stat in batch:
+                parent, name = posixpath.split(relative)
+                remote_stat = listings[parent or '.'].get(name)
+                if remote_stat is not None:
+                    self.state['remote'][relative] = remote_stat
+                    self.state['local'][relative] = stat
+            self._save_state()
+        logger.info("Uploaded %s files to %s", len(batch), self.storage.url)
+
+    def close(self) -> None:
+        # Drains the upload queue, then pushes everything else that changed in the mirror
+        # (tree-level passes, anything a failed batch left behind).
+        self.uploads.put(_STOP)
+        self.upload_thread.join()
+        self.failed_uploads = 0
+        changed = self._changed(self.mirror)
+        for start in range(0, len(changed), upload_batch_files):
+            self._upload(changed[start:start + upload_batch_files])
+        self.cache.close()
+        if self.failed_uploads:
+            logger.error("%s files could not be uploaded to %s; they are kept in %s and retried on the next run",
+                         self.failed_uploads, self.storage.url, self.mirror)
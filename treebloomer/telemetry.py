@@ -0,0 +1,253 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Off unless main() turns it on. Every hook checks `enabled` first, so a normal run pays one
+# attribute lookup per stage and per API request.
+enabled = False
+settings = {
+    'trace_file': None,
+    'metrics_file': None,
+    'profile_dir': None,
+    'run_id': None,
+}
+
+AUDIO_SUFFIXES = {'.mp3', '.m4a', '.wav', '.aac'}
+
+_write_lock = threading.Lock()
+_current_span: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar('treebloomer_span', default=None)
+
+
+def configure(trace_file: Optional[str] = None, metrics_file: Optional[str] = None,
+              profile_dir: Optional[str] = None, run_id: Optional[str] = None):
+    global enabled
+    settings.update(trace_file=trace_file, metrics_file=metrics_file, profile_dir=profile_dir,
+                    run_id=run_id or settings['run_id'] or uuid.uuid4().hex[:12])
+    # metrics are aggregated from the trace, so asking for metrics alone still writes one next to them
+    if metrics_file and not trace_file:
+        settings['trace_file'] = f"{metrics_file}.trace.jsonl"
+    if profile_dir:
+        Path(profile_dir).mkdir(parents=True, exist_ok=True)
+    enabled = bool(settings['trace_file'] or profile_dir)
+
+
+def worker_settings() -> dict:
+    # passed to spawned worker processes, which don't inherit module state
+    return dict(settings)
+
+
+def _thread_io() -> Dict[str, int]:
+    try:
+        with open('/proc/thread-self/io', 'r') as f:
+            values = dict(line.split(': ') for line in f.read().splitlines())
+        return {'read': int(values['read_bytes']), 'write': int(values['write_bytes'])}
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def _rusage(who: str) -> tuple:
+    # (user + system CPU seconds, ru_maxrss) of RUSAGE_SELF or RUSAGE_CHILDREN; zeros off POSIX
+    try:
+        import resource
+        usage = resource.getrusage(getattr(resource, who))
+        return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+    except (ImportError, ValueError):
+        return 0.0, 0
+
+
+def _file_size(path: Optional[Path]) -> Optional[int]:
+    try:
+        return os.path.getsize(path) if path is not None else None
+    except OSError:
+        return None
+
+
+def _audio_seconds(*paths: Optional[Path]) -> Optional[float]:
+    from treebloomer.processes.media import media_duration
+    for path in paths:
+        if path is not None and Path(path).suffix in AUDIO_SUFFIXES:
+            try:
+                return media_duration(Path(path))
+            except Exception:
+                return None
+    return None
+
+
+class Span:
+    def __init__(self, stage: str, leaf: Path):
+        self.lock = threading.Lock()
+        self.record = {
+            'run': settings['run_id'], 'leaf': str(leaf), 'stage': stage, 'pid': os.getpid(),
+            'api_requests': 0, 'api_retries': 0, 'api_latency_s': 0.0,
+            'api_tokens_estimated': 0, 'api_prompt_tokens': 0, 'api_completion_tokens': 0,
+        }
+
+    def add_api_call(self, latency: float, retries: int, tokens: int, usage) -> None:
+        with self.lock:
+            self.record['api_requests'] += 1
+            self.record['api_retries'] += retries
+            self.record['api_latency_s'] += latency
+            self.record['api_tokens_estimated'] += tokens
+            if usage is not None:
+                self.record['api_prompt_tokens'] += getattr(usage, 'prompt_tokens', 0) or 0
+                self.record['api_completion_tokens'] += getattr(usage, 'completion_tokens', 0) or 0
+
+
+def record_api_call(latency: float, retries: int, tokens: int = 0, response=None) -> None:
+    span = _current_span.get()
+    if span is not None:
+        span.add_api_call(latency, retries, tokens, getattr(response, 'usage', None))
+
+
+def submit(pool, func, *args):
+    # ThreadPoolExecutor workers don't inherit context variables; tasks that make API calls on
+    # behalf of a stage are submitted through here so their requests count against its span.
+    if not enabled:
+        return pool.submit(func, *args)
+    return pool.submit(contextvars.copy_context().run, func, *args)
+
+
+def _append_trace(record: dict) -> None:
+    line = json.dumps(record) + '\n'
+    with _write_lock:
+        # one O_APPEND write per record, so worker processes can share the file
+        fd = os.open(settings['trace_file'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+
+@contextmanager
+def stage_span(stage: str, leaf: Path, input_file: Optional[Path] = None):
+    span = Span(stage, leaf)
+    token = _current_span.set(span)
+    profiler = None
+    if settings['profile_dir']:
+        import cProfile
+        profiler = cProfile.Profile()
+    io_before = _thread_io()
+    wall_before, cpu_before = time.perf_counter(), time.thread_time()
+    record = span.record
+    record['started'] = time.time()
+    output = {}
+    try:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield output
+        finally:
+            if profiler is not None:
+                profiler.disable()
+        record['status'] = 'ok'
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = f"{e.__class__.__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        record['wall_s'] = time.perf_counter() - wall_before
+        record['cpu_s'] = time.thread_time() - cpu_before
+        # Process-wide snapshots, not per stage: getrusage can't tell which thread's stage
+        # started a subprocess, and ru_maxrss is a lifetime high-water mark in KiB (Linux).
+        # write_metrics reports them per process, never per stage.
+        record['children_cpu_s'], record['children_peak_rss_kb'] = _rusage('RUSAGE_CHILDREN')
+        record['process_peak_rss_kb'] = _rusage('RUSAGE_SELF')[1]
+        io_after = _thread_io()
+        if io_before and io_after:
+            record['io_read_bytes'] = io_after['read'] - io_before['read']
+            record['io_write_bytes'] = io_after['write'] - io_before['write']
+        output_file = output.get('file')
+        record['input_bytes'] = _file_size(input_file)
+        record['output_bytes'] = _file_size(output_file)
+        record['audio_s'] = _audio_seconds(output_file, input_file)
+        if profiler is not None:
+            profile_file = Path(settings['profile_dir']) / f"{Path(leaf).stem}.{stage}.{os.getpid()}.prof"
+            profiler.dump_stats(str(profile_file))
+        if settings['trace_file']:
+            try:
+                _append_trace(record)
+            except OSError as e:
+                logger.warning("Could not write trace record to %s: %s", settings['trace_file'], e)
+
+
+metric_fields = {
+    'wall_s': ('treebloomer_stage_wall_seconds_total', 'Wall-clock seconds spent in the stage'),
+    'cpu_s': ('treebloomer_stage_cpu_seconds_total', 'CPU seconds of the thread running the stage'),
+    'io_read_bytes': ('treebloomer_stage_read_bytes_total', 'Bytes read from storage by the stage'),
+    'io_write_bytes': ('treebloomer_stage_written_bytes_total', 'Bytes written to storage by the stage'),
+    'output_bytes': ('treebloomer_stage_output_bytes_total', 'Size of the artifacts the stage produced'),
+    'audio_s': ('treebloomer_stage_audio_seconds_total', 'Seconds of audio handled by the stage'),
+    'api_requests': ('treebloomer_api_requests_total', 'API requests made by the stage'),
+    'api_retries': ('treebloomer_api_retries_total', 'API requests retried by the stage'),
+    'api_latency_s': ('treebloomer_api_latency_seconds_total', 'Seconds spent waiting on API responses'),
+    'api_tokens_estimated': ('treebloomer_api_estimated_tokens_total', 'Prompt tokens estimated before sending'),
+    'api_prompt_tokens': ('treebloomer_api_prompt_tokens_total', 'Prompt tokens reported by the API'),
+    'api_completion_tokens': ('treebloomer_api_completion_tokens_total', 'Completion tokens reported by the API'),
+}
+
+
+def write_metrics() -> None:
+    # Aggregates this run's trace records into a Prometheus textfile (node_exporter textfile
+    # collector format), replaced atomically.
+    if not settings['metrics_file'] or not settings['trace_file']:
+        return
+    runs: Dict[tuple, int] = {}
+    totals: Dict[str, Dict[str, float]] = {field: {} for field in metric_fields}
+    # per pid, the latest of each process-wide snapshot (all three only ever grow)
+    processes: Dict[int, Dict[str, float]] = {}
+    try:
+        with open(settings['trace_file'], 'r', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get('run') != settings['run_id']:
+                    continue
+                stage = record['stage']
+                runs[(stage, record['status'])] = runs.get((stage, record['status']), 0) + 1
+                for field in metric_fields:
+                    if record.get(field) is not None:
+                        totals[field][stage] = totals[field].get(stage, 0) + record[field]
+                process = processes.setdefault(record.get('pid'), {})
+                for field in ('process_peak_rss_kb', 'children_peak_rss_kb', 'children_cpu_s'):
+                    process[field] = max(process.get(field, 0), record.get(field) or 0)
+    except FileNotFoundError:
+        return
+
+    lines = ['# HELP treebloomer_stage_runs_total Stage executions by outcome',
+             '# TYPE treebloomer_stage_runs_total counter']
+    lines += [f'treebloomer_stage_runs_total{{stage="{stage}",status="{status}"}} {count}'
+              for (stage, status), count in sorted(runs.items())]
+    for field, (name, help_text) in metric_fields.items():
+        if not totals[field]:
+            continue
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        lines += [f'{name}{{stage="{stage}"}} {value}' for stage, value in sorted(totals[field].items())]
+    if processes:
+        values = processes.values()
+        lines += ['# HELP treebloomer_process_peak_rss_bytes Lifetime high-water resident set size of the largest treebloomer process',
+                  '# TYPE treebloomer_process_peak_rss_bytes gauge',
+                  f'treebloomer_process_peak_rss_bytes {max(p["process_peak_rss_kb"] for p in values) * 1024}',
+                  '# HELP treebloomer_children_peak_rss_bytes Resident set size of the largest subprocess (ffmpeg) any treebloomer process waited for',
+                  '# TYPE treebloomer_children_peak_rss_bytes gauge',
+                  f'treebloomer_children_peak_rss_bytes {max(p["children_peak_rss_kb"] for p in values) * 1024}',
+                  '# HELP treebloomer_children_cpu_seconds_total CPU seconds of subprocesses (ffmpeg) waited for by treebloomer processes, all stages together',
+                  '# TYPE treebloomer_children_cpu_seconds_total counter',
+                  f'treebloomer_children_cpu_seconds_total {sum(p["children_cpu_s"] for p in values)}']
+    lines += ['# HELP treebloomer_last_run_timestamp_seconds When these metrics were written',
+              '# TYPE treebloomer_last_run_timestamp_seconds gauge',
+              f'treebloomer_last_run_timestamp_seconds {time.time()}']
+
+    path = Path(settings['metrics_file'])
+    incomplete_path = path.with_name(path.name + '.incomplete')
+    with open(incomplete_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    incomplete_path.replace(path)
@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2
+INDEX_NAME = '.treebloomer_scan.json'
+VIDEO_SUFFIX = '.mp4'
+
+# The index maps each directory (relative to the root) to its mtime when last listed, its
+# subdirectories and its leaves as name -> [size, mtime_ns, inode]. A directory's mtime only
+# changes when entries are added, removed or renamed in it, so an unchanged directory is reused
+# from the index with a single stat instead of being listed again. Listings are kept unfiltered
+# and --exclude is applied on top, so changing it never needs a --rescan.
+
+def index_path(root: Path) -> Path:
+    return root / INDEX_NAME
+
+def load_index(root: Path) -> dict:
+    try:
+        with open(index_path(root), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable scan index under %s: %s", root, e)
+    return {'version': INDEX_VERSION, 'dirs': {}}
+
+def save_index(root: Path, index: dict) -> None:
+    path = index_path(root)
+    incomplete_path = path.with_name(path.name + '.incomplete')
+    try:
+        with open(incomplete_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        incomplete_path.replace(path)
+    except OSError as e:
+        logger.warning("Could not save scan index %s: %s", path, e)
+
+def _list_directory(directory: str) -> dict:
+    subdirs, leaves = [], {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # our own state (scan index, queue leases, ...) lives in .treebloomer_* entries
+            if entry.name.startswith('.treebloomer_'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif entry.name.endswith(VIDEO_SUFFIX) and entry.is_file():
+                stat = entry.stat()
+                leaves[entry.name] = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+    # a leaf's artifact subfolder holds no videos and changes on every run; never descend into it
+    artifact_folders = {name[:-len(VIDEO_SUFFIX)] for name in leaves}
+    subdirs = sorted(name for name in subdirs if name not in artifact_folders)
+    return {'subdirs': subdirs, 'leaves': leaves}
+
+def is_remote(location: str) -> bool:
+    # an fsspec URL, handled by treebloomer.storage; file:// counts too, so the remote path can run
+    # against a local directory
+    return '://' in location
+
+def scan_tree(root: Path, exclude: Optional[List[str]] = None, index: Optional[dict] = None,
+              use_index: bool = True) -> Dict[Path, list]:
+    exclude_set = set(exclude or [])
+    if exclude_set.intersection(root.parts):
+        return {}
+    index = index if index is not None else (load_index(root) if use_index else {'version': INDEX_VERSION, 'dirs': {}})
+    previous = index['dirs']
+    current: Dict[str, dict] = {}
+    found: Dict[Path, list] = {}
+    listed = 0
+
+    pending = ['.']
+    while pending:
+        relative = pending.pop()
+        directory = os.path.join(str(root), relative)
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+            entry = previous.get(relative)
+            if entry is None or entry['mtime_ns'] != mtime_ns:
+                entry = dict(_list_directory(directory), mtime_ns=mtime_ns)
+                listed += 1
+        except OSError as e:
+            logger.warning("Could not scan %s: %s", directory, e)
+            continue
+        current[relative] = entry
+        for name, stat in entry['leaves'].items():
+            if name not in exclude_set:
+                found[root / relative / name] = stat
+        pending.extend(os.path.normpath(os.path.join(relative, name)) for name in entry['subdirs']
+                       if name not in exclude_set)
+
+    index['dirs'] = current
+    if use_index:
+        save_index(root, index)
+    logger.info("Scanned %s directories under %s, listed %s, found %s videos.", len(current), root, listed, len(found))
+    return found
+
+def _inotify_watcher(root: Path):
+    # Optional: wakes the watch loop as soon as something changes on local disks. Network mounts
+    # don't deliver inotify events for remote writes, so polling stays the source of truth.
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        return None
+    inotify = INotify()
+    mask = flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE | flags.DELETE
+    for dirpath, dirnames, _ in os.walk(root):
+        try:
+            inotify.add_watch(dirpath, mask)
+        except OSError:
+            pass
+    return inotify
+
+def watch_tree(root: Path, exclude: Optional[List[str]] = None, interval: float = 30.0,
+               settle_seconds: float = 10.0) -> Iterator[List[Path]]:
+    # Yields batches of videos that are new or changed since the previous scan and whose size and
+    # mtime have stopped changing for settle_seconds, i.e. that have finished copying in.
+    inotify = _inotify_watcher(root)
+    logger.info("Watching %s (%s every %ss)", root, 'inotify' if inotify else 'polling', interval)
+    seen: Dict[Path, list] = {}
+    candidates: Dict[Path, tuple] = {}
+    first = True
+    while True:
+        found = scan_tree(root, exclude)
+        now = time.monotonic()
+        for video_file, stat in found.items():
+            if (first or seen.get(video_file) != stat) and video_file not in candidates:
+                candidates[video_file] = (None, now)
+        seen = found
+        first = False
+
+        ready = []
+        for video_file, (last_stat, since) in list(candidates.items()):
+            # stat candidates directly: a file still being written doesn't touch its directory's mtime
+            try:
+                stat = os.stat(video_file)
+            except OSError:
+                del candidates[video_file]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current != last_stat:
+                candidates[video_file] = (current, now)
+            elif now - since >= settle_seconds:
+                ready.append(video_file)
+                del candidates[video_file]
+        if ready:
+            yield sorted(ready)
+
+        wait = min(interval, settle_seconds) if candidates else interval
+        if inotify is not None:
+            if inotify.read(timeout=int(wait * 1000)):
+                # give writers a moment, then rescan; new subdirectories need watches too
+                time.sleep(1.0)
+                inotify.close()
+                inotify = _inotify_watcher(root)
+        else:
+            time.sleep(wait)
@@ -0,0 +1,403 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from treebloomer import telemetry
+from treebloomer.manifest import config_hashes, expected_entries, leaf_status, load_manifest, record_stage, save_manifest
+from treebloomer.scheduler import _init_worker, run_stage
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DIR = '.treebloomer_queue'
+QUEUE_DB = '.treebloomer_queue.sqlite'
+MANIFEST_TASK = '__manifest__'
+
+# Several nodes can work through one shared tree. Each (leaf, stage) task is claimed with a lease
+# before it runs; a holder keeps its leases alive with heartbeats and releases them when done, and
+# a lease that hasn't been renewed for lease_seconds (crashed or partitioned node) can be taken
+# over. Writes to a leaf's manifest take a short lease of their own, heartbeated like a task's,
+# since two stages of one leaf may finish on different nodes at the same time. CPU-bound stages run
+# in a process pool like in the scheduler; the node's threads only hold their leases. Leases compare wall clocks across nodes, so
+# lease_seconds should comfortably exceed any clock skew between them.
+
+
+def default_node_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LockFileLeases:
+    # Each task has a directory under <root>/.treebloomer_queue holding numbered generations of its
+    # lease; the highest one is current and its mtime is the heartbeat. Claiming means creating the
+    # next generation with O_EXCL once the current one is released or expired, so exactly one node
+    # wins every handover, and a release is itself a new generation marked free (a deleted lease
+    # would let a node that saw an older generation claim alongside a new holder). Works on any
+    # shared mount that honours exclusive create (NFSv3+, SMB).
+    def __init__(self, root: Path, node_id: str, lease_seconds: float):
+        self.directory = root / QUEUE_DIR
+        self.directory.mkdir(exist_ok=True)
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        self.held: Dict[Tuple[str, str], int] = {}
+
+    def _folder(self, key: Tuple[str, str]) -> Path:
+        return self.directory / hashlib.sha1('\0'.join(key).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _generations(folder: Path) -> List[Tuple[int, Path]]:
+        generations = []
+        try:
+            for path in folder.iterdir():
+                number, _, suffix = path.name.partition('.')
+                if suffix == 'lease' and number.isdigit():
+                    generations.append((int(number), path))
+        except FileNotFoundError:
+            pass
+        return sorted(generations)
+
+    @staticmethod
+    def _read(path: Path) -> Optional[dict]:
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # gone, or just created and not written yet
+            return None
+
+    def _create(self, folder: Path, generation: int, record: dict) -> bool:
+        try:
+            fd = os.open(folder / f"{generation}.lease", os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        for number, path in self._generations(folder):
+            if number < generation:
+                path.unlink(missing_ok=True)
+        return True
+
+    def claim(self, key: Tuple[str, str]) -> bool:
+        folder = self._folder(key)
+        folder.mkdir(exist_ok=True)
+        generations = self._generations(folder)
+        generation = 0
+        if generations:
+            generation, path = generations[-1]
+            record = self._read(path)
+            if record is None or not record.get('free'):
+                try:
+                    if time.time() - path.stat().st_mtime <= self.lease_seconds:
+                        return False
+                except FileNotFoundError:
+                    # superseded while we looked
+                    return False
+                logger.warning("Taking over expired lease on %s", ' / '.join(key))
+        if not self._create(folder, generation + 1, {'node': self.node_id, 'leaf': key[0], 'stage': key[1],
+                                                     'claimed': time.time()}):
+            return False
+        with self.lock:
+            self.held[key] = generation + 1
+        return True
+
+    def _current(self, key: Tuple[str, str]) -> Optional[Path]:
+        # our lease file if it's still the current generation
+        with self.lock:
+            generation = self.held.get(key)
+        generations = self._generations(self._folder(key))
+        if generation is None or not generations or generations[-1][0] != generation:
+            return None
+        return generations[-1][1]
+
+    def renew(self, key: Tuple[str, str]) -> bool:
+        path = self._current(key)
+        if path is None:
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self, key: Tuple[str, str]) -> None:
+        path = self._current(key)
+        with self.lock:
+            generation = self.held.pop(key, None)
+        if path is not None:
+            self._create(path.parent, generation + 1, {'free': True})
+
+    def others_active(self) -> bool:
+        now = time.time()
+        for folder in self.directory.iterdir():
+            generations = self._generations(folder) if folder.is_dir() else []
+            if not generations:
+                continue
+            path = generations[-1][1]
+            record = self._read(path) or {}
+            try:
+                if not record.get('free') and record.get('node') != self.node_id \
+                        and now - path.stat().st_mtime <= self.lease_seconds:
+                    return True
+            except FileNotFoundError:
+                pass
+        return False
+
+
+class SQLiteLeases:
+    # A leases table in one SQLite database; claims are single IMMEDIATE transactions. Suited to a
+    # local disk shared by several processes, or a database on a mount with working POSIX locks.
+    def __init__(self, db_path: Path, node_id: str, lease_seconds: float):
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS leases (leaf TEXT NOT NULL, stage TEXT NOT NULL, "
+                                "node TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (leaf, stage))")
+
+    def claim(self, key: Tuple[str, str]) -> bool:
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("DELETE FROM leases WHERE leaf = ? AND stage = ? AND expires < ?", (*key, now))
+                inserted = self.connection.execute("INSERT OR IGNORE INTO leases VALUES (?, ?, ?, ?)",
+                                                   (*key, self.node_id, now + self.lease_seconds)).rowcount
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return inserted == 1
+
+    def renew(self, key: Tuple[str, str]) -> bool:
+        with self.lock:
+            return self.connection.execute("UPDATE leases SET expires = ? WHERE leaf = ? AND stage = ? AND node = ?",
+                                           (time.time() + self.lease_seconds, *key, self.node_id)).rowcount == 1
+
+    def release(self, key: Tuple[str, str]) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM leases WHERE leaf = ? AND stage = ? AND node = ?", (*key, self.node_id))
+
+    def others_active(self) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM leases WHERE node != ? AND expires >= ? LIMIT 1",
+                                           (self.node_id, time.time())).fetchone() is not None
+
+
+class Heartbeat:
+    # Renews every lease this node holds every lease_seconds / 3 on a background thread.
+    def __init__(self, leases, lease_seconds: float):
+        self.leases = leases
+        self.interval = lease_seconds / 3
+        self.held: Dict[Tuple[str, str], bool] = {}
+        self.lost: set = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='treebloomer-heartbeat', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                keys = list(self.held)
+            for key in keys:
+                try:
+                    if not self.leases.renew(key):
+                        logger.warning("Lost lease on %s", ' / '.join(key))
+                        with self.lock:
+                            self.lost.add(key)
+                except Exception as e:
+                    logger.warning("Heartbeat for %s failed: %s", ' / '.join(key), e)
+
+    def hold(self, key: Tuple[str, str]):
+        with self.lock:
+            self.held[key] = True
+
+    def drop(self, key: Tuple[str, str]):
+        with self.lock:
+            self.held.pop(key, None)
+            self.lost.discard(key)
+
+    def still_held(self, key: Tuple[str, str]) -> bool:
+        with self.lock:
+            if key in self.lost:
+                return False
+        return self.leases.renew(key)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class QueueWorker:
+    def __init__(self, root: Path, stages: list, leases, node_stages: Optional[Sequence[str]] = None,
+                 stage_options: Optional[dict] = None, lease_seconds: float = 120.0, failed: Optional[set] = None,
+                 cpu_pool: Optional[Executor] = None):
+        self.root = root
+        self.stages = stages
+        self.configs = config_hashes(stages)
+        self.leases = leases
+        self.node_stages = set(node_stages) if node_stages else {stage.name for stage in stages}
+        self.stage_options = stage_options
+        self.heartbeat = Heartbeat(leases, lease_seconds)
+        # shared by a node's worker threads, so a failing task isn't retried once per thread
+        self.failed: set = failed if failed is not None else set()
+        self.cpu_pool = cpu_pool
+        self.completed = 0
+
+    def _key(self, video_file: Path, stage_name: str) -> Tuple[str, str]:
+        return video_file.relative_to(self.root).as_posix(), stage_name
+
+    def _record(self, video_file: Path, stage, output_file: Path) -> None:
+        key = self._key(video_file, MANIFEST_TASK)
+        delay = 0.05
+        while True:
+            while not self.leases.claim(key):
+                time.sleep(random.uniform(0, delay))
+                delay = min(delay * 2, 1.0)
+            self.heartbeat.hold(key)
+            try:
+                manifest = load_manifest(video_file)
+                record_stage(manifest, stage.name, expected_entries(video_file, self.stages, self.configs)[stage.name],
+                             output_file)
+                # a stall past lease_seconds hands the manifest to another node; don't overwrite its write
+                if self.heartbeat.still_held(key):
+                    save_manifest(video_file, manifest)
+                    return
+            finally:
+                self.heartbeat.drop(key)
+                self.leases.release(key)
+            logger.warning("Lease on the manifest of %s lost before saving; retrying", video_file)
+
+    def ready_tasks(self, video_file: Path) -> Tuple[List, bool]:
+        # (stages this node can run now, whether any of this node's stages are still pending there)
+        status = leaf_status(video_file, self.stages, self.configs)
+        ours = [stage for stage in self.stages
+                if status[stage.name] != 'fresh' and stage.name in self.node_stages
+                and (video_file, stage.name) not in self.failed]
+        ready = [stage for stage in ours if all(status[name] == 'fresh' for name in stage.requires)]
+        return ready, bool(ours)
+
+    def run_task(self, video_file: Path, stage) -> bool:
+        key = self._key(video_file, stage.name)
+        if not self.leases.claim(key):
+            return False
+        self.heartbeat.hold(key)
+        try:
+            # re-check under the lease: another node may have finished it since we looked
+            status = leaf_status(video_file, self.stages, self.configs)
+            if status[stage.name] == 'fresh' or any(status[name] != 'fresh' for name in stage.requires):
+                return False
+            subfolder = video_file.parent / video_file.stem
+            subfolder.mkdir(exist_ok=True)
+            recorded = load_manifest(video_file).get('stages', {})
+            input_file = video_file if stage.input_stage is None else subfolder / recorded[stage.input_stage]['output']
+            logger.info("Running %s on %s", stage.name, video_file)
+            try:
+                force = status[stage.name] == 'stale'
+                if self.cpu_pool is not None and stage.pool == 'cpu':
+                    output_file = self.cpu_pool.submit(run_stage, stage, input_file, subfolder, self.stage_options,
+                                                       force).result()
+                else:
+                    output_file = run_stage(stage, input_file, subfolder, self.stage_options, force=force)
+            except Exception as e:
+                logger.error("Failed to process %s at %s: %s", video_file, stage.name, e)
+                self.failed.add((video_file, stage.name))
+                return False
+            if not self.heartbeat.still_held(key):
+                # another node has taken the task over and records its own result
+                logger.warning("Lease on %s / %s lost while running; not recording the result", video_file, stage.name)
+                return False
+            self._record(video_file, stage, output_file)
+            self.completed += 1
+            return True
+        finally:
+            self.heartbeat.drop(key)
+            self.leases.release(key)
+
+    def run(self, video_files: List[Path], poll_interval: float = 10.0, idle_exit: float = 0.0) -> int:
+        # Passes over the tree until nothing is left that this node can do. Leaves are visited from a
+        # random offset so nodes starting together don't all contend for the same leaf.
+        offset = random.randrange(max(len(video_files), 1))
+        ordered = video_files[offset:] + video_files[:offset]
+        idle_since = None
+        try:
+            while True:
+                worked, waiting = False, False
+                for video_file in ordered:
+                    try:
+                        ready, pending = self.ready_tasks(video_file)
+                    except OSError as e:
+                        logger.error("Failed to read the state of %s: %s", video_file, e)
+                        continue
+                    waiting = waiting or pending
+                    for stage in ready:
+                        worked = self.run_task(video_file, stage) or worked
+                if worked:
+                    idle_since = None
+                    continue
+                if not waiting:
+                    return self.completed
+                # our remaining work is blocked on another node (a lease, or a stage we don't run)
+                idle_since = idle_since or time.monotonic()
+                if not self.leases.others_active() and time.monotonic() - idle_since >= idle_exit:
+                    logger.info("Nothing this node can do right now and no other node is active; exiting")
+                    return self.completed
+                time.sleep(poll_interval)
+        finally:
+            self.heartbeat.stop()
+
+
+def open_leases(kind: str, root: Path, node_id: str, lease_seconds: float, db_path: Optional[Path] = None):
+    if kind == 'sqlite':
+        return SQLiteLeases(db_path or root / QUEUE_DB, node_id, lease_seconds)
+    return LockFileLeases(root, node_id, lease_seconds)
+
+
+def run_queue_worker(root: Path, video_files: List[Path], stages: list, kind: str = 'lockfile',
+                     node_id: Optional[str] = None, node_stages: Optional[Sequence[str]] = None,
+                     stage_options: Optional[dict] = None, workers: int = 1, jobs: int = 1,
+                     lease_seconds: float = 120.0, poll_interval: float = 10.0, idle_exit: float = 0.0,
+                     db_path: Optional[Path] = None, log_format: str = logging.BASIC_FORMAT) -> int:
+    node_id = node_id or default_node_id()
+    names = {stage.name for stage in stages}
+    # pool names are shorthand for the stages in that pool
+    selected = set()
+    for name in node_stages or names:
+        if name in ('cpu', 'api'):
+            selected.update(stage.name for stage in stages if stage.pool == name)
+        else:
+            selected.add(name)
+    unknown = selected - names
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+    logger.info("Queue worker %s running %s with %s threads", node_id, ', '.join(sorted(selected)), workers)
+
+    leases = open_leases(kind, root, node_id, lease_seconds, db_path)
+    # the threads would run CPU-bound stages one at a time under the GIL
+    cpu_pool = None
+    if any(stage.pool == 'cpu' and stage.name in selected for stage in stages):
+        cpu_pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                       initargs=(logging.getLogger().level, log_format, telemetry.worker_settings()))
+    failed: set = set()
+    queue_workers = [QueueWorker(root, stages, leases, selected, stage_options, lease_seconds, failed, cpu_pool)
+                     for _ in range(workers)]
+    threads = [threading.Thread(target=worker.run, args=(video_files, poll_interval, idle_exit),
+                                name=f"treebloomer-queue-{index}") for index, worker in enumerate(queue_workers)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if cpu_pool is not None:
+            cpu_pool.shutdown(wait=True, cancel_futures=True)
+    completed = sum(worker.completed for worker in queue_workers)
+    logger.info("Queue worker %s completed %s tasks", node_id, completed)
+    return completed